@@ -2,7 +2,7 @@
 <xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0" xmlns:t="http://www.tei-c.org/ns/1.0" exclude-result-prefixes="t">
     
     <xsl:strip-space elements="*" />
-    <xsl:output omit-xml-declaration="yes" indent="yes"/>
+    <xsl:output omit-xml-declaration="yes" indent="yes" encoding="UTF-8"/>
         
     <!-- glyphs -->
     <xsl:template name="split-refs">
@@ -63,6 +63,9 @@
             <xsl:if test="@n">
                 <xsl:attribute name="wordnum"><xsl:value-of select="@n"/></xsl:attribute>
             </xsl:if>
+            <xsl:if test="@passageword">
+                <xsl:attribute name="passageword"><xsl:value-of select="@passageword"/></xsl:attribute>
+            </xsl:if>
             <xsl:if test="parent::t:seg[@type='font-style:underline;']">
                 <xsl:attribute name="data-lexicon"><xsl:value-of select="@lemmaRef"/></xsl:attribute>
                 <xsl:attribute name="onclick">showLexEntry(this)</xsl:attribute>
@@ -10,12 +10,26 @@ class Config(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     POSTS_PER_PAGE = 10
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # Search the corpus with an index stored under CACHE_DIRECTORY when ELASTICSEARCH_URL is not set.
+    # 'python manager.py build-search-index' builds the index before the first search.
+    LOCAL_SEARCH = os.environ.get('NO_LOCAL_SEARCH') is None
     LANGUAGES = ['en', 'de', 'fr']
     CORPUS_FOLDERS = os.environ.get('CORPUS_FOLDERS').split(';') if os.environ.get('CORPUS_FOLDERS') else ["/home/matt/results/formulae"]
     SQLALCHEMY_BINDS = {
         'appmeta':      'sqlite:////{}/appmeta.db'.format(CORPUS_FOLDERS[0])
     }
     CACHE_DIRECTORY = os.environ.get('NEMO_CACHE_DIR') or './cache/'
+    # The maximum size in bytes of the rendered passages stored under CACHE_DIRECTORY. Set to 0 to disable the cache.
+    PASSAGE_CACHE_MAX_SIZE = int(os.environ.get('PASSAGE_CACHE_MAX_SIZE') or 256 * 1024 * 1024)
+    # The number of threads used to render the texts of multi-text views in parallel
+    PASSAGE_RENDER_THREADS = int(os.environ.get('PASSAGE_RENDER_THREADS') or 1)
+    # Write the corpus metadata snapshot under CACHE_DIRECTORY when the app boots without a fresh one.
+    # 'python manager.py build-snapshot' also stores the references of every text in the snapshot.
+    CORPUS_SNAPSHOT_ON_BOOT = os.environ.get('NO_CORPUS_SNAPSHOT') is None
+    # Only read the TEI headers at startup and parse each text when it is first requested
+    LAZY_RESOLVER = os.environ.get('LAZY_RESOLVER') is not None
+    # The estimated memory in bytes that the lazy resolver may use for the parsed texts it keeps
+    PARSED_TEXT_CACHE_SIZE = int(os.environ.get('PARSED_TEXT_CACHE_SIZE') or 128 * 1024 * 1024)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -24,6 +38,35 @@ class Config(object):
     ADMINS = os.environ.get('ADMINS').split(';') if os.environ.get('ADMINS') else ['no-reply@example.com']
     # This should only be changed to True when collecting search queries and responses for mocking ES
     SAVE_REQUESTS = False
+    # The number of Elasticsearch responses kept by each worker and the number of seconds they are used. 0 disables the cache.
+    SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES') or 1000)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 24 * 60 * 60)
+    # The number of responses that are also stored under CACHE_DIRECTORY so that all workers share them. 0 disables this.
+    SEARCH_CACHE_SHARED_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_SHARED_MAX_ENTRIES') or 0)
+    # How long Elasticsearch keeps the point in time that deep result pages are retrieved from after its last use
+    SEARCH_PIT_KEEP_ALIVE = os.environ.get('SEARCH_PIT_KEEP_ALIVE') or '10m'
+    # The number of seconds after which a search is given up and the number of pooled connections to each ES node
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 10)
+    ELASTICSEARCH_CONNECTIONS = int(os.environ.get('ELASTICSEARCH_CONNECTIONS') or 10)
+    # The number of result pages after the current one that are retrieved in the background. 0 disables prefetching.
+    SEARCH_PREFETCH_PAGES = int(os.environ.get('SEARCH_PREFETCH_PAGES') or 0)
+    SEARCH_PREFETCH_THREADS = int(os.environ.get('SEARCH_PREFETCH_THREADS') or 2)
+    # The maximum number of completions /search/suggest returns for the word that is being typed
+    AUTOCOMPLETE_MAX_RESULTS = int(os.environ.get('AUTOCOMPLETE_MAX_RESULTS') or 10)
     CACHE_MAX_AGE = os.environ.get('VARNISH_MAX_AGE') or 0 # This doesn't need to be set locally.
-    TEXT_PARALLELS = os.environ.get('TEXT_PARALLELS') or [os.path.join(x, 'text_parallels.json') for x in CORPUS_FOLDERS]
-    NT_COMMENTARY_SECTIONS = os.environ.get('NT_COMMENTARY_SECTIONS') or [os.path.join(x, 'nt_commentary_sections.json') for x in CORPUS_FOLDERS]
+    # The number of seconds for which browsers and Varnish may use the responses of these routes before revalidating them
+    # with their ETag. 'api' stands for the routes under /api. The other routes use CACHE_MAX_AGE.
+    ROUTE_MAX_AGE = {'r_multipassage': int(os.environ.get('PASSAGE_MAX_AGE') or 0),
+                     'r_collection': int(os.environ.get('COLLECTION_MAX_AGE') or 0),
+                     'r_references': int(os.environ.get('REFERENCES_MAX_AGE') or 0),
+                     'r_passage_fragment': int(os.environ.get('FRAGMENT_MAX_AGE') or 0),
+                     'api': int(os.environ.get('API_MAX_AGE') or 0)}
+    # Passage pages only contain ESI includes of /fragment/ URLs for their passages and notes, which are the same for
+    # every reader and can be kept by the edge cache. Only set this behind a cache that processes ESI (e.g., Varnish with
+    # do_esi) and drops the cookies of the requests for /fragment/.
+    FRAGMENT_CACHING = os.environ.get('FRAGMENT_CACHING') is not None
+    # Identifies the deployed code in the ETags and the passage cache, e.g., the git commit that the deployment sets with
+    # APP_VERSION=$(git rev-parse HEAD). Without it, the names, sizes and modification times of the code files are used.
+    APP_VERSION = os.environ.get('APP_VERSION')
+    TEXT_PARALLELS = os.environ.get('TEXT_PARALLELS').split(';') if os.environ.get('TEXT_PARALLELS') else [os.path.join(x, 'text_parallels.json') for x in CORPUS_FOLDERS]
+    NT_COMMENTARY_SECTIONS = os.environ.get('NT_COMMENTARY_SECTIONS').split(';') if os.environ.get('NT_COMMENTARY_SECTIONS') else [os.path.join(x, 'nt_commentary_sections.json') for x in CORPUS_FOLDERS]
@@ -11,6 +11,7 @@ from flask_bootstrap import Bootstrap
 from flask_babel import Babel
 from flask_babel import lazy_gettext as _l
 from flask_mail import Mail
+from concurrent.futures import ThreadPoolExecutor
 
 db = SQLAlchemy()
 login = LoginManager()
@@ -25,8 +26,29 @@ mail = Mail()
 def create_app(config_class=Config):
     app = Flask("Flask Application for Nemo")
     app.config.from_object(config_class)
-    app.elasticsearch = Elasticsearch(app.config['ELASTICSEARCH_URL']) \
-        if app.config['ELASTICSEARCH_URL'] else None
+    # The connections to Elasticsearch are kept open and shared by all threads of the worker
+    app.elasticsearch = None
+    if app.config['ELASTICSEARCH_URL']:
+        app.elasticsearch = Elasticsearch(app.config['ELASTICSEARCH_URL'],
+                                          request_timeout=app.config['ELASTICSEARCH_TIMEOUT'],
+                                          connections_per_node=app.config['ELASTICSEARCH_CONNECTIONS'])
+    elif app.config['LOCAL_SEARCH']:
+        # Answers the same requests from an index of the corpus files so that deployments without ES can be searched
+        from .search.local import LocalSearch
+        app.elasticsearch = LocalSearch(app.config['CORPUS_FOLDERS'],
+                                        os.path.join(app.config['CACHE_DIRECTORY'], 'local_search'))
+    app.search_executor = ThreadPoolExecutor(max_workers=app.config['SEARCH_PREFETCH_THREADS']) \
+        if app.config['SEARCH_PREFETCH_PAGES'] else None
+    app.search_cache = None
+    if app.config['SEARCH_CACHE_MAX_ENTRIES']:
+        from .search.cache import SearchCache, SharedSearchStore
+        shared = SharedSearchStore(app.config['CACHE_DIRECTORY'], app.config['SEARCH_CACHE_SHARED_MAX_ENTRIES']) \
+            if app.config['SEARCH_CACHE_SHARED_MAX_ENTRIES'] else None
+        app.search_cache = SearchCache(app.config['SEARCH_CACHE_MAX_ENTRIES'], app.config['SEARCH_CACHE_TTL'],
+                                       shared=shared)
+    from .search.autocomplete import Autocompleter
+    # The vocabulary is loaded on first use. 'python manager.py build-autocomplete' builds it before a deploy.
+    app.autocompleter = Autocompleter(app.config['CORPUS_FOLDERS'], app.config['CACHE_DIRECTORY'])
 
     db.init_app(app)
     migrate.init_app(app, db)
@@ -53,6 +75,10 @@ def create_app(config_class=Config):
 
 
 def get_locale():
+    # The passage fragments are requested by the edge cache without cookies and carry the locale of their page
+    if request.endpoint == 'InstanceNemo.r_passage_fragment' and \
+            request.args.get('locale') in current_app.config['LANGUAGES']:
+        return request.args['locale']
     if 'locale' in session:
         return session['locale']
     if current_user.is_authenticated and current_user.default_locale:
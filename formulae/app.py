@@ -2,9 +2,19 @@ from MyCapytain.resolvers.capitains.local import XmlCapitainsLocalResolver
 from capitains_nautilus.flask_ext import FlaskNautilus
 from . import create_app
 from .nemo import NemoFormulae
+from .corpus_snapshot import CorpusSnapshot
+from .lazy_resolver import LazyCapitainsResolver
 
 flask_app = create_app()
-resolver = XmlCapitainsLocalResolver(flask_app.config['CORPUS_FOLDERS'])
+snapshot = CorpusSnapshot(flask_app.config['CACHE_DIRECTORY'], NemoFormulae.corpus_paths(flask_app.config))
+resolver_class = LazyCapitainsResolver if flask_app.config['LAZY_RESOLVER'] else XmlCapitainsLocalResolver
+if snapshot.load(resolver_class):
+    resolver = snapshot.resolver
+else:
+    with snapshot.timer.measure('parse_corpus'):
+        resolver = resolver_class(flask_app.config['CORPUS_FOLDERS'])
+if flask_app.config['LAZY_RESOLVER']:
+    resolver.trees.max_size = flask_app.config['PARSED_TEXT_CACHE_SIZE']
 nautilus_api = FlaskNautilus(prefix="/api", resolver=resolver, app=flask_app)
 
 nemo = NemoFormulae(
@@ -21,7 +31,8 @@ nemo = NemoFormulae(
                "errors": "templates/errors",
                "auth": "templates/auth",
                "search": "templates/search"},
-    pdf_folder="pdf_folder/"
+    pdf_folder="pdf_folder/",
+    snapshot=snapshot
 )
 
 
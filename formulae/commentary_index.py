@@ -0,0 +1,152 @@
+import os
+from bisect import bisect_left
+from sys import intern
+from threading import Lock
+from time import time
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+Passage = Tuple[str, str]
+
+
+def split_urn(urn: str) -> Passage:
+    """ Splits a passage-level URN into the identifier of its text and its subreference"""
+    ident, _, ref = urn.rpartition(':')
+    return intern(ident), intern(ref)
+
+
+def ref_key(ref: str) -> Tuple[Tuple[int, object], ...]:
+    """ The sort key of a subreference, e.g., '1.10' after '1.9'"""
+    return tuple((0, int(x)) if x.isdigit() else (1, x) for x in ref.split('.'))
+
+
+class PassageRelations(object):
+    """ The passages that are related to each passage of a set of texts. Besides single passages, ranges such as
+        '1.1-1.5' and whole chapters such as '1' can be looked up, which return the related passages of every passage
+        they contain in reading order.
+    """
+
+    def __init__(self):
+        self.related = dict()  # type: Dict[str, Dict[str, Tuple[Passage, ...]]]
+        self._keys = dict()  # type: Dict[str, List[Tuple]]
+        self._refs = dict()  # type: Dict[str, List[str]]
+
+    def add(self, ident: str, ref: str, passage: Passage):
+        self.related.setdefault(ident, dict()).setdefault(ref, [])
+        self.related[ident][ref].append(passage)
+
+    def freeze(self):
+        """ Make the lists of related passages immutable and sort the subreferences of every text"""
+        for ident, refs in self.related.items():
+            for ref, passages in refs.items():
+                refs[ref] = tuple(passages)
+            ordered = sorted(refs, key=ref_key)
+            self._refs[ident] = ordered
+            self._keys[ident] = [ref_key(x) for x in ordered]
+
+    def get(self, ident: str, subreference: str) -> List[Passage]:
+        """ The passages related to a passage, a range of passages or a chapter of a text
+
+        :param ident: the identifier of the text
+        :param subreference: the subreference, e.g., '1.1', '1.1-1.5' or '1'
+        :return: the related passages without duplicates
+        """
+        refs = self.related.get(ident)
+        if not refs:
+            return []
+        if subreference in refs:
+            return list(refs[subreference])
+        start, _, end = subreference.partition('-')
+        start_key, end_key = ref_key(start), ref_key(end or start)
+        keys = self._keys[ident]
+        found = []
+        for i in range(bisect_left(keys, start_key), len(keys)):
+            if keys[i][:len(end_key)] > end_key:
+                break
+            for passage in refs[self._refs[ident][i]]:
+                if passage not in found:
+                    found.append(passage)
+        return found
+
+
+class NtCommentaryIndex(object):
+    """ The links between the New Testament and the commentaries, held in memory so that they do not have to be
+        queried for every view. The NtComRels table of the appmeta database is indexed in both directions, from each
+        NT passage to the commentary sections on it and from each commentary section to the NT passages it comments
+        on. NemoFormulae loads it on startup and it is loaded again when the database file changes, which is checked
+        at most once every REFRESH_INTERVAL seconds. The identifiers are split and interned once.
+
+        The word-level links from the NT_COMMENTARY_SECTIONS files are kept in sections in the form returned by
+        NemoFormulae.compile_nt_commentary_sections, usually as a memory-mapped PassageTable.
+
+    :param sections: the compiled word-level links
+    :param database_uri: the SQLAlchemy URI of the appmeta database
+    """
+
+    # The number of seconds for which a change of the database file is not looked for again
+    REFRESH_INTERVAL = 10
+
+    def __init__(self, sections: Optional[Mapping[str, Mapping[str, Dict[str, str]]]] = None,
+                 database_uri: Optional[str] = None):
+        self.sections = sections if sections is not None else dict()
+        self.database_path = make_url(database_uri).database if database_uri else None
+        self.nt_to_commentary = PassageRelations()
+        self.commentary_to_nt = PassageRelations()
+        self._stamp = None
+        self._checked = 0.0
+        self._loaded = False
+        self._lock = Lock()
+
+    def load(self, rows: Iterable[Tuple[str, str]]):
+        """ Build the indices from (nt, com) pairs of passage-level URNs"""
+        nt_to_commentary = PassageRelations()
+        commentary_to_nt = PassageRelations()
+        for nt, com in rows:
+            nt_passage = split_urn(nt)
+            ident, ref = split_urn(com)
+            # The commentaries are linked to with the cjhnt namespace
+            com_passage = (intern(ident.replace('greekLit', 'cjhnt')), ref)
+            nt_to_commentary.add(nt_passage[0], nt_passage[1], com_passage)
+            commentary_to_nt.add(com_passage[0], com_passage[1], nt_passage)
+        nt_to_commentary.freeze()
+        commentary_to_nt.freeze()
+        self.nt_to_commentary, self.commentary_to_nt = nt_to_commentary, commentary_to_nt
+        self._loaded = True
+
+    def refresh(self):
+        """ Load the NtComRels table if it has not been loaded yet or if the database file has changed. This needs an
+            application context.
+        """
+        now = time()
+        if self._loaded and now - self._checked < self.REFRESH_INTERVAL:
+            return
+        self._checked = now
+        stamp = None
+        if self.database_path and os.path.isfile(self.database_path):
+            stat = os.stat(self.database_path)
+            stamp = (stat.st_size, stat.st_mtime_ns)
+        if self._loaded and stamp == self._stamp:
+            return
+        with self._lock:
+            if self._loaded and stamp == self._stamp:
+                return
+            from .models import NtComRels
+            try:
+                rows = NtComRels.query.with_entities(NtComRels.nt, NtComRels.com).order_by(NtComRels.id).all()
+            except OperationalError:
+                # The table has not been created yet. It is read when it is created since that changes the file.
+                NtComRels.query.session.rollback()
+                rows = []
+            self.load(rows)
+            self._stamp = stamp
+
+    def commentaries(self, objectId: str, subreference: str) -> List[Passage]:
+        """ The commentary sections on an NT passage, range of passages or chapter as (objectId, subreference)"""
+        self.refresh()
+        return self.nt_to_commentary.get(objectId, subreference)
+
+    def nt_passages(self, objectId: str, subreference: str) -> List[Passage]:
+        """ The NT passages that a commentary section comments on as (objectId, subreference)"""
+        self.refresh()
+        return self.commentary_to_nt.get(objectId, subreference)
@@ -0,0 +1,119 @@
+import os
+import pickle
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha1
+from time import perf_counter
+from typing import Iterable, Optional, Dict, Any
+from MyCapytain.common.constants import set_graph
+from MyCapytain.resolvers.utils import CollectionDispatcher
+from .passage_cache import list_files
+
+
+def file_fingerprint(paths: Iterable[str], extensions: Iterable[str] = ('.xml', '.json')) -> str:
+    """ Builds a hash over the names, sizes and modification times of all files with the given extensions in paths.
+        Unlike content_hash, this does not read the files, so it is cheap enough to be computed on every boot.
+
+    :param paths: the files and folders to include
+    :param extensions: only files with these extensions are included
+    :return: the hexadecimal digest
+    """
+    digest = sha1()
+    for file_path in list_files(paths, extensions):
+        stat = os.stat(file_path)
+        digest.update('{}:{}:{}\n'.format(file_path, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class StartupTimer(object):
+    """ Records how long each step of the application startup takes"""
+
+    def __init__(self):
+        self.times = OrderedDict()  # type: Dict[str, float]
+
+    @contextmanager
+    def measure(self, step: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[step] = self.times.get(step, 0) + perf_counter() - start
+
+    def report(self) -> str:
+        """ A one-line summary of the recorded steps and their total"""
+        return ', '.join(['{} {:.3f}s'.format(step, t) for step, t in self.times.items()] +
+                         ['total {:.3f}s'.format(sum(self.times.values()))])
+
+
+class CorpusSnapshot(object):
+    """ A serialized copy of everything that is derived from the corpus metadata at startup: the parsed inventory
+        of the resolver, the sub-collections with their short titles, the chunked references of the texts and the
+        hash of the corpus contents. Loading the snapshot is much faster than parsing all of the __cts__.xml files
+        and walking the inventory again.
+
+        The snapshot is only used if the fingerprint of the corpus files (i.e., their names, sizes and modification
+        times) is the same as when it was written. The fingerprint is stored at the beginning of the file so that a
+        stale snapshot is recognized without deserializing the rest of it.
+
+    :param directory: the folder in which the snapshot file is stored
+    :param paths: the corpus folders and additional files whose changes make the snapshot stale
+    """
+
+    FILE_NAME = 'corpus_snapshot.pickle'
+
+    def __init__(self, directory: str, paths: Iterable[str]):
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.timer = StartupTimer()
+        with self.timer.measure('fingerprint'):
+            self.fingerprint = file_fingerprint(paths)
+        self.data = None  # type: Optional[Dict[str, Any]]
+
+    def load(self, resolver_class: type = None) -> bool:
+        """ Load the snapshot if it exists and is fresh
+
+        :param resolver_class: if given, the snapshot is only loaded if its resolver is of exactly this class
+        :return: whether a fresh snapshot was loaded
+        """
+        with self.timer.measure('load_snapshot'):
+            try:
+                with open(self.path, 'rb') as f:
+                    if pickle.load(f) != self.fingerprint:
+                        return False
+                    data = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+                return False
+            snapshot_class, state = data['resolver']
+            if resolver_class is not None and snapshot_class is not resolver_class:
+                return False
+            resolver = snapshot_class.__new__(snapshot_class)
+            resolver.__dict__.update(state)
+            resolver.dispatcher = CollectionDispatcher(resolver.inventory)
+            # All metadata objects share the graph they were unpickled with, so MyCapytain has to use it as well
+            set_graph(resolver.inventory.graph)
+            data['resolver'] = resolver
+            self.data = data
+        return True
+
+    @property
+    def resolver(self):
+        return self.data['resolver'] if self.data else None
+
+    def save(self, resolver, **data):
+        """ Write a new snapshot. The file is replaced atomically so that workers that are starting at the same time
+            never read a partially written snapshot.
+
+        :param resolver: the resolver whose parsed inventory should be stored
+        :param data: the other values to store, e.g., sub_colls and reffs_indices
+        """
+        with self.timer.measure('write_snapshot'):
+            # The dispatcher is only needed while parsing the corpus and contains functions that cannot be pickled
+            state = {k: v for k, v in vars(resolver).items() if k != 'dispatcher'}
+            data['resolver'] = (type(resolver), state)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(self.fingerprint, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            data['resolver'] = resolver
+            self.data = data
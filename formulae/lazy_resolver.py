@@ -0,0 +1,123 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, Any
+from lxml import etree
+from MyCapytain.resolvers.capitains.local import XmlCapitainsLocalResolver
+
+
+TEI_TEXT = '{http://www.tei-c.org/ns/1.0}text'
+
+
+def parse_header(file) -> etree._Element:
+    """ Parses a TEI document only up to the start of its <text> element. The result contains the whole teiHeader,
+        including the citation scheme in its refsDecl, but none of the text itself.
+
+    :param file: the opened TEI file
+    :return: the root element of the document without its text
+    """
+    root = None
+    # iterparse only accepts files that are opened in binary mode, so the file is opened again from its path
+    for event, element in etree.iterparse(file.name, events=('start',)):
+        if root is None:
+            root = element
+        if element.tag == TEI_TEXT:
+            element.getparent().remove(element)
+            break
+    return root
+
+
+class ParsedTreeCache(object):
+    """ A thread-safe least recently used store of parsed XML trees with a memory budget. The memory that a parsed
+        tree uses is estimated from the size of its file. An entry is parsed again if its file has been changed.
+        When the cache is pickled (e.g., as part of the corpus snapshot), only its budget is kept.
+
+    :param max_size: the estimated memory in bytes that all cached trees may use together
+    """
+
+    # The memory used by a parsed lxml tree in relation to the size of its file. Measured on the commentary texts.
+    TREE_SIZE_FACTOR = 4
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._trees = OrderedDict()  # type: Dict[str, tuple]
+        self._lock = Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {'max_size': self.max_size}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(state['max_size'])
+
+    def __len__(self) -> int:
+        return len(self._trees)
+
+    def get(self, path: str, parse: Callable[[], etree._Element]) -> etree._Element:
+        """ Return the parsed tree of the file at path, calling parse if it is not in the cache
+
+        :param path: the path of the file
+        :param parse: callable that parses the file and returns the tree
+        :return: the parsed tree
+        """
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._trees.get(path)
+            if entry is not None and entry[0] == version:
+                self._trees.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+        self.misses += 1
+        tree = parse()
+        size = stat.st_size * self.TREE_SIZE_FACTOR
+        if size > self.max_size:
+            return tree
+        with self._lock:
+            old = self._trees.pop(path, None)
+            if old is not None:
+                self.size -= old[1]
+            self._trees[path] = (version, size, tree)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, old_size, _) = self._trees.popitem(last=False)
+                self.size -= old_size
+        return tree
+
+
+class LazyCapitainsResolver(XmlCapitainsLocalResolver):
+    """ A local resolver that does not read the texts of the corpus at startup and keeps the texts that are
+        requested in a bounded cache.
+
+        While the inventory is parsed, only the headers of the TEI documents are read to retrieve their citation
+        schemes. Afterwards, every text is parsed the first time it is requested and its tree is kept in a
+        ParsedTreeCache so that following requests for the same text do not parse it again.
+
+    :param resource: the corpus folders
+    :param cache_size: the estimated memory in bytes that the cached text trees may use
+    """
+
+    def __init__(self, resource, cache_size: int = 128 * 1024 * 1024, **kwargs):
+        self.trees = ParsedTreeCache(cache_size)
+        self._parsing_inventory = False
+        super(LazyCapitainsResolver, self).__init__(resource, **kwargs)
+
+    def parse(self, resource):
+        self._parsing_inventory = True
+        try:
+            return super(LazyCapitainsResolver, self).parse(resource)
+        finally:
+            self._parsing_inventory = False
+
+    def xmlparse(self, file):
+        """ Parse an XML file. While the inventory is parsed, only the TEI header is read. Otherwise the parsed tree
+            is taken from the cache if possible.
+
+        :param file: Opened File
+        :return: Tree
+        """
+        if self._parsing_inventory:
+            return parse_header(file)
+        return self.trees.get(file.name, lambda: super(LazyCapitainsResolver, self).xmlparse(file))
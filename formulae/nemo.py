@@ -1,24 +1,57 @@
-from flask import url_for, Markup, g, session, flash, request, abort, send_from_directory
+from flask import url_for, Markup, g, session, flash, request, abort, send_from_directory, \
+    copy_current_request_context, has_request_context
 from flask_login import current_user, login_required
 from flask_babel import _, refresh, get_locale
 from flask_babel import lazy_gettext as _l
 from werkzeug.utils import redirect
+from itsdangerous import URLSafeTimedSerializer, TimestampSigner, BadSignature
 from flask_nemo import Nemo, filters
 from rdflib.namespace import DCTERMS, DC, Namespace
 from MyCapytain.common.constants import Mimetypes
 from MyCapytain.resources.collections.capitains import XmlCapitainsReadableMetadata, XmlCapitainsCollectionMetadata
 from MyCapytain.errors import UnknownCollection
 from formulae.search.forms import SearchForm
+from formulae.search.snippets import decode_result_code
 from lxml import etree
-from typing import List, Tuple, Union, Match, Dict, Any, Sequence, Callable
+from typing import List, Tuple, Union, Match, Dict, Any, Sequence, Callable, Optional
 from .errors.handlers import e_internal_error, e_not_found_error, e_unknown_collection_error
+import os
 import re
 from datetime import date
 from urllib.parse import quote
 from string import punctuation
-from .models import NtComRels
+from sys import intern
+from .commentary_index import NtCommentaryIndex
 from operator import itemgetter
-from json import load as json_load, JSONDecodeError
+from json import dumps, load as json_load, JSONDecodeError
+from .stylesheets import StylesheetRegistry
+from .passage_cache import PassageCache, content_hash
+from .passage_tables import PassageTable, merge_json, table_path, write_table
+from .corpus_snapshot import StartupTimer, file_fingerprint
+from .reffs_index import ReffsIndex
+from .rendering import PassagePipeline, index_words, add_word_spacing, mark_cited_words, highlight_sentences, \
+    highlight_words, locate_words, locate_sentence, tei_words, serialize_tree, parse_tree, strip_word_numbers, \
+    PASSAGE_WORD, PUNCTUATION
+from functools import partial
+from hashlib import sha1
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+
+class PeriodSigner(TimestampSigner):
+    """ A TimestampSigner that signs with the start of the current period instead of the current second, so that a
+        value gets the same signature for the whole period
+
+    :param period: the length of the periods in seconds
+    """
+
+    def __init__(self, *args, period: int = 60, **kwargs):
+        super(PeriodSigner, self).__init__(*args, **kwargs)
+        self.period = period
+
+    def get_timestamp(self) -> int:
+        return int(time()) // self.period * self.period
 
 
 class NemoFormulae(Nemo):
@@ -30,6 +63,7 @@ class NemoFormulae(Nemo):
         ("/work/<objectId>", "r_work", ["GET"]),
         ("/text/<objectId>/references", "r_references", ["GET"]),
         ("/texts/<objectIds>/passage/<subreferences>", "r_multipassage", ["GET"]),
+        ("/fragment/texts/<objectIds>/passage/<subreferences>", "r_passage_fragment", ["GET"]),
         ("/add_collections/<objectIds>/<reffs>", "r_add_text_collections", ["GET"]),
         ("/add_collection/<objectId>/<objectIds>/<reffs>", "r_add_text_collection", ["GET"]),
         ("/add_text/<objectId>/<objectIds>/<reffs>", "r_add_text_work", ["GET"]),
@@ -70,6 +104,9 @@ class NemoFormulae(Nemo):
 
     OPEN_NOTES = []
 
+    # The prefix of the routes of the CTS API (see formulae.app)
+    API_PREFIX = '/api'
+
     LANGUAGE_MAPPING = {"lat": _l('Latein'), "deu": _l("Deutsch"), "fre": _l("Französisch"),
                         "eng": _l("Englisch"), "grc": _l("Griechisch"), "mul": _l("Verschiedene")}
 
@@ -79,8 +116,18 @@ class NemoFormulae(Nemo):
         if "pdf_folder" in kwargs:
             self.pdf_folder = kwargs["pdf_folder"]
             del kwargs["pdf_folder"]
+        self.snapshot = kwargs.pop("snapshot", None)
+        self.startup_timer = self.snapshot.timer if self.snapshot else StartupTimer()
         super(NemoFormulae, self).__init__(*args, **kwargs)
-        self.sub_colls = self.get_all_corpora()
+        with self.startup_timer.measure('compile_stylesheets'):
+            self.stylesheets = StylesheetRegistry(self._transform)
+            self.stylesheets.compile_all()
+        for name, stats in self.stylesheets.stats.items():
+            self.app.logger.info('Compiled {} ({}) in {:.3f}s'.format(name, stats['path'], stats['compile_time']))
+        snapshot_data = self.snapshot.data if self.snapshot else None
+        with self.startup_timer.measure('sub_colls'):
+            self.sub_colls = snapshot_data['sub_colls'] if snapshot_data else self.get_all_corpora()
+        self.reffs_indices = snapshot_data['reffs_indices'] if snapshot_data else dict()  # type: Dict[str, ReffsIndex]
         self.app.jinja_env.filters["remove_from_list"] = self.f_remove_from_list
         self.app.jinja_env.filters["join_list_values"] = self.f_join_list_values
         self.app.jinja_env.filters["replace_indexed_item"] = self.f_replace_indexed_item
@@ -88,11 +135,66 @@ class NemoFormulae(Nemo):
         self.app.register_error_handler(500, e_internal_error)
         self.app.before_request(self.before_request)
         self.app.after_request(self.after_request)
-        self.parallel_texts = self.load_external_json('TEXT_PARALLELS')
-        self.nt_commentary_sections = self.load_external_json('NT_COMMENTARY_SECTIONS')
+        with self.startup_timer.measure('external_json'):
+            self.parallel_texts = self.load_external_table('TEXT_PARALLELS')
+            self.parallel_titles = self.load_parallel_titles()
+            self.commentary_index = NtCommentaryIndex(
+                self.load_external_table('NT_COMMENTARY_SECTIONS', self.compile_nt_commentary_sections),
+                self.app.config['SQLALCHEMY_BINDS'].get('appmeta'))
+            # Loaded now so that no view waits for the table to be read
+            with self.app.app_context():
+                self.commentary_index.refresh()
+        # The versions are only built from the names, sizes and modification times of the files, so that a boot does
+        # not have to read the whole corpus and code
+        with self.startup_timer.measure('corpus_version'):
+            # The snapshot has already fingerprinted the corpus paths
+            corpus_hash = self.snapshot.fingerprint if self.snapshot else \
+                file_fingerprint(self.corpus_paths(self.app.config))
+            self.corpus_version = sha1((corpus_hash +
+                                        content_hash(sorted(self.stylesheets.paths.values()))).encode()).hexdigest()
+        with self.startup_timer.measure('app_version'):
+            self.app_version = self.app.config['APP_VERSION'] or \
+                file_fingerprint(self.app_paths(), extensions=('.py', '.html', '.css', '.js', '.mo'))
+        self.passage_cache = None
+        if self.app.config['PASSAGE_CACHE_MAX_SIZE']:
+            # The stored passages also depend on the code that renders them
+            self.passage_cache = PassageCache(self.app.config['CACHE_DIRECTORY'],
+                                              self.corpus_version + self.app_version,
+                                              self.app.config['PASSAGE_CACHE_MAX_SIZE'])
+        if self.snapshot and snapshot_data is None and self.app.config['CORPUS_SNAPSHOT_ON_BOOT']:
+            self.write_snapshot(with_reffs=False)
+        self.app.logger.info('Startup times: ' + self.startup_timer.report())
+
+    def app_paths(self) -> List[str]:
+        """ The folders of the files that the pages are built with besides the corpus and the stylesheets: the code,
+            the templates, the static assets and the translations
+        """
+        return [os.path.dirname(os.path.abspath(__file__)), os.path.join(self.app.root_path, 'translations'),
+                self.static_folder] + [directory for namespace, directory in self.__templates_namespaces__]
+
+    @staticmethod
+    def corpus_paths(config) -> List[str]:
+        """ The corpus folders and the JSON files whose contents are part of the corpus version"""
+        return config['CORPUS_FOLDERS'] + config['TEXT_PARALLELS'] + config['NT_COMMENTARY_SECTIONS']
+
+    def write_snapshot(self, with_reffs: bool = True):
+        """ Store the corpus metadata that is computed at startup in self.snapshot so that it can be loaded on the
+            next boot instead of being computed again
+
+        :param with_reffs: whether the reference index of every text should be stored. This requires parsing
+                           every text in the corpus.
+        """
+        if with_reffs:
+            with self.startup_timer.measure('reffs'):
+                for text in self.resolver.getMetadata().readableDescendants:
+                    self.get_reffs_index(str(text.id))
+        self.snapshot.save(self.resolver, sub_colls=self.sub_colls, reffs_indices=self.reffs_indices)
     
     def load_external_json(self, config_var: str) -> dict:
-        """ Ingests an existing JSON file that contains notes about specific manuscript transcriptions"""
+        """ Ingests the existing JSON files that contain notes about specific manuscript transcriptions. The files of
+            all corpus folders are merged.
+        """
+        merged = dict()
         for j in self.app.config[config_var]:
             with open(j) as f:
                 try:
@@ -100,7 +202,93 @@ class NemoFormulae(Nemo):
                 except JSONDecodeError:
                     self.app.logger.warning(j + ' is not a valid JSON file. Unable to load valid collected collections from it.')
                     continue
-        return json_dict
+            merge_json(merged, json_dict)
+        return merged
+
+    def load_external_table(self, config_var: str, compile_json: Callable[[dict], dict] = None,
+                            rebuild: bool = False) -> PassageTable:
+        """ Memory-map the compiled form of the JSON files in config_var, compiling them under CACHE_DIRECTORY first if
+            they have changed since they were last compiled
+
+        :param config_var: the name of the config variable with the paths of the JSON files
+        :param compile_json: a function that converts the merged JSON into {objectId: {subreference: value}}
+        :param rebuild: whether the table should be compiled even if it is up to date
+        :return: the table
+        """
+        path = table_path(self.app.config['CACHE_DIRECTORY'], config_var.lower(), self.app.config[config_var])
+        if rebuild or not os.path.isfile(path):
+            data = self.load_external_json(config_var)
+            write_table(path, compile_json(data) if compile_json else data)
+        return PassageTable(path)
+
+    def transform(self, work, xml, objectId, subreference=None):
+        """ Transform input according to the registered XSLT. Unlike the flask_nemo implementation, which re-reads and
+            re-compiles the XSL file on every call, this uses the stylesheet compiled once in self.stylesheets.
+
+        :param work: Work object containing metadata about the xml
+        :param xml: XML to transform
+        :type xml: etree._Element
+        :param objectId: Object Identifier
+        :type objectId: str
+        :param subreference: Subreference
+        :type subreference: str
+        :return: String representation of transformed resource
+        :rtype: str
+        """
+        name = str(objectId) if str(objectId) in self._transform else 'default'
+        if name in self.stylesheets:
+            return etree.tostring(self.stylesheets.get(name)(xml), encoding=str, method="html",
+                                  xml_declaration=None, pretty_print=False, with_tail=True, standalone=None)
+        return super(NemoFormulae, self).transform(work, xml, objectId, subreference=subreference)
+
+    def transform_tree(self, work, xml, objectId, subreference=None) -> etree._Element:
+        """ Transform input according to the registered XSLT but return the root element of the result instead of
+            its serialization so that further processing can be done on the tree
+
+        :param work: Work object containing metadata about the xml
+        :param xml: XML to transform
+        :type xml: etree._Element
+        :param objectId: Object Identifier
+        :type objectId: str
+        :param subreference: Subreference
+        :type subreference: str
+        :return: root element of the transformed resource
+        """
+        name = str(objectId) if str(objectId) in self._transform else 'default'
+        if name in self.stylesheets:
+            return self.stylesheets.get(name)(xml).getroot()
+        return etree.fromstring(self.transform(work, xml, objectId, subreference=subreference))
+
+    @property
+    def nt_commentary_sections(self) -> Dict[str, Dict[str, Dict[str, str]]]:
+        """ The word-level links from the NT to the commentaries, which are held by self.commentary_index"""
+        return self.commentary_index.sections
+
+    @nt_commentary_sections.setter
+    def nt_commentary_sections(self, sections: Dict[str, Dict[str, Dict[str, str]]]):
+        self.commentary_index.sections = sections
+
+    @staticmethod
+    def compile_nt_commentary_sections(sections: Dict[str, Dict[str, Dict[str, Dict[str, List[List[str]]]]]]) \
+            -> Dict[str, Dict[str, Dict[str, str]]]:
+        """ Converts the nested NT commentary sections JSON into one dictionary per verse that maps each linked word
+            number directly to its finished 'comm-passages' attribute value. Words without commentary passages are
+            dropped.
+
+        :param sections: {objectId: {chapter: {verse: {wordnum: [[commentary_id, subreference], ...]}}}}
+        :return: {objectId: {'chapter.verse': {wordnum: 'commentary_id;subreference%...'}}}
+        """
+        compiled = dict()
+        for objectId, chapters in sections.items():
+            verses = compiled[objectId] = dict()
+            for chapter, chapter_verses in chapters.items():
+                for verse, words in chapter_verses.items():
+                    # Many words are linked to the same commentary passages, so their values are interned
+                    linked = {w_num: intern('%'.join([';'.join(x) for x in comm_passages]))
+                              for w_num, comm_passages in words.items() if comm_passages}
+                    if linked:
+                        verses['{}.{}'.format(chapter, verse)] = linked
+        return compiled
 
     def get_all_corpora(self):
         """ A convenience function to return all sub-corpora in all collections
@@ -116,6 +304,47 @@ class NemoFormulae(Nemo):
             colls[member['id']] = members
         return colls
 
+    def get_reffs_index(self, objectId: str, document=None, text_metadata=None) -> ReffsIndex:
+        """ Return the reference index of a text, building it the first time it is requested
+
+        :param objectId: the identifier of the text
+        :param document: the parsed text, if it has already been retrieved
+        :param text_metadata: the metadata of the parsed text
+        :return: the index
+        """
+        objectId = str(objectId)
+        index = self.reffs_indices.get(objectId)
+        if index is None:
+            # If two threads build the same index at the same time, both results are identical
+            if document is None:
+                document, text_metadata = self.resolver.__getText__(objectId)
+            index = ReffsIndex.build(document, partial(self.chunk, text_metadata))
+            self.reffs_indices[objectId] = index
+        return index
+
+    def get_reffs(self, objectId, subreference=None, collection=None, export_collection=False):
+        """ Retrieve and transform a list of references. The references of whole texts are taken from their
+            reference index.
+
+        :param objectId: Collection Identifier
+        :type objectId: str
+        :param subreference: Subreference from which to retrieve children
+        :type subreference: str
+        :param collection: Collection object bearing metadata
+        :type collection: Collection
+        :param export_collection: Return collection metadata
+        :type export_collection: bool
+        :return: Returns either the list of references, or the text collection object with its references as tuple
+        :rtype: (Collection, [str]) or [str]
+        """
+        if subreference is not None:
+            return super(NemoFormulae, self).get_reffs(objectId, subreference=subreference, collection=collection,
+                                                       export_collection=export_collection)
+        reffs = list(self.get_reffs_index(objectId).chunks)
+        if export_collection is True:
+            return collection if collection is not None else self.get_collection(objectId), reffs
+        return reffs
+
     def check_project_team(self):
         """ A convenience function that checks if the current user is a part of the project team"""
         try:
@@ -191,17 +420,62 @@ class NemoFormulae(Nemo):
         refresh()
 
     def before_request(self):
-        g.search_form = SearchForm()
+        route = self.etag_route()
+        # The search form would put a CSRF token into the session of the fragments, which have to stay cookie-free
+        if route != 'r_passage_fragment':
+            g.search_form = SearchForm()
+        # A client that already has the current version of the response gets a 304 before anything is rendered.
+        # Only a tag that was sent with a 200 for this URL can match (see make_etag), so a URL that does not exist
+        # is never answered with a 304.
+        # Messages that are waiting to be flashed would be lost, so the page is rendered again when there are any.
+        g.etag = self.make_etag()
+        if g.etag and g.etag in request.if_none_match and \
+                (route == 'r_passage_fragment' or not session.get('_flashes')):
+            return self.app.response_class(status=304)
 
     def after_request(self, response):
-        """ Currently used only for the Cache-Control header
+        """ Sets the Cache-Control header and the ETag of the routes in ROUTE_MAX_AGE
             max_age calculates days, hours, minutes and seconds and adds them together.
             First number after '+' is the respective number for each value.
         """
-        response.cache_control.max_age = self.app.config['CACHE_MAX_AGE']
+        route = self.etag_route()
+        response.cache_control.max_age = self.app.config['ROUTE_MAX_AGE'][route] if route \
+            else self.app.config['CACHE_MAX_AGE']
         response.cache_control.public = True
+        if g.get('etag') and response.status_code in (200, 304):
+            response.set_etag(g.etag)
+            if route != 'r_passage_fragment':
+                response.vary.add('Cookie')
+        if g.get('esi'):
+            response.headers['Surrogate-Control'] = 'content="ESI/1.0"'
         return response
 
+    def etag_route(self) -> Optional[str]:
+        """ The name of the current route in ROUTE_MAX_AGE or None if its responses have no ETag"""
+        route = 'api' if request.path.startswith(self.API_PREFIX + '/') else (request.endpoint or '').split('.')[-1]
+        return route if route in self.app.config['ROUTE_MAX_AGE'] and request.method == 'GET' else None
+
+    def make_etag(self) -> Optional[str]:
+        """ A strong ETag for the response to the current request. The response only changes with the corpus and the
+            stylesheets (see self.corpus_version), the code, templates, assets and translations (see self.app_version),
+            the locale, the URL and the user, since the pages show whether and as whom someone is logged in. The
+            passage fragments are the same for all users. The tag is only sent with 200 and 304 responses, and it
+            includes the SECRET_KEY, so a client cannot compute it and can only have received it for this URL with
+            a 200.
+
+        :return: the ETag or None if the route is not in ROUTE_MAX_AGE
+        """
+        route = self.etag_route()
+        if route is None:
+            return None
+        parts = [self.app.config['SECRET_KEY'], self.corpus_version, self.app_version, route, self.get_locale(),
+                 request.path, sorted(request.args.items(multi=True)),
+                 None if route == 'r_passage_fragment' else current_user.get_id()]
+        if self.app.config['FRAGMENT_CACHING'] and route in ('r_multipassage', 'r_passage_fragment'):
+            # The pages include new fragment URLs and the old ones expire with each fragment_period
+            parts.append(int(time()) // self.fragment_period)
+        return sha1(dumps(parts).encode('utf-8')).hexdigest()
+
     def semantic(self, collection: Union[XmlCapitainsCollectionMetadata, XmlCapitainsReadableMetadata],
                  parent: XmlCapitainsCollectionMetadata = None) -> str:
         """ Generates a SEO friendly string for given collection
@@ -330,13 +604,8 @@ class NemoFormulae(Nemo):
         :rtype: [(str, list)]
         """
         collection = self.resolver.getMetadata(objectId)
-        reffs = self.resolver.getReffs(objectId)
-        r = list()
-        for reff in reffs:
-            try:
-                r.append((str(reff), [str(x) for x in self.resolver.getReffs(objectId, subreference=str(reff))]))
-            except:
-                r.append((str(reff), []))
+        index = self.get_reffs_index(objectId)
+        r = [(reff, index.children(reff)) for reff in index.levels[0]]
         return {
             "template": "main::sub_collection.html",
             "collections": {
@@ -421,11 +690,10 @@ class NemoFormulae(Nemo):
         :type objectId: str
         :return: Redirection to the first passage of given text
         """
-        collection, reffs = self.get_reffs(objectId=objectId, export_collection=True)
-        first, _ = reffs[0]
-        return str(first)
+        return self.get_reffs_index(objectId).first
 
-    def r_passage(self, objectId, subreference, lang=None):
+    def r_passage(self, objectId, subreference, lang=None, result_sents=None, cited_words=None, documents=None,
+                  result_words=None):
         """ Retrieve the text of the passage
 
         :param objectId: Collection identifier
@@ -434,6 +702,14 @@ class NemoFormulae(Nemo):
         :type lang: str
         :param subreference: Reference identifier
         :type subreference: str
+        :param result_sents: The converted sentences from elasticsearch results that should be highlighted
+        :type result_sents: [str]
+        :param cited_words: The word numbers that should be marked as cited
+        :type cited_words: range
+        :param documents: Parsed documents that can be shared between several calls (see get_document)
+        :type documents: {str: tuple}
+        :param result_words: The numbers of the first and last word of each of the result_sents in the document
+        :type result_words: [(int, int)]
         :return: Template, collections metadata and Markup object representing the text
         :rtype: {str: Any}
         """
@@ -445,57 +721,284 @@ class NemoFormulae(Nemo):
                 raise UnknownCollection('{}.{}'.format(collection.get_label(lang), subreference) + _l(' wurde nicht gefunden.'))
             objectId = editions[0].id
             collection = self.get_collection(objectId)
-        try:
-            text = self.get_passage(objectId=objectId, subreference=subreference)
-        except IndexError:
-            new_subref = self.get_reffs(objectId)[0][0]
-            text = self.get_passage(objectId=objectId, subreference=new_subref)
+        rendered = None
+        # The found sentences of search results are highlighted over the stored passage, so that all search results
+        # that link to the same passage share its cache entry
+        if self.passage_cache is not None:
+            cache_key = self.passage_cache.make_key(objectId, subreference, lang,
+                                                    list(cited_words) if cited_words else None)
+            rendered = self.passage_cache.get(cache_key)
+        if rendered is None:
+            rendered = self.render_passage(objectId, subreference, collection, lang=lang, cited_words=cited_words,
+                                           documents=documents)
+            if self.passage_cache is not None:
+                self.passage_cache.set(cache_key, rendered)
+        text_passage = self.highlight_passage(objectId, rendered, result_sents=result_sents,
+                                              result_words=result_words, documents=documents)
+        if rendered['subreference'] != subreference:
             flash('{}.{}'.format(collection.get_label(lang), subreference) + _l(' wurde nicht gefunden. Der ganze Text wird angezeigt.'))
-            subreference = new_subref
-        passage = self.transform(text, text.export(Mimetypes.PYTHON.ETREE), objectId)
-        passage = passage.replace('span><span', 'span> <span')
-        if 'cjhnt:nt' in objectId:
-            passage = self.nt_commentary_link(objectId, subreference, passage)
-        if 'notes' in self._transform:
-            notes = self.extract_notes(passage)
-        else:
-            notes = ''
-        prev, next = self.get_siblings(objectId, subreference, text)
-        text_parallels = list()
-        if objectId in self.parallel_texts and subreference in self.parallel_texts[objectId]:
-            for p in self.parallel_texts[objectId][subreference]:
-                text_parallels.append((p[0], p[1], ' '.join([str(self.get_collection(p[0]).metadata.get_single(DC.title, lang=lang)), p[1]])))
         # if current_user.project_team is False and str(text.get_creator(lang)) not in self.OPEN_COLLECTIONS:
         #     pdf_path = self.pdf_folder + objectId.split(':')[-1] + '.pdf'
         return {
             "template": "main::text.html",
             "objectId": objectId,
-            "subreference": subreference,
+            "subreference": rendered['subreference'],
             "collections": {
                 "current": {
                     "label": collection.get_label(lang),
                     "id": collection.id,
                     "model": str(collection.model),
                     "type": str(collection.type),
-                    "author": text.get_creator(lang),
-                    "title": text.get_title(lang),
-                    "description": text.get_description(lang),
+                    "author": rendered['author'],
+                    "title": rendered['title'],
+                    "description": rendered['description'],
                     "citation": collection.citation,
-                    "coins": self.make_coins(collection, text, subreference, lang=lang),
+                    "coins": rendered['coins'],
                     'lang': collection.lang,
-                    'parallels': text_parallels
+                    'parallels': rendered['parallels']
                 },
                 "parents": self.make_parents(collection, lang=lang)
             },
-            "text_passage": Markup(passage),
-            "notes": Markup(notes),
-            "prev": prev,
-            "next": next,
+            "text_passage": Markup(text_passage),
+            "notes": Markup(rendered['notes']),
+            "prev": rendered['prev'],
+            "next": rendered['next'],
             "open_regest": True,
             "show_notes": True,
             "date": "{:04}-{:02}-{:02}".format(date.today().year, date.today().month, date.today().day)
         }
 
+    def load_parallel_titles(self) -> Dict[str, List[Tuple[Optional[str], str]]]:
+        """ The titles of all texts that are parallels of a passage in all of their languages. They are resolved from
+            the inventory once when the parallels are loaded.
+
+        :return: {objectId: [(language, title)]}
+        """
+        titles = dict()
+        for parallels_by_ref in self.parallel_texts.values():
+            for parallels in parallels_by_ref.values():
+                for parallel_id, parallel_ref in parallels:
+                    if parallel_id not in titles:
+                        try:
+                            titles[parallel_id] = [(title.language, str(title)) for title in
+                                                   self.get_collection(parallel_id).metadata.get(DC.title)]
+                        except UnknownCollection:
+                            titles[parallel_id] = [(None, parallel_id)]
+        return titles
+
+    def parallel_title(self, objectId: str, lang: str = None) -> str:
+        """ The title of a parallel text in lang, chosen like Metadata.get_single does
+
+        :param objectId: the identifier of the parallel text
+        :param lang: the language of the title
+        :return: the title
+        """
+        titles = self.parallel_titles.get(objectId) or [(None, objectId)]
+        if lang is None:
+            return titles[0][1]
+        return next((title for language, title in titles if language == lang), titles[-1][1])
+
+    def get_parallels(self, objectId: str, subreference: str, lang: str = None) -> List[Tuple[str, str, str]]:
+        """ The parallel passages of a passage with their labels
+
+        :param objectId: the identifier of the text
+        :param subreference: the subreference of the passage
+        :param lang: the language of the labels
+        :return: (objectId, subreference, label) of each parallel passage
+        """
+        return [(parallel_id, ref, self.parallel_title(parallel_id, lang) + ' ' + ref)
+                for parallel_id, ref in self.parallel_texts.get(objectId, {}).get(subreference, [])]
+
+    def render_passage(self, objectId: str, subreference: str, collection: XmlCapitainsReadableMetadata,
+                       lang: str = None, cited_words: range = None,
+                       documents: Dict[str, tuple] = None) -> Dict[str, Any]:
+        """ Retrieve and render the passage and all of its passage-specific information. The result contains only
+            strings and lists so that it can be stored in the passage cache. The passage is kept as a tree with the
+            numbers of its words (see highlight_passage) together with the words themselves.
+
+        :param objectId: Edition identifier
+        :param subreference: Reference identifier. If it is not found in the text, the whole text is rendered.
+        :param collection: The metadata object of the edition
+        :param lang: Lang in which to express main data
+        :param cited_words: The word numbers that should be marked as cited
+        :param documents: If given, the passage is taken from the document of the text stored here (see get_document)
+        :return: the rendered passage and its metadata
+        """
+        if documents is None:
+            try:
+                text = self.get_passage(objectId=objectId, subreference=subreference)
+            except IndexError:
+                subreference = self.get_reffs_index(objectId).first
+                text = self.get_passage(objectId=objectId, subreference=subreference)
+        else:
+            document, text_metadata, index = self.get_document(objectId, documents)
+            try:
+                text = document.getTextualNode(subreference)
+            except IndexError:
+                subreference = index.first
+                text = document.getTextualNode(subreference)
+            text.set_metadata_from_collection(text_metadata)
+        prev, next = self.get_siblings(objectId, subreference, text)
+        tei = text.export(Mimetypes.PYTHON.ETREE)
+        words, elements = tei_words(tei)
+        for w, n in elements:
+            w.set(PASSAGE_WORD, str(n))
+        try:
+            pipeline = PassagePipeline(self.transform_tree(text, tei, objectId))
+        finally:
+            # The exported tree may be shared with the resolver
+            for w, n in elements:
+                del w.attrib[PASSAGE_WORD]
+        pipeline.add_stage(add_word_spacing)
+        if 'cjhnt:nt' in objectId:
+            pipeline.add_stage(partial(self.nt_commentary_link, objectId, subreference))
+        if 'notes' in self._transform:
+            pipeline.add_stage(self.extract_notes, name='notes')
+        if cited_words:
+            pipeline.add_stage(partial(mark_cited_words, word_range=cited_words))
+        passage = pipeline.run(serialize_tree)
+        text_parallels = self.get_parallels(objectId, subreference, lang=lang)
+        return {
+            'subreference': subreference,
+            'text_passage': passage,
+            'words': words,
+            'notes': pipeline.outputs.get('notes', ''),
+            'prev': str(prev) if prev else None,
+            'next': str(next) if next else None,
+            'author': str(text.get_creator(lang)),
+            'title': str(text.get_title(lang)),
+            'description': str(text.get_description(lang)),
+            'coins': self.make_coins(collection, text, subreference, lang=lang),
+            'parallels': text_parallels
+        }
+
+    def highlight_passage(self, objectId: str, rendered: Dict[str, Any], result_sents: List[str] = None,
+                          result_words: List[Optional[Tuple[int, int]]] = None,
+                          documents: Dict[str, tuple] = None) -> str:
+        """ The HTML of a passage from render_passage with the found sentences of the search results highlighted.
+            The words are highlighted by their position if it can be determined (see found_words), otherwise by
+            matching the sentences.
+
+        :param objectId: the identifier of the text
+        :param rendered: the rendered passage
+        :param result_sents: the converted sentences from elasticsearch results that should be highlighted
+        :param result_words: the numbers of the first and last word of each of the result_sents in the document
+            or None where they are not known
+        :param documents: the parsed documents that are shared between passages (see get_document)
+        :return: the serialized passage
+        """
+        pipeline = PassagePipeline(parse_tree(rendered['text_passage']))
+        if result_sents:
+            ranges = self.found_words(objectId, rendered['words'], result_sents, result_words, documents)
+            if ranges:
+                pipeline.add_stage(partial(highlight_words, ranges=ranges))
+            else:
+                pipeline.add_stage(partial(self.highlight_found_sents, sents=result_sents))
+        pipeline.add_stage(strip_word_numbers)
+        return pipeline.run()
+
+    def found_words(self, objectId: str, words: List[str], result_sents: List[str],
+                    result_words: Optional[List[Optional[Tuple[int, int]]]],
+                    documents: Dict[str, tuple] = None) -> List[Tuple[int, int]]:
+        """ The numbers of the first and last word in the passage of each of the result_sents that is found in it.
+            The positions that the search results pass on (only lemma searches know them) are numbered in the whole
+            document. They are used if the words there are the sentence, which needs the words of the document.
+            All other sentences, e.g., those of text searches or those in a text that was changed after it was
+            indexed, are looked for among the words of the passage.
+
+        :param objectId: the identifier of the text
+        :param words: the words of the passage (see tei_words)
+        :param result_sents: the converted sentences from elasticsearch results
+        :param result_words: the numbers of the first and last word of each of the result_sents in the document
+            or None where they are not known
+        :param documents: the parsed documents that are shared between passages (see get_document)
+        :return: the word numbers of the found sentences
+        """
+        if not result_words or len(result_words) != len(result_sents):
+            result_words = [None] * len(result_sents)
+        offset = None
+        if any(result_words):
+            document = self.get_document(objectId, documents if documents is not None else dict())[0]
+            document_words = tei_words(document.xml)[0]
+            offset = locate_words(words, document_words)
+        ranges = []
+        for sent, known in zip(result_sents, result_words):
+            if offset is not None and known and \
+                    [w for w in (PUNCTUATION.sub('', x) for x in document_words[known[0]:known[1] + 1]) if w] == \
+                    sent.split():
+                ranges.append((known[0] - offset, known[1] - offset))
+            else:
+                found = locate_sentence(sent, words)
+                if found:
+                    ranges.append(found)
+        return ranges
+
+    def get_document(self, objectId: str, documents: Dict[str, tuple]) -> tuple:
+        """ Parse the whole document of a text once so that several passages can be taken from it. The resolver
+            reads and parses the XML file again for every passage, reference list and sibling lookup.
+
+        :param objectId: the identifier of the text
+        :param documents: the dictionary in which the parsed documents are kept
+        :return: the parsed text, its metadata and its reference index
+        """
+        if objectId not in documents:
+            document, text_metadata = self.resolver.__getText__(objectId)
+            documents[objectId] = (document, text_metadata,
+                                   self.get_reffs_index(objectId, document=document, text_metadata=text_metadata))
+        return documents[objectId]
+
+    def get_siblings(self, objectId, subreference, passage):
+        """ Get the previous and next references of a passage from the reference index of its text. If subreference
+            is not one of the chunked references of the text, the siblings of the passage itself are used.
+
+        :param objectId: Id of the object
+        :param subreference: Subreference of the object
+        :param passage: Current Passage
+        :return: Previous and next references
+        :rtype: (str, str)
+        """
+        siblings = self.get_reffs_index(objectId).siblings(subreference)
+        return siblings if siblings is not None else passage.siblingsId
+
+    def get_passages(self, passages: List[Tuple[str, Union[str, None]]], lang: str = None,
+                     result_sents: List[str] = None,
+                     result_words: List[Optional[Tuple[int, int]]] = None) -> List[Dict[str, Any]]:
+        """ Retrieve and render several passages at once. The passages are grouped by text so that the document and
+            the references of each text are only loaded once. If PASSAGE_RENDER_THREADS is larger than 1, the texts
+            are rendered in parallel.
+
+        :param passages: (objectId, subreference) pairs. A subreference of None stands for the first passage of the text.
+        :param lang: Lang in which to express main data
+        :param result_sents: The converted sentences from elasticsearch results that should be highlighted
+        :param result_words: The numbers of the first and last word of each of the result_sents in the document
+        :return: the r_passage data for each of the passages in the same order as the pairs
+        """
+        groups = OrderedDict()
+        for i, (objectId, subreference) in enumerate(passages):
+            groups.setdefault(objectId, []).append((i, subreference))
+        results = [None] * len(passages)
+
+        def render_group(objectId, members):
+            documents = dict()
+            for i, subreference in members:
+                if subreference is None:
+                    subreference = self.get_document(objectId, documents)[2].first
+                results[i] = self.r_passage(objectId, subreference, lang=lang, result_sents=result_sents,
+                                            documents=documents, result_words=result_words)
+
+        workers = min(self.app.config['PASSAGE_RENDER_THREADS'], len(groups))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(copy_current_request_context(render_group) if has_request_context()
+                                           else render_group, objectId, members)
+                           for objectId, members in groups.items()]
+                for future in futures:
+                    future.result()
+        else:
+            for objectId, members in groups.items():
+                render_group(objectId, members)
+        return results
+
     @login_required
     def r_multipassage(self, objectIds, subreferences, lang=None, result_sents=''):
         """ Retrieve the text of the passage
@@ -511,49 +1014,134 @@ class NemoFormulae(Nemo):
         :return: Template, collections metadata and Markup object representing the text
         :rtype: {str: Any}
         """
+        # The edge cache is public, so the pages of the project team, which may show more, are rendered completely
+        if self.app.config['FRAGMENT_CACHING'] and not self.check_project_team():
+            return self.fragment_page(objectIds, subreferences)
+        passage_data = self.multipassage_data(objectIds, subreferences, lang=lang)
+        passage_data['template'] = 'main::multipassage.html'
+        if len(objectIds.split('+')) > len(passage_data['objects']):
+            flash(_('Mindestens ein Text, den Sie anzeigen möchten, ist nicht verfügbar.'))
+        return passage_data
+
+    def multipassage_data(self, objectIds: str, subreferences: str, lang: str = None) -> Dict[str, Any]:
+        """ The rendered passages of r_multipassage and r_passage_fragment and the other versions of their texts
+
+        :param objectIds: Collection identifiers separated by '+'
+        :param subreferences: Reference identifiers separated by '+'
+        :param lang: Lang in which to express main data
+        :return: the r_passage data of each passage in 'objects' and the other versions of each text in 'translation'
+        """
         ids = objectIds.split('+')
         translations = {}
         for i in ids:
             p = self.resolver.getMetadata(self.make_parents(self.resolver.getMetadata(i))[0]['id'])
             translations[i] = [v for k, v in p.readableDescendants.items() if k not in ids]
-        passage_data = {'template': 'main::multipassage.html', 'objects': [], "translation": translations}
+        passage_data = {'objects': [], "translation": translations}
         subrefers = subreferences.split('+')
-        result_sents = request.args.get('result_sents')
-        for i, id in enumerate(ids):
-            if subrefers[i] in ["all", 'first']:
-                subref = self.get_reffs(id)[0][0]
-            else:
-                subref = subrefers[i]
-            d = self.r_passage(id, subref, lang=lang)
-            del d['template']
+        # Links from the search results carry their sentences and their positions compactly encoded.
+        # Older links still use result_sents.
+        result_words = None
+        if request.args.get('sents'):
+            result_sents, result_words = decode_result_code(request.args['sents'])
+        else:
+            result_sents = request.args.get('result_sents')
             if result_sents:
-                d['text_passage'] = self.highlight_found_sents(d['text_passage'],
-                                                               self.convert_result_sents(result_sents))
+                result_sents = self.convert_result_sents(result_sents)
+        passages = [(id, None if subrefers[i] in ["all", 'first'] else subrefers[i]) for i, id in enumerate(ids)]
+        for d in self.get_passages(passages, lang=lang, result_sents=result_sents, result_words=result_words):
+            del d['template']
             passage_data['objects'].append(d)
-        if len(ids) > len(passage_data['objects']):
-            flash(_('Mindestens ein Text, den Sie anzeigen möchten, ist nicht verfügbar.'))
         return passage_data
 
-    def nt_commentary_link(self, objectId: str, subreference: str, passage:str):
+    @property
+    def fragment_period(self) -> int:
+        """ The number of seconds for which the same fragment URLs are given out. The URLs have to stay valid as long
+            as the page that includes them and the fragments themselves may be cached, and at least for a minute.
+        """
+        max_age = self.app.config['ROUTE_MAX_AGE']
+        return max(max_age['r_multipassage'], max_age['r_passage_fragment'], 60)
+
+    @property
+    def fragment_serializer(self) -> URLSafeTimedSerializer:
+        """ Signs the access to the fragments. A signature is the same during each fragment_period so that all pages
+            include the same fragment URLs, and it expires one to two periods after it was given out.
+        """
+        return URLSafeTimedSerializer(self.app.config['SECRET_KEY'], salt='passage-fragment', signer=PeriodSigner,
+                                      signer_kwargs={'period': self.fragment_period})
+
+    def fragment_page(self, objectIds: str, subreferences: str) -> Dict[str, Any]:
+        """ The passage page with FRAGMENT_CACHING for readers outside of the project team. Nothing is rendered here
+            but the page around the passages, which includes the passages and their notes as ESI fragments. The URLs
+            of the fragments carry the locale and are signed with the passages for the current fragment_period, so
+            the fragments are the same for every reader and the edge cache can keep them.
+
+        :param objectIds: Collection identifiers separated by '+'
+        :param subreferences: Reference identifiers separated by '+'
+        :return: Template, the identifiers of the passages and the URLs of the fragments
+        """
+        objects = []
+        for objectId, subreference in zip(objectIds.split('+'), subreferences.split('+')):
+            # Unknown texts are answered just like by the page that renders them
+            self.resolver.getMetadata(objectId)
+            objects.append({'objectId': objectId, 'subreference': subreference})
+        access = self.fragment_serializer.dumps([objectIds, subreferences])
+        args = {k: v for k, v in request.args.items() if k in ('sents', 'result_sents')}
+        fragment_urls = {part: url_for('InstanceNemo.r_passage_fragment', objectIds=objectIds,
+                                       subreferences=subreferences, part=part, locale=str(get_locale()),
+                                       access=access, **args)
+                         for part in ('passage', 'notes')}
+        g.esi = True
+        return {'template': 'main::multipassage.html', 'objects': objects, 'fragment_urls': fragment_urls}
+
+    def r_passage_fragment(self, objectIds, subreferences, lang=None):
+        """ The passages of a page of r_multipassage without the page around them or, with part=notes, their notes
+            (see FRAGMENT_CACHING). Access is checked with the signature that fragment_page put into the URL, so the
+            user does not have to be loaded. The fragments are what readers outside of the project team see.
+
+        :param objectIds: Collection identifiers separated by '+'
+        :type objectIds: str
+        :param subreferences: Reference identifiers separated by '+'
+        :type subreferences: str
+        :param lang: Lang in which to express main data
+        :type lang: str
+        :return: Template, collections metadata and Markup objects representing the texts
+        :rtype: {str: Any}
+        """
+        try:
+            signed = self.fragment_serializer.loads(request.args.get('access', ''), max_age=self.fragment_period)
+        except BadSignature:
+            # This includes signatures that have expired
+            abort(403)
+        if signed != [objectIds, subreferences]:
+            abort(403)
+        passage_data = self.multipassage_data(objectIds, subreferences, lang=lang)
+        passage_data['template'] = 'main::notes.html' if request.args.get('part') == 'notes' \
+            else 'main::passage_fragment.html'
+        passage_data['project_team'] = False
+        return passage_data
+
+    def nt_commentary_link(self, objectId: str, subreference: str, passage_xml: etree._Element):
         """ Mark up the NT passages with their links to the commentaries
+
+        :param objectId: the identifier of the NT text
+        :param subreference: the chapter.verse subreference of the passage
+        :param passage_xml: the root element of the transformed passage, which is changed in place
         """
-        sub_ref_parts = subreference.split('.')
-        passage_xml = etree.XML(passage)
-        if len(sub_ref_parts) == 2:
-            for w_num, comm_passages in self.nt_commentary_sections[objectId][sub_ref_parts[0]][sub_ref_parts[1]].items():
-                if comm_passages:
-                    xml_word = passage_xml.xpath('//span[@wordnum="{}"]'.format(w_num))[0]
-                    xml_word.set('class', xml_word.get('class') + ' commentary-word')
-                    xml_word.set('comm-passages', '%'.join([';'.join(x) for x in comm_passages]))
-                    # xml_word.set('data-content', '%'.join([';'.join(x) for x in comm_passages]))
-                    xml_word.set('data-container', 'body')
-                    xml_word.set('data-toggle', 'popover')
-                    xml_word.set('data-placement', 'bottom')
-                    xml_word.set('title', 'Passages related to this word')
-                    xml_word.set('data-trigger', 'focus')
-                    xml_word.set('tabindex', '0')
-        return Markup(etree.tostring(passage_xml, pretty_print=True, encoding=str))
-    
+        linked_words = self.nt_commentary_sections.get(objectId, {}).get(subreference)
+        if not linked_words:
+            return
+        for w_num, xml_word in index_words(passage_xml).items():
+            comm_passages = linked_words.get(w_num)
+            if comm_passages:
+                xml_word.set('class', xml_word.get('class') + ' commentary-word')
+                xml_word.set('comm-passages', comm_passages)
+                xml_word.set('data-container', 'body')
+                xml_word.set('data-toggle', 'popover')
+                xml_word.set('data-placement', 'bottom')
+                xml_word.set('title', 'Passages related to this word')
+                xml_word.set('data-trigger', 'focus')
+                xml_word.set('tabindex', '0')
+
     @login_required
     def r_commentary_view(self, objectIds, subreferences, lang=None, result_sents=''):
         """ Retrieve the appropriate NT passage as well as the commentary section(s) that go with it
@@ -569,24 +1157,22 @@ class NemoFormulae(Nemo):
         :return: Template, collections metadata and Markup object representing the text
         :rtype: {str: Any}
         """
-        def split_comms(com):
-            ident = ':'.join(com.split(':')[:-1]).replace('greekLit', 'cjhnt')
-            ref = com.split(':')[-1]
-            return {'id': ident, 'ref': ref}
-
-        comms = [split_comms(x.com) for x in NtComRels.query.filter_by(nt=objectIds + ':' + subreferences).all()]
-        passage_data = {'template': 'main::commentary_view.html', 'comm_sections': [], "nt": self.r_passage(objectIds,
-                                                                                                            subreferences,
-                                                                                                            lang=lang)}
-        for com in comms:
-            d = self.r_passage(com['id'], com['ref'], lang=lang)
+        comms = self.commentary_index.commentaries(objectIds, subreferences)
+        nt, *comm_sections = self.get_passages([(objectIds, subreferences)] + comms, lang=lang)
+        passage_data = {'template': 'main::commentary_view.html', 'comm_sections': [], "nt": nt}
+        for d in comm_sections:
             del d['template']
             passage_data['comm_sections'].append(d)
         return passage_data
     
     @login_required
     def r_get_snippet(self, objectId: str, subreference: str):
-        data = self.r_passage(objectId=objectId, subreference=subreference)
+        cited_words = None
+        if 'cjhnt:nt' in objectId and request.args.get('words', None):
+            cited_words = [int(x) for x in request.args.get('words').split('-')]
+            if len(cited_words) == 2:
+                cited_words = range(cited_words[0], cited_words[1] + 1)
+        data = self.r_passage(objectId=objectId, subreference=subreference, cited_words=cited_words)
         data['template'] = 'main::source_collapse.html'
         translation_id = re.sub(r'grc(?=\d+)', 'eng', objectId)
         if translation_id != objectId:
@@ -599,15 +1185,6 @@ class NemoFormulae(Nemo):
             data["translation_passage"] = ''
         if 'cjhnt:nt' in objectId:
             data['template'] = 'main::commentary_nt.html'
-            if request.args.get('words', None):
-                passage_xml = etree.XML(data['text_passage'])
-                word_range = [int(x) for x in request.args.get('words').split('-')]
-                if len(word_range) == 2:
-                    word_range = range(word_range[0], word_range[1] + 1)
-                for word in passage_xml.xpath('//span[@class="w"]'):
-                    if int(word.get('wordnum')) in word_range:
-                        word.set('class', word.get('class') + ' cited-word')
-                data['text_passage'] = Markup(etree.tostring(passage_xml, pretty_print=True, encoding=str))
         if request.args.get('source') == 'ntPassage':
             data['template'] = 'main::commentary_popover.html'
         return data
@@ -618,9 +1195,8 @@ class NemoFormulae(Nemo):
         """
         referring_text_refs = re.search(r'.*texts/(.*)/passage/([\d\w\.\-\+]+).*', request.referrer)
         passages = {'commentaries': [], 'ancient': [], 'template': 'main::commentary_popover.html'}
-        for urn_reference in objectIds.split('%'):
-            objectId, subreference = urn_reference.split(';')
-            data = self.r_passage(objectId=objectId, subreference=subreference)
+        urn_references = [tuple(urn_reference.split(';')) for urn_reference in objectIds.split('%')]
+        for (objectId, subreference), data in zip(urn_references, self.get_passages(urn_references)):
             passage_xml = etree.XML(data['text_passage'])
             if 'commentary' in objectId:
                 header = passage_xml.xpath('//*[@class="cjh-Überschrift-2" or @class="cjh-Überschrift-1"]/text()')[0]
@@ -645,33 +1221,14 @@ class NemoFormulae(Nemo):
         intermediate = intermediate.split('$')
         return [re.sub('[{}„“…]'.format(punctuation), '', x) for x in intermediate]
 
-    def highlight_found_sents(self, html, sents):
-        """ Adds "searched" to the classList of words in "sents" from elasticsearch results
+    def highlight_found_sents(self, root, sents):
+        """ Adds "searched" to the classList of words in "sents" from elasticsearch results and wraps the found
+            words in a <span class="searched"> element
 
-        :param html: the marked-up text to be searched
+        :param root: the root element of the passage to be searched, which is changed in place
         :param sents: list of the "sents" strings
-        :return: transformed html
-        """
-        root = etree.fromstring(html)
-        spans = root.xpath('//span[contains(@class, "w")]')
-        texts = [re.sub('[{}„“…]'.format(punctuation), '', re.sub(r'&[lg]t;', '', x.text)) for x in spans if re.sub('[{}„“…]'.format(punctuation), '', x.text) != '']
-        for sent in sents:
-            words = sent.split()
-            for i in range(len(spans)):
-                if words == texts[i:i + len(words)]:
-                    spans[i].set('class', spans[i].get('class') + ' searched-start')
-                    spans[i + len(words) - 1].set('class', spans[i + len(words) - 1].get('class') + ' searched-end')
-                    for span in spans[i:i + len(words)]:
-                        if span.getparent().index(span) == 0 and 'searched-start' not in span.get('class'):
-                            span.set('class', span.get('class') + ' searched-start')
-                        if span == span.getparent().findall('span')[-1] and 'searched-end' not in span.get('class'):
-                            span.set('class', span.get('class') + ' searched-end')
-                    break
-        xml_string = etree.tostring(root, encoding=str, method='html', xml_declaration=None, pretty_print=False,
-                                    with_tail=True, standalone=None)
-        span_pattern = re.compile(r'(<span class="w \w*\s?searched-start.*?searched-end".*?</span>)', re.DOTALL)
-        xml_string = re.sub(span_pattern, r'<span class="searched">\1</span>', xml_string)
-        return Markup(xml_string)
+        """
+        highlight_sentences(root, sents)
 
     def r_impressum(self):
         """ Impressum route function
@@ -681,17 +1238,14 @@ class NemoFormulae(Nemo):
         """
         return {"template": "main::impressum.html"}
 
-    def extract_notes(self, text):
+    def extract_notes(self, root):
         """ Constructs a dictionary that contains all notes with their ids. This will allow the notes to be
         rendered anywhere on the page and not only where they occur in the text.
 
-        :param text: the string to be transformed
+        :param root: the root element of the transformed passage
         :return: dict('note_id': 'note_content')
         """
-        with open(self._transform['notes']) as f:
-            xslt = etree.XSLT(etree.parse(f))
-
-        return str(xslt(etree.fromstring(text)))
+        return str(self.stylesheets.get('notes')(root))
 
     ''' I may add these back in later.
     def r_add_sub_elements(self, coll, objectIds, reffs, lang=None):
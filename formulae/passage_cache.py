@@ -0,0 +1,126 @@
+import os
+import sqlite3
+from hashlib import sha1
+from json import dumps, loads
+from threading import local
+from time import time
+from typing import Iterable, Iterator, Optional, Dict, Any
+
+
+def content_hash(paths: Iterable[str], extensions: Iterable[str] = ('.xml', '.xsl', '.json')) -> str:
+    """ Builds a hash over the contents of all files with the given extensions in paths. Paths can be single files
+        or folders, which are walked recursively in a stable order. The hash changes whenever any of the files is
+        added, removed or changed.
+
+    :param paths: the files and folders to include
+    :param extensions: only files with these extensions are hashed
+    :return: the hexadecimal digest
+    """
+    digest = sha1()
+    for file_path in list_files(paths, extensions):
+        digest.update(file_path.encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def list_files(paths: Iterable[str], extensions: Iterable[str] = ('.xml', '.xsl', '.json')) -> Iterator[str]:
+    """ Yields every file with one of the given extensions in paths. Paths can be single files, which are always
+        returned, or folders, which are walked recursively in a stable order. Paths that do not exist are skipped.
+
+    :param paths: the files and folders to include
+    :param extensions: only files with these extensions are returned from folders
+    """
+    extensions = tuple(extensions)
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+        else:
+            yield from sorted(os.path.join(root, f) for root, dirs, fs in os.walk(path) for f in fs
+                              if f.endswith(extensions))
+
+
+class PassageCache(object):
+    """ A disk-backed store for rendered passages that is shared by all workers using the same cache directory.
+        The entries live in an SQLite database so that several processes can read and write it safely.
+        Each entry is stored with the version (i.e., the content hash of the corpus and the XSL files) that
+        was current when it was rendered and entries from other versions are dropped when the cache is opened.
+        When the total size of the stored payloads exceeds max_size, the least recently used entries are removed.
+        The total is kept in a table of its own by triggers, so that it changes in the same transaction as the
+        entries and no write has to add up the sizes of all entries. The access times are only as exact as
+        ACCESS_INTERVAL.
+
+    :param directory: the folder in which the database is created
+    :param version: the current corpus and transform version
+    :param max_size: the maximum size of all stored payloads in bytes
+    """
+
+    FILE_NAME = 'passages.sqlite'
+    # The access time of an entry is only written again after this many seconds so that hits rarely need the write lock
+    ACCESS_INTERVAL = 60
+
+    def __init__(self, directory: str, version: str, max_size: int):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.version = version
+        self.max_size = max_size
+        self._local = local()
+        with self.connection as conn:
+            # Other workers may open the cache at the same time
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('CREATE TABLE IF NOT EXISTS passages (key TEXT PRIMARY KEY, version TEXT, value TEXT, '
+                         'size INTEGER, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS passages_accessed ON passages (accessed)')
+            conn.execute('CREATE TABLE IF NOT EXISTS total (size INTEGER)')
+            if conn.execute('SELECT size FROM total').fetchone() is None:
+                conn.execute('INSERT INTO total SELECT TOTAL(size) FROM passages')
+            conn.execute('CREATE TRIGGER IF NOT EXISTS passages_insert AFTER INSERT ON passages '
+                         'BEGIN UPDATE total SET size = size + NEW.size; END')
+            conn.execute('CREATE TRIGGER IF NOT EXISTS passages_delete AFTER DELETE ON passages '
+                         'BEGIN UPDATE total SET size = size - OLD.size; END')
+            conn.execute('DELETE FROM passages WHERE version != ?', (self.version,))
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ SQLite connections cannot be shared between threads, so every thread opens its own"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return sha1(dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """ Return the payload stored under key or None if there is none for the current version"""
+        with self.connection as conn:
+            row = conn.execute('SELECT value, accessed FROM passages WHERE key = ? AND version = ?',
+                               (key, self.version)).fetchone()
+            if row is None:
+                return None
+            now = time()
+            if now - row[1] > self.ACCESS_INTERVAL:
+                conn.execute('UPDATE passages SET accessed = ? WHERE key = ?', (now, key))
+        return loads(row[0])
+
+    def set(self, key: str, value: Dict[str, Any]):
+        """ Store value under key and evict the least recently used entries if the cache has grown too large"""
+        value = dumps(value)
+        with self.connection as conn:
+            # Rows that INSERT OR REPLACE removes would not fire the delete trigger
+            conn.execute('DELETE FROM passages WHERE key = ?', (key,))
+            conn.execute('INSERT INTO passages VALUES (?, ?, ?, ?, ?)', (key, self.version, value, len(value), time()))
+            total = conn.execute('SELECT size FROM total').fetchone()[0]
+            if total > self.max_size:
+                to_remove = total - self.max_size
+                keys = []
+                for old_key, size in conn.execute('SELECT key, size FROM passages ORDER BY accessed'):
+                    keys.append((old_key,))
+                    to_remove -= size
+                    if to_remove <= 0:
+                        break
+                conn.executemany('DELETE FROM passages WHERE key = ?', keys)
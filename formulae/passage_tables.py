@@ -0,0 +1,195 @@
+import mmap
+import os
+from array import array
+from collections.abc import Mapping
+from glob import glob
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from .corpus_snapshot import file_fingerprint
+
+MAGIC = b'CJHNTPT1'
+# The kinds of values: a list of (objectId, subreference) pairs or a mapping, e.g., from word numbers to strings
+PAIRS = 0
+MAPPING = 1
+
+Value = Union[List[Tuple[str, str]], Dict[str, str]]
+
+
+def merge_json(target: Dict[str, Any], source: Dict[str, Any]) -> Dict[str, Any]:
+    """ Merges the nested dictionaries of a JSON file into those of another one. Lists at the same place are joined
+        without repeating their items.
+
+    :param target: the dictionary that is changed
+    :param source: the dictionary that is merged into target
+    :return: target
+    """
+    for key, value in source.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_json(target[key], value)
+        elif isinstance(value, list) and isinstance(target.get(key), list):
+            target[key].extend(x for x in value if x not in target[key])
+        else:
+            target[key] = value
+    return target
+
+
+def table_path(directory: str, name: str, sources: Sequence[str]) -> str:
+    """ The path of the compiled table of the given source files, which changes when one of them changes"""
+    return os.path.join(directory, '{}.{}.bin'.format(name, file_fingerprint(sources, ('.json',))))
+
+
+def write_table(path: str, data: Dict[str, Dict[str, Value]]):
+    """ Compiles {objectId: {subreference: value}} into a PassageTable file. Every string is stored once in a table of
+        strings sorted by their UTF-8 encoding and everything else is an array of indices into that table: the sorted
+        (objectId, subreference) keys, the offsets of the value of each key and the string pairs of the values.
+        Files of the same table with another fingerprint are removed.
+
+    :param path: the path as returned by table_path
+    :param data: the values are either lists of string pairs or dictionaries of strings
+    """
+    kind = MAPPING if any(isinstance(v, dict) for refs in data.values() for v in refs.values()) else PAIRS
+    entries = []
+    strings = set()
+    for objectId, refs in data.items():
+        for subreference, value in refs.items():
+            pairs = [(str(a), str(b)) for a, b in (value.items() if kind == MAPPING else value)]
+            entries.append((objectId, subreference, pairs))
+            strings.update([objectId, subreference])
+            strings.update(x for pair in pairs for x in pair)
+    encoded = sorted(s.encode('utf-8') for s in strings)
+    ids = {s.decode('utf-8'): i for i, s in enumerate(encoded)}
+    string_offsets = array('I', [0])
+    for s in encoded:
+        string_offsets.append(string_offsets[-1] + len(s))
+    entries.sort(key=lambda x: (ids[x[0]], ids[x[1]]))
+    keys = array('I')
+    value_offsets = array('I', [0])
+    values = array('I')
+    for objectId, subreference, pairs in entries:
+        keys.extend([ids[objectId], ids[subreference]])
+        values.extend(ids[x] for pair in pairs for x in pair)
+        value_offsets.append(len(values))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        array('I', [kind, len(encoded), len(entries), len(values)]).tofile(f)
+        for ints in (string_offsets, keys, value_offsets, values):
+            ints.tofile(f)
+        f.write(b''.join(encoded))
+    os.replace(tmp_path, path)
+    prefix = os.path.basename(path).split('.')[0] + '.'
+    for old in glob(os.path.join(os.path.dirname(path), prefix + '*.bin')):
+        if old != path and os.path.basename(old).count('.') == 2:
+            os.remove(old)
+
+
+class PassageTable(Mapping):
+    """ A memory-mapped file written by write_table that is read like the dictionary it was compiled from:
+        table[objectId][subreference] is the value of a passage. Since the file is only mapped and nothing is copied
+        into Python objects, all workers share its pages through the page cache. Lookups are binary searches in the
+        sorted string table and key array.
+
+    :param path: the path of the file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a passage table'.format(path))
+        view = memoryview(self._mmap)
+        start = len(MAGIC) + 16
+        self.kind, n_strings, n_keys, n_values = view[len(MAGIC):start].cast('I')
+        sizes = [n_strings + 1, 2 * n_keys, n_keys + 1, n_values]
+        ints = view[start:start + 4 * sum(sizes)].cast('I')
+        self._string_offsets, self._keys, self._value_offsets, self._values = \
+            [ints[sum(sizes[:i]):sum(sizes[:i + 1])] for i in range(4)]
+        self._strings = view[start + 4 * sum(sizes):]
+        self._n_keys = n_keys
+
+    def string(self, i: int) -> str:
+        return str(self._strings[self._string_offsets[i]:self._string_offsets[i + 1]], 'utf-8')
+
+    def string_id(self, s: str) -> Optional[int]:
+        """ The index of a string in the string table or None if it is not in the table"""
+        encoded = s.encode('utf-8')
+        lo, hi = 0, len(self._string_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._strings[self._string_offsets[mid]:self._string_offsets[mid + 1]].tobytes() < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._string_offsets) - 1 and \
+                self._strings[self._string_offsets[lo]:self._string_offsets[lo + 1]].tobytes() == encoded:
+            return lo
+        return None
+
+    def key_range(self, text_id: int, lo: int = 0, hi: int = None, column: int = 0) -> Tuple[int, int]:
+        """ The first and the last index + 1 of the keys between lo and hi whose column is text_id"""
+        keys = self._keys
+        hi = self._n_keys if hi is None else hi
+        start, end = lo, hi
+        while start < end:
+            mid = (start + end) // 2
+            if keys[2 * mid + column] < text_id:
+                start = mid + 1
+            else:
+                end = mid
+        end = hi
+        first = start
+        while start < end:
+            mid = (start + end) // 2
+            if keys[2 * mid + column] <= text_id:
+                start = mid + 1
+            else:
+                end = mid
+        return first, start
+
+    def value(self, i: int) -> Value:
+        """ The value of the key with index i"""
+        ids = self._values[self._value_offsets[i]:self._value_offsets[i + 1]]
+        pairs = [(self.string(ids[j]), self.string(ids[j + 1])) for j in range(0, len(ids), 2)]
+        return dict(pairs) if self.kind == MAPPING else pairs
+
+    def __getitem__(self, objectId: str) -> 'TextEntries':
+        text_id = self.string_id(objectId)
+        if text_id is None:
+            raise KeyError(objectId)
+        lo, hi = self.key_range(text_id)
+        if lo == hi:
+            raise KeyError(objectId)
+        return TextEntries(self, lo, hi)
+
+    def __iter__(self) -> Iterator[str]:
+        i = 0
+        while i < self._n_keys:
+            yield self.string(self._keys[2 * i])
+            i = self.key_range(self._keys[2 * i], lo=i)[1]
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class TextEntries(Mapping):
+    """ The values of the passages of one text in a PassageTable, by subreference"""
+
+    def __init__(self, table: PassageTable, lo: int, hi: int):
+        self.table = table
+        self.lo = lo
+        self.hi = hi
+
+    def __getitem__(self, subreference: str) -> Value:
+        ref_id = self.table.string_id(subreference)
+        if ref_id is not None:
+            first, end = self.table.key_range(ref_id, self.lo, self.hi, column=1)
+            if first < end:
+                return self.table.value(first)
+        raise KeyError(subreference)
+
+    def __iter__(self) -> Iterator[str]:
+        return (self.table.string(self.table._keys[2 * i + 1]) for i in range(self.lo, self.hi))
+
+    def __len__(self) -> int:
+        return self.hi - self.lo
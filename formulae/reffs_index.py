@@ -0,0 +1,66 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class ReffsIndex(object):
+    """ The ordered references of a single text at every citation level together with the chunked references that
+        are used for reading. It is built with one walk over the citation tree per level so that the table of
+        contents, the first passage and the siblings of a passage can afterwards be looked up without retrieving
+        the references again.
+
+    :param levels: the references at each citation level, starting with the top level
+    :param chunks: the chunked references and their labels as returned by Nemo.chunk
+    """
+
+    def __init__(self, levels: List[List[str]], chunks: List[Tuple[str, str]]):
+        self.levels = tuple(tuple(level) for level in levels)
+        self.chunks = tuple(tuple(chunk) for chunk in chunks)
+        self._chunk_positions = {reff: i for i, (reff, _) in enumerate(self.chunks)}
+        # For every reference above the lowest level, the slice of its children in the next level
+        self._children = dict()  # type: Dict[str, Tuple[int, int]]
+        for level in self.levels[1:]:
+            for i, reff in enumerate(level):
+                parent = reff.rsplit('.', 1)[0]
+                start, _ = self._children.get(parent, (i, i))
+                self._children[parent] = (start, i + 1)
+        self._depths = {reff: depth for depth, level in enumerate(self.levels) for reff in level}
+
+    @classmethod
+    def build(cls, document, chunk: Callable[[Callable], List[Tuple[str, str]]]) -> 'ReffsIndex':
+        """ Build the index of a parsed text
+
+        :param document: the parsed text
+        :param chunk: callable that turns a reference getter into the chunked references of the text
+        :return: the index
+        """
+        levels = [[str(reff) for reff in document.getReffs(level=level)]
+                  for level in range(1, len(document.citation) + 1)]
+        chunks = chunk(lambda level: levels[min(level, len(levels)) - 1])
+        return cls(levels, chunks)
+
+    @property
+    def first(self) -> str:
+        """ The first chunked reference, i.e., the first passage shown when a text is opened"""
+        return self.chunks[0][0]
+
+    @property
+    def last(self) -> str:
+        return self.chunks[-1][0]
+
+    def children(self, reff: str) -> List[str]:
+        """ The references one level below reff"""
+        if reff not in self._children:
+            return []
+        start, end = self._children[reff]
+        return list(self.levels[self._depths[reff] + 1][start:end])
+
+    def siblings(self, reff: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """ The previous and next chunked references of reff
+
+        :param reff: the reference of the current passage
+        :return: previous and next references or None if reff is not one of the chunked references
+        """
+        index = self._chunk_positions.get(reff)
+        if index is None:
+            return None
+        return (self.chunks[index - 1][0] if index > 0 else None,
+                self.chunks[index + 1][0] if index < len(self.chunks) - 1 else None)
@@ -0,0 +1,349 @@
+from lxml import etree
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Sequence
+from bisect import bisect_left, bisect_right
+from collections import deque
+from string import punctuation
+from formulae.search.lemmas import word_spans
+import re
+
+
+PUNCTUATION = re.compile('[{}„“…]'.format(re.escape(punctuation)))
+ESCAPED_BRACKETS = re.compile(r'&[lg]t;')
+TEI_NS = {'tei': 'http://www.tei-c.org/ns/1.0'}
+TEI_W = '{http://www.tei-c.org/ns/1.0}w'
+# The attribute in which the XSLT passes on the number of a word in its passage (see tei_words)
+PASSAGE_WORD = 'passageword'
+
+
+class PassagePipeline(object):
+    """ Renders a transformed passage by running an ordered list of stages over a single lxml tree and serializing
+        the tree only once at the end. Each stage is a callable that receives the root element and changes it in place.
+        If a stage is registered with a name, its return value is kept in self.outputs under that name
+        (e.g., the extracted notes).
+
+    :param root: the root element of the transformed passage
+    """
+
+    def __init__(self, root: etree._Element):
+        self.root = root
+        self.stages = list()  # type: List[Tuple[Optional[str], Callable]]
+        self.outputs = dict()  # type: Dict[str, str]
+
+    def add_stage(self, stage: Callable, name: str = None) -> 'PassagePipeline':
+        """ Append a stage to the pipeline
+
+        :param stage: callable that accepts the root element of the passage
+        :param name: if given, the return value of the stage is stored in self.outputs[name]
+        :return: the pipeline itself so that calls can be chained
+        """
+        self.stages.append((name, stage))
+        return self
+
+    def run(self, serializer: Callable[[etree._Element], str] = None) -> str:
+        """ Run all stages in the order in which they were added
+
+        :param serializer: turns the tree into the returned string. The default is serialize.
+        :return: the serialized passage
+        """
+        for name, stage in self.stages:
+            result = stage(self.root)
+            if name is not None:
+                self.outputs[name] = result
+        return (serializer or serialize)(self.root)
+
+
+def serialize(root: etree._Element) -> str:
+    """ Serialize a passage tree to the HTML string that is sent to the templates"""
+    return etree.tostring(root, encoding=str, method='html', xml_declaration=None, pretty_print=False,
+                          with_tail=True, standalone=None)
+
+
+def serialize_tree(root: etree._Element) -> str:
+    """ Serialize a passage tree as XML so that parse_tree returns the same tree. The HTML parser would move
+        the block elements in paragraphs, e.g., the page breaks, out of them.
+    """
+    return etree.tostring(root, encoding=str)
+
+
+def parse_tree(xml: str) -> etree._Element:
+    """ The passage tree that was serialized with serialize_tree"""
+    return etree.fromstring(xml)
+
+
+def add_word_spacing(root: etree._Element):
+    """ The XSLT places word spans directly next to each other. This inserts a space between adjacent spans.
+        It is the in-tree equivalent of replacing 'span><span' with 'span> <span' in the serialized passage.
+    """
+    for span in root.iter('span'):
+        if not span.text and not span.attrib and len(span) and span[0].tag == 'span':
+            span.text = ' '
+        if not span.tail:
+            sibling = span.getnext()
+            if sibling is not None and sibling.tag == 'span':
+                span.tail = ' '
+
+
+def index_words(root: etree._Element) -> Dict[str, etree._Element]:
+    """ Maps the word number of every numbered word in the passage to its span in a single walk over the tree.
+        If a word number occurs more than once, the first span is used.
+    """
+    index = dict()
+    for span in root.iter('span'):
+        w_num = span.get('wordnum')
+        if w_num is not None and w_num not in index:
+            index[w_num] = span
+    return index
+
+
+def add_class(element: etree._Element, cls: str):
+    """ Append cls to the class attribute of element"""
+    element.set('class', element.get('class') + ' ' + cls if element.get('class') else cls)
+
+
+def mark_cited_words(root: etree._Element, word_range: range):
+    """ Adds 'cited-word' to the classList of every word whose word number is in word_range
+
+    :param root: the root element of the passage
+    :param word_range: the word numbers to mark
+    """
+    for word in root.iter('span'):
+        if 'w' in word.get('class', '').split() and word.get('wordnum') and int(word.get('wordnum')) in word_range:
+            add_class(word, 'cited-word')
+
+
+def wrap_searched(root: etree._Element):
+    """ Wraps every run of sibling word spans from a 'searched-start' span to the next 'searched-end' span in a
+        <span class="searched"> element
+    """
+    for start in [x for x in root.iter('span') if 'searched-start' in x.get('class', '').split()]:
+        # The start of a run that overlaps an earlier one has already been wrapped with it
+        if any('searched' in x.get('class', '').split() for x in start.iterancestors('span')):
+            continue
+        parent = start.getparent()
+        run = [start]
+        if 'searched-end' not in start.get('class').split():
+            for sibling in start.itersiblings():
+                run.append(sibling)
+                if sibling.tag == 'span' and 'searched-end' in sibling.get('class', '').split():
+                    break
+        wrapper = etree.Element('span', {'class': 'searched'})
+        parent.insert(parent.index(start), wrapper)
+        wrapper.tail = run[-1].tail
+        run[-1].tail = None
+        for span in run:
+            wrapper.append(span)
+
+
+def normalize_token(text: str) -> str:
+    """ Removes escaped angle brackets and punctuation from a word so that it can be compared to the search results"""
+    if '&' in text:
+        text = ESCAPED_BRACKETS.sub('', text)
+    return PUNCTUATION.sub('', text)
+
+
+def find_sentences(tokens: Sequence[str], sentences: Sequence[Sequence[str]]) -> List[Optional[int]]:
+    """ Finds the first occurrence of every sentence in tokens in a single pass using an Aho-Corasick automaton
+        whose alphabet is the set of words in the sentences
+
+    :param tokens: the normalized words of the passage
+    :param sentences: the sentences to look for, each one a sequence of normalized words
+    :return: for each sentence the index of the token at which its first occurrence starts or None if it was not found
+    """
+    goto = [dict()]  # type: List[Dict[str, int]]
+    fail = [0]
+    matches = [[]]  # type: List[List[int]]
+    for n, words in enumerate(sentences):
+        if not words:
+            continue
+        node = 0
+        for word in words:
+            if word not in goto[node]:
+                goto[node][word] = len(goto)
+                goto.append(dict())
+                fail.append(0)
+                matches.append([])
+            node = goto[node][word]
+        matches[node].append(n)
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for word, child in goto[node].items():
+            queue.append(child)
+            f = fail[node]
+            while f and word not in goto[f]:
+                f = fail[f]
+            fail[child] = goto[f].get(word, 0)
+            matches[child] = matches[child] + matches[fail[child]]
+    starts = [None] * len(sentences)  # type: List[Optional[int]]
+    remaining = len(set(n for m in matches for n in m))
+    node = 0
+    for i, token in enumerate(tokens):
+        while node and token not in goto[node]:
+            node = fail[node]
+        node = goto[node].get(token, 0)
+        for n in matches[node]:
+            if starts[n] is None:
+                starts[n] = i - len(sentences[n]) + 1
+                remaining -= 1
+        if remaining == 0:
+            break
+    return starts
+
+
+def highlight_sentences(root: etree._Element, sents: Sequence[str]):
+    """ Adds 'searched-start' and 'searched-end' to the classList of the first and last words of the first
+        occurrence of each sentence in the passage and wraps the found words in <span class="searched"> elements.
+        Since the highlighting may not cross the boundaries of the parent element of a word, the first and last word
+        spans of each parent within the found words are also marked as start and end.
+
+    :param root: the root element of the passage, which is changed in place
+    :param sents: the sentences, with their words separated by whitespace and punctuation already removed
+    """
+    words = list()
+    tokens = list()
+    for span in root.iter('span'):
+        if 'w' in span.get('class', '').split():
+            token = normalize_token(''.join(span.itertext()))
+            if token:
+                words.append(span)
+                tokens.append(token)
+    sentences = [sent.split() for sent in sents]
+    mark_searched(words, [(start, start + len(sentence) - 1)
+                          for start, sentence in zip(find_sentences(tokens, sentences), sentences) if start is not None])
+    wrap_searched(root)
+
+
+def merge_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """ Merges overlapping (first, last) ranges of word indices so that no word is highlighted twice"""
+    merged = []  # type: List[List[int]]
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return [(first, last) for first, last in merged]
+
+
+def mark_searched(words: Sequence[etree._Element], ranges: Iterable[Tuple[int, int]]):
+    """ Adds 'searched-start' and 'searched-end' to the first and last word spans of each range, after merging
+        the ranges that overlap, and to the first and last word spans of each parent element within a range
+
+    :param words: the word spans of the passage in reading order
+    :param ranges: the indices in words of the first and last word of each found sentence
+    """
+    last_spans = dict()
+    for first, last in merge_ranges(ranges):
+        found = words[first:last + 1]
+        add_class_once(found[0], 'searched-start')
+        add_class_once(found[-1], 'searched-end')
+        for span in found:
+            parent = span.getparent()
+            if span.getprevious() is None:
+                add_class_once(span, 'searched-start')
+            if parent not in last_spans:
+                last_spans[parent] = parent.findall('span')[-1]
+            if span == last_spans[parent]:
+                add_class_once(span, 'searched-end')
+
+
+def add_class_once(element: etree._Element, cls: str):
+    """ Append cls to the class attribute of element if it is not already there"""
+    if cls not in element.get('class', '').split():
+        add_class(element, cls)
+
+
+def tei_words(root: etree._Element) -> Tuple[List[str], List[Tuple[etree._Element, int]]]:
+    """ The words of the body of a TEI document or passage outside of its notes, numbered the same way as the words of
+        the text that is indexed for the search (see lemmas.word_spans), and the number of the word in which each <w>
+        element outside of the notes starts
+
+    :param root: the root element of the TEI document or passage
+    :return: the words and the (element, word number) pairs in reading order
+    """
+    body = root.find('.//tei:body', TEI_NS)
+    nodes = (body if body is not None else root).xpath('.//text()[not(ancestor::tei:note)]', namespaces=TEI_NS)
+    text = ''.join(nodes)
+    spans = word_spans(text)
+    starts = [start for start, end in spans]
+    ends = [end for start, end in spans]
+    elements = []
+    # The text nodes of an element follow each other. The elements are compared by identity because the exported
+    # passages are objectified and their elements compare equal if they contain the same word.
+    current = None
+    position = 0
+    for node in nodes:
+        owner = node.getparent() if node.is_text else node.getparent().getparent()
+        w = owner if owner.tag == TEI_W else next(owner.iterancestors(TEI_W), None)
+        if w is not None and w is not current and node.strip():
+            current = w
+            char = position + len(node) - len(node.lstrip())
+            n = bisect_right(ends, char)
+            # The word is only the one in which the element starts if no whitespace lies in between
+            if n < len(spans) and not any(c.isspace() for c in text[char:starts[n]]):
+                elements.append((w, n))
+        position += len(node)
+    return [text[start:end] for start, end in spans], elements
+
+
+def find_words(needle: Sequence[str], words: Sequence[str]) -> Optional[int]:
+    """ The index of the first occurrence of the sequence needle in words or None if it does not occur"""
+    if not needle:
+        return None
+    haystack = ' ' + ' '.join(words) + ' '
+    found = haystack.find(' ' + ' '.join(needle) + ' ')
+    return haystack.count(' ', 0, found + 1) - 1 if found != -1 else None
+
+
+def locate_words(words: Sequence[str], document_words: Sequence[str]) -> Optional[int]:
+    """ The number of the document word at which the words of a passage begin. If the whole sequence is not found,
+        e.g., because the first or last word of the passage is only part of a word of the document, the sequence
+        without them is looked for.
+
+    :param words: the words of the passage
+    :param document_words: the words of the whole document
+    :return: the number of the first word of the passage in the document or None if it was not found
+    """
+    for shift, needle in ((0, words), (1, words[1:-1])):
+        found = find_words(needle, document_words)
+        if found is not None:
+            return found - shift
+    return None
+
+
+def locate_sentence(sentence: str, words: Sequence[str]) -> Optional[Tuple[int, int]]:
+    """ The numbers of the first and last word of the first occurrence of a found sentence in a passage
+
+    :param sentence: the words of the sentence separated by single spaces and without punctuation (see result_sents)
+    :param words: the words of the passage (see tei_words)
+    :return: the numbers of the first and last word of the sentence or None if it does not occur
+    """
+    needle = sentence.split()
+    numbers = []
+    normalized = []
+    for n, word in enumerate(words):
+        word = PUNCTUATION.sub('', word)
+        if word:
+            numbers.append(n)
+            normalized.append(word)
+    found = find_words(needle, normalized)
+    return (numbers[found], numbers[found + len(needle) - 1]) if found is not None else None
+
+
+def highlight_words(root: etree._Element, ranges: Iterable[Tuple[int, int]]):
+    """ Highlights the words by their number in the passage, which the XSLT copies into the PASSAGE_WORD attribute of
+        their spans. Otherwise like highlight_sentences.
+
+    :param root: the root element of the passage, which is changed in place
+    :param ranges: the numbers of the first and last word of each found sentence in the passage
+    """
+    words = [span for span in root.iter('span') if span.get(PASSAGE_WORD) is not None]
+    numbers = [int(span.get(PASSAGE_WORD)) for span in words]
+    mark_searched(words, [(bisect_left(numbers, first), bisect_right(numbers, last) - 1) for first, last in ranges
+                          if bisect_left(numbers, first) < bisect_right(numbers, last)])
+    wrap_searched(root)
+
+
+def strip_word_numbers(root: etree._Element):
+    """ Removes the PASSAGE_WORD attributes, which are only needed for highlighting, before the passage is shown"""
+    for span in root.iter('span'):
+        span.attrib.pop(PASSAGE_WORD, None)
@@ -1,9 +1,11 @@
-from flask import current_app, Markup, flash
+from flask import current_app, flash, has_request_context
 from flask_babel import _
+from elasticsearch import NotFoundError, ConnectionError, ConnectionTimeout
 # This import is only needed for capturing the ES request. I could perhaps comment it out when it is not needed.
 from tests.fake_es import FakeElasticsearch
-from string import punctuation
-import re
+from .lemmas import find_lemma_matches, lemma_snippet
+from .lemmas import word_spans
+from .snippets import build_snippets, plain_sentence, snippet_window, encode_result_sents, words_in_span
 
 
 PRE_TAGS = "</small><strong>"
@@ -11,6 +13,14 @@ POST_TAGS = "</strong><small>"
 AGGREGATIONS = {'corpus': {'filters': {'filters': {'NT': {'match': {'_type': 'nt'}},
                                                    'Philo': {'match': {'_type': 'tlg0018'}},
                                                    'LXX': {'match': {'_type': 'tlg0527'}}}}}}
+# Only the fields of _source that are shown in the results are requested. The text and lemmas of a document are only
+# needed to build the snippets of lemma searches since ES cannot highlight the text field for them.
+SOURCE_FIELDS = ['title', 'urn', 'date_string', 'orig_comp_ort']
+LEMMA_SOURCE_FIELDS = SOURCE_FIELDS + ['text', 'lemmas', 'lemma_offsets']
+# The maximum number of hits Elasticsearch returns for a single request (its default max_result_window)
+MAX_RESULT_WINDOW = 10000
+# What a search returns when Elasticsearch could not answer it in time
+EMPTY_RESPONSE = {'hits': {'total': 0, 'hits': []}, 'aggregations': {'corpus': {'buckets': {}}}}
 
 
 def build_sort_list(sort_str):
@@ -20,6 +30,167 @@ def build_sort_list(sort_str):
         return [{'urn': {'order': 'desc'}}]
 
 
+def search_index(index, body, prefetch=True):
+    """ Send a search to Elasticsearch unless the same search has already been answered and is in the search cache.
+        The aggregations only depend on the query and not on the page or the sort order, so they are also cached
+        separately and are not requested again for the other pages of the same query.
+
+        If Elasticsearch does not answer within ELASTICSEARCH_TIMEOUT, an empty result is returned and the user is
+        told to try again. Otherwise the following pages are prefetched in the background if this is configured.
+
+    :param index: the index or list of indices to search
+    :param body: the request body
+    :param prefetch: whether the following pages of the results should be prefetched
+    :return: the Elasticsearch response
+    """
+    try:
+        response = _search_index(index, body)
+    except (ConnectionError, ConnectionTimeout) as e:
+        current_app.logger.warning('Elasticsearch did not answer a search: {}'.format(e))
+        if has_request_context():
+            flash(_('Die Suche konnte nicht rechtzeitig beantwortet werden. Bitte versuchen Sie es erneut.'))
+        return EMPTY_RESPONSE
+    if prefetch:
+        prefetch_pages(index, body, response)
+    return response
+
+
+def _search_index(index, body):
+    cache = current_app.search_cache
+    if cache is None:
+        return current_app.elasticsearch.search(index=index, doc_type="", body=body)
+    key = cache.make_key(index, body)
+    response = cache.get(key)
+    if response is None:
+        aggs_key = cache.make_key(index, {'query': body['query'], 'aggs': body['aggs']}) if 'aggs' in body else None
+        aggregations = cache.get(aggs_key) if aggs_key else None
+        if aggregations is None:
+            response = search_page(index, body)
+            if aggs_key:
+                cache.set(aggs_key, response['aggregations'])
+        else:
+            response = search_page(index, {k: v for k, v in body.items() if k != 'aggs'})
+            response = dict(response, aggregations=aggregations)
+        cache.set(key, response)
+    return response
+
+
+def search_many(searches):
+    """ Send several searches to Elasticsearch in a single msearch request. Searches whose responses are in the search
+        cache are not sent again and the new responses are added to it.
+
+    :param searches: the index or indices and the request body of each search
+    :return: the responses in the same order as the searches
+    """
+    cache = current_app.search_cache
+    keys = [cache.make_key(index, body) if cache else None for index, body in searches]
+    responses = [cache.get(key) if cache else None for key in keys]
+    missing = [n for n, response in enumerate(responses) if response is None]
+    if missing:
+        lines = []
+        for n in missing:
+            lines.extend([{'index': searches[n][0]}, searches[n][1]])
+        for n, response in zip(missing, current_app.elasticsearch.msearch(body=lines)['responses']):
+            responses[n] = response
+            if cache and 'error' not in response:
+                cache.set(keys[n], response)
+    return responses
+
+
+def prefetch_pages(index, body, response):
+    """ Retrieve the SEARCH_PREFETCH_PAGES pages after the current one in a background thread so that they are already
+        in the search cache when the user moves on. Pages that are read with search_after (see search_page) depend on
+        the cursor of the page before them and are retrieved one after the other. All other pages are sent together
+        in one msearch request.
+
+    :param index: the index or list of indices that were searched
+    :param body: the request body of the current page
+    :param response: the response for the current page
+    """
+    executor = current_app.search_executor
+    if executor is None or current_app.search_cache is None or 'from' not in body:
+        return
+    size = body.get('size', 10)
+    total = response['hits']['total']
+    total = total['value'] if isinstance(total, dict) else total
+    bodies = [dict(body, **{'from': body['from'] + n * size})
+              for n in range(1, current_app.config['SEARCH_PREFETCH_PAGES'] + 1) if body['from'] + n * size < total]
+    if bodies:
+        executor.submit(_prefetch, current_app._get_current_object(), index, bodies)
+
+
+def _prefetch(app, index, bodies):
+    with app.app_context():
+        try:
+            if bodies[0].get('sort'):
+                for body in bodies:
+                    search_index(index, body, prefetch=False)
+            else:
+                search_many([(index, body) for body in bodies])
+        except Exception:
+            app.logger.exception('Prefetching search results failed')
+
+
+def search_page(index, body):
+    """ Retrieve a page of results after the first one with search_after instead of from so that Elasticsearch does
+        not have to collect and skip all of the hits on the previous pages. The pages of a query are read from a point
+        in time. The sort values after which each page starts (the cursors) are kept in the search cache together
+        with the point in time, so the page numbers in the URLs can still be used. If the cursor of a page is not
+        known yet, e.g., when someone jumps to the last page, the hits up to that page are retrieved with only their
+        sort values and the cursors of all of the skipped pages are stored.
+
+    :param index: the index or list of indices to search
+    :param body: the request body with 'from' and 'size'
+    :return: the Elasticsearch response
+    """
+    cache = current_app.search_cache
+    size = body.get('size', 10)
+    page, offset = divmod(body.get('from', 0), size) if size else (0, 1)
+    if not page or offset or not body.get('sort') or cache is None:
+        return current_app.elasticsearch.search(index=index, doc_type="", body=body)
+    chain_key = cache.make_key(index, {'query': body['query'], 'sort': body['sort'], 'size': size})
+    chain = cache.get(chain_key) or {'pit': None, 'cursors': {}}
+    try:
+        response = _search_after(index, body, page, size, chain)
+    except NotFoundError:
+        # The point in time has expired. The cursors of its pages cannot be used with a new one.
+        chain = {'pit': None, 'cursors': {}}
+        response = _search_after(index, body, page, size, chain)
+    cache.set(chain_key, chain)
+    return response
+
+
+def _search_after(index, body, page, size, chain):
+    es = current_app.elasticsearch
+    keep_alive = current_app.config['SEARCH_PIT_KEEP_ALIVE']
+    if chain['pit'] is None:
+        chain['pit'] = es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+        chain['cursors'] = {}
+    known = max([p for p in chain['cursors'] if p <= page] or [0])
+    while known < page:
+        step = min(page - known, MAX_RESULT_WINDOW // size)
+        walk_body = {'query': body['query'], 'sort': body['sort'], 'size': step * size, '_source': False,
+                     'track_total_hits': False, 'pit': {'id': chain['pit'], 'keep_alive': keep_alive}}
+        if known:
+            walk_body['search_after'] = chain['cursors'][known]
+        hits = es.search(doc_type="", body=walk_body)['hits']['hits']
+        for n in range(1, len(hits) // size + 1):
+            chain['cursors'][known + n] = hits[n * size - 1]['sort']
+        if len(hits) < step * size:
+            break
+        known += step
+    if page not in chain['cursors']:
+        # The page is beyond the last hit
+        return es.search(index=index, doc_type="", body=body)
+    page_body = {k: v for k, v in body.items() if k != 'from'}
+    page_body.update({'search_after': chain['cursors'][page], 'pit': {'id': chain['pit'], 'keep_alive': keep_alive}})
+    response = es.search(doc_type="", body=page_body)
+    chain['pit'] = response.get('pit_id', chain['pit'])
+    if len(response['hits']['hits']) == size:
+        chain['cursors'][page + 1] = response['hits']['hits'][-1]['sort']
+    return response
+
+
 def query_index(index, field, query, page, per_page, sort='urn'):
     if not current_app.elasticsearch:
         return [], 0, {}
@@ -33,47 +204,38 @@ def query_index(index, field, query, page, per_page, sort='urn'):
             clauses.append({'span_multi': {'match': {'wildcard': {'text': term}}}})
         else:
             clauses.append({"span_term": {'text': term}})
-    search = current_app.elasticsearch.search(index=index, doc_type="",
-                                              body={'query': {'span_near':
-                                                                  {'clauses': clauses,
-                                                                   "slop": 0,
-                                                                   'in_order': True}
-                                                              },
-                                                    "sort": sort,
-                                                    'from': (page - 1) * per_page,
-                                                    'size': per_page,
-                                                    'highlight':
-                                                        {'fields': {field: {"fragment_size": 300}},
-                                                         'pre_tags': [PRE_TAGS],
-                                                         'post_tags': [POST_TAGS],
-                                                         'encoder': 'html'
-                                                         },
-                                                    'aggs': AGGREGATIONS
-                                                    }
-                                              )
-    ids = [{'id': hit['_id'], 'info': hit['_source'], 'sents': [Markup(highlight_segment(x, 30, 30, PRE_TAGS, POST_TAGS)) for x in hit['highlight'][field]]} for hit in search['hits']['hits']]
-    return ids, search['hits']['total'], search['aggregations']
+    search = search_index(index, {'query': {'span_near':
+                                                {'clauses': clauses,
+                                                 "slop": 0,
+                                                 'in_order': True}
+                                            },
+                                  "sort": sort,
+                                  'from': (page - 1) * per_page,
+                                  'size': per_page,
+                                  '_source': SOURCE_FIELDS,
+                                  'highlight':
+                                      {'fields': {field: {"fragment_size": 300}},
+                                       'pre_tags': [PRE_TAGS],
+                                       'post_tags': [POST_TAGS],
+                                       'encoder': 'html'
+                                       },
+                                  'aggs': AGGREGATIONS
+                                  })
+    return highlighted_hits(search['hits']['hits'], field), search['hits']['total'], search['aggregations']
 
 
-def suggest_word_search(word, **kwargs):
-    """ To enable search-as-you-type for the text search
+def highlighted_hits(hits, field):
+    """ The results of the hits of a search whose field was highlighted by Elasticsearch. The positions of the
+        snippets in the documents are not known here and are looked up when a result is opened (see
+        NemoFormulae.found_words), so the text of the documents does not have to be requested.
 
-    :return: sorted set of results
+    :param hits: the hits of the response
+    :param field: the highlighted field
+    :return: the id, the metadata, the snippets and the encoded result_sents of each hit
     """
-    results = []
-    kwargs['fragment_size'] = 1000
-    posts, total, aggs = advanced_query_index(q=word, **kwargs)
-    for post in posts:
-        for sent in post['sents']:
-            r = str(sent[sent.find('</small><strong>'):])
-            r = r.replace('</small><strong>', '').replace('</strong><small>', '')
-            results.append(re.sub(r'[{}]'.format(punctuation), '', r[:min(r.find(' ', len(word) + 30), len(r))]))
-            """ind = 0
-            while w in r[ind:]:
-                i = r.find(w, ind)
-                results.append(re.sub(r'[{}]'.format(punctuation), '', r[i:min(r.find(' ', i + len(word) + 30), len(r))]))
-                ind = r.find(w, ind) + 1"""
-    return sorted(list(set(results)))
+    snippets = build_snippets([hit['highlight'][field] for hit in hits], 30, 30, PRE_TAGS, POST_TAGS)
+    return [{'id': hit['_id'], 'info': hit['_source'], 'sents': sents, 'result_sents': result_sents,
+             'sents_code': encode_result_sents(result_sents)} for hit, (sents, result_sents) in zip(hits, snippets)]
 
 
 def highlight_segment(orig_str, chars_before, chars_after, pre_tag, post_tag):
@@ -87,14 +249,8 @@ def highlight_segment(orig_str, chars_before, chars_after, pre_tag, post_tag):
     :param post_tag: the tag(s) that mark the end of the highlighted section
     :return: the string to show in the search results
     """
-    init_index = 0
-    end_index = len(orig_str)
-    if orig_str.find(pre_tag) - chars_before > 0:
-        init_index = max(orig_str.rfind(' ', 0, orig_str.find(pre_tag) - chars_before), 0)
-    if orig_str.rfind(post_tag) + chars_after + len(post_tag) < len(orig_str):
-        end_index = min(orig_str.find(' ', orig_str.rfind(post_tag) + chars_after + len(post_tag)), len(orig_str))
-    if end_index == -1:
-        end_index = len(orig_str)
+    init_index, end_index = snippet_window(orig_str, orig_str.find(pre_tag), orig_str.rfind(post_tag), chars_before,
+                                           chars_after, len(post_tag))
     return orig_str[init_index:end_index]
 
 
@@ -105,6 +261,7 @@ def advanced_query_index(corpus=['all'], field="text", q='', page=1, per_page=10
     sort = build_sort_list(sort)
     body_template = {"query": {"bool": {"must": []}}, "sort": sort,
                      'from': (page - 1) * per_page, 'size': per_page,
+                     '_source': LEMMA_SOURCE_FIELDS if field == 'lemmas' and q else SOURCE_FIELDS,
                      'aggs': AGGREGATIONS
                      }
     if not current_app.elasticsearch:
@@ -135,39 +292,43 @@ def advanced_query_index(corpus=['all'], field="text", q='', page=1, per_page=10
                 clauses.append({'span_multi': {'match': {'fuzzy': {field: {"value": term, "fuzziness": fuzz}}}}})
         body_template['query']['bool']['must'].append({'span_near': {'clauses': clauses, 'slop': slop,
                                                                      'in_order': ordered_terms}})
-    search = current_app.elasticsearch.search(index=corpus, doc_type="", body=body_template)
+    search = search_index(corpus, body_template)
     if q:
         # The following lines transfer "highlighting" to the text field so that the user sees the text instead of
         # a series of lemmata. The problem is that there is no real highlighting since the text and lemmas fields don't
         # match up 1-to-1.
+        # If the document has been indexed with its lemma offsets (see lemmas.align_lemmas), the inflected forms of the
+        # found lemmas are highlighted exactly. Otherwise their position in the text is estimated.
         if field == 'lemmas':
             ids = []
+            query_words = q.split()
+            context = 15 if len(query_words) > 1 else 10
             for hit in search['hits']['hits']:
                 sentences = []
-                start = 0
+                result_words = []
                 lems = hit['_source']['lemmas'].split()
-                inflected = hit['_source']['text'].split()
+                offsets = hit['_source'].get('lemma_offsets')
+                inflected = hit['_source']['text'].split() if not offsets else []
+                spans = tuple(zip(*word_spans(hit['_source']['text']))) if offsets else None
                 ratio = len(inflected)/len(lems)
-                if ' ' in q:
-                    addend = 0 if ordered_terms else 1
-                    query_words = q.split()
-                    for i, w in enumerate(lems):
-                        if w == query_words[0] and set(query_words).issubset(lems[max(i - (int(slop) + addend), 0):min(i + (int(slop) + len(query_words)), len(lems))]):
-                            rounded = round(i * ratio)
-                            sentences.append(' '.join(inflected[max(rounded - 15, 0):min(rounded + 15, len(inflected))]))
-                else:
-                    while q in lems[start:]:
-                        i = lems.index(q, start)
-                        start = i + 1
+                for i, found in find_lemma_matches(lems, query_words, int(slop), ordered_terms):
+                    if offsets:
+                        first, last = max(i - context, 0), min(i + context - 1, len(offsets) // 2 - 1)
+                        sentences.append(lemma_snippet(hit['_source']['text'], offsets, found, first, last,
+                                                       PRE_TAGS, POST_TAGS))
+                        result_words.append(words_in_span(spans, offsets[2 * first], offsets[2 * last + 1]))
+                    else:
                         rounded = round(i * ratio)
-                        sentences.append(' '.join(inflected[max(rounded - 10, 0):min(rounded + 10, len(inflected))]))
-                ids.append({'id': hit['_id'], 'info': hit['_source'], 'sents': sentences})
+                        sentences.append(' '.join(inflected[max(rounded - context, 0):min(rounded + context, len(inflected))]))
+                        result_words.append(None)
+                result_sents = [plain_sentence(x, PRE_TAGS, POST_TAGS) for x in sentences]
+                ids.append({'id': hit['_id'], 'info': hit['_source'], 'sents': sentences, 'result_sents': result_sents,
+                            'sents_code': encode_result_sents(result_sents, result_words)})
         else:
-            ids = [{'id': hit['_id'],
-                    'info': hit['_source'],
-                    'sents': [Markup(highlight_segment(x, 30, 30, PRE_TAGS, POST_TAGS)) for x in hit['highlight'][field]]} for hit in search['hits']['hits']]
+            ids = highlighted_hits(search['hits']['hits'], field)
     else:
-        ids = [{'id': hit['_id'], 'info': hit['_source'], 'sents': []} for hit in search['hits']['hits']]
+        ids = [{'id': hit['_id'], 'info': hit['_source'], 'sents': [], 'result_sents': [], 'sents_code': None}
+               for hit in search['hits']['hits']]
     # It may be good to comment this block out when I am not saving requests, though it probably won't affect performance.
     if current_app.config["SAVE_REQUESTS"] and 'autocomplete' not in field:
         req_name = "{corpus}&{field}&{q}&{fuzz}&{in_order}&{slop}&{sort}".format(corpus='+'.join(corpus), field=field,
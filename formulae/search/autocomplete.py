@@ -0,0 +1,184 @@
+import os
+import pickle
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from heapq import nlargest
+from string import punctuation
+from threading import Lock
+from typing import Dict, Iterable, List, Tuple, Union
+from lxml import etree
+from formulae.corpus_snapshot import file_fingerprint
+from formulae.passage_cache import list_files
+from .local import fuzziness_limit, levenshtein
+
+
+TEI_W = '{http://www.tei-c.org/ns/1.0}w'
+# The autocomplete fields of the search form and where their vocabulary comes from in the TEI files
+FIELDS = {'autocomplete': 'form', 'autocomplete_lemmas': 'lemma'}
+
+
+def normalize(word: str) -> str:
+    """ The form of a word that is used to match it with what is typed"""
+    return word.strip(punctuation + '·’⸀⸁⸂⸃').lower()
+
+
+class Vocabulary(object):
+    """ The terms of one field in sorted order with the frequency of every term in each corpus. The terms that start
+        with a prefix are a contiguous slice of the sorted list, so they are found with two binary searches.
+
+    :param counts: for each corpus, how often each term occurs in it
+    """
+
+    def __init__(self, counts: Dict[str, Counter]):
+        totals = Counter()
+        for corpus_counts in counts.values():
+            totals.update(corpus_counts)
+        # The most frequent spelling of a term is the one that is suggested
+        forms = dict()
+        for term, count in totals.items():
+            key = normalize(term)
+            if key and (key not in forms or count > totals[forms[key]]):
+                forms[key] = term
+        self.keys = sorted(forms)
+        self.terms = [forms[k] for k in self.keys]
+        positions = {k: i for i, k in enumerate(self.keys)}
+        self.frequencies = dict()  # type: Dict[str, array]
+        for corpus, corpus_counts in counts.items():
+            frequencies = array('I', bytes(4 * len(self.keys)))
+            for term, count in corpus_counts.items():
+                key = normalize(term)
+                if key:
+                    frequencies[positions[key]] += count
+            self.frequencies[corpus] = frequencies
+
+    def prefix_range(self, prefix: str, start: int = 0) -> Tuple[int, int]:
+        """ The first and the last index + 1 of the terms that start with prefix"""
+        start = bisect_left(self.keys, prefix, start)
+        return start, bisect_left(self.keys, prefix + '\U0010ffff', start)
+
+    def fuzzy_ranges(self, prefix: str, limit: int) -> List[Tuple[int, int]]:
+        """ The ranges of the terms whose beginning is at most limit edits away from prefix. Since the terms are
+            sorted, those with the same beginning are contiguous and each beginning is compared only once.
+        """
+        ranges = []
+        i = 0
+        while i < len(self.keys):
+            start, end = self.prefix_range(self.keys[i][:len(prefix)], i)
+            if levenshtein(prefix, self.keys[i][:len(prefix)], limit) <= limit:
+                ranges.append((start, end))
+            i = end
+        return ranges
+
+    def complete(self, prefix: str, corpora: Iterable[str], size: int, fuzziness: Union[str, int] = 0) -> List[str]:
+        """ The most frequent terms in the given corpora that start with prefix
+
+        :param prefix: the beginning of the term
+        :param corpora: the corpora whose frequencies are counted. ['all'] means all of them.
+        :param size: the maximum number of terms
+        :param fuzziness: the number of edits by which the beginning of a term may differ from prefix or 'AUTO'
+        :return: the terms, the most frequent first
+        """
+        prefix = normalize(prefix)
+        corpora = list(self.frequencies) if 'all' in corpora else [c for c in corpora if c in self.frequencies]
+        if not prefix or not corpora:
+            return []
+        limit = fuzziness_limit(fuzziness, prefix)
+        ranges = self.fuzzy_ranges(prefix, limit) if limit else [self.prefix_range(prefix)]
+        tables = [self.frequencies[c] for c in corpora]
+        ranked = nlargest(size, ((sum(t[i] for t in tables), -i) for start, end in ranges for i in range(start, end)))
+        return [self.terms[-i] for freq, i in ranked if freq]
+
+
+class Autocompleter(object):
+    """ Completes the word that is being typed in the search box from the vocabulary of the corpus instead of sending
+        a search to Elasticsearch for every keystroke. The word forms and lemmas are read from the tei:w elements of
+        the texts when the vocabulary is first used. The vocabulary is stored under the cache directory and is reused
+        until the corpus files change, so the build-autocomplete manager command builds it once before a deploy and
+        the app only reads it.
+
+    :param corpus_folders: the folders that contain the texts
+    :param cache_directory: the folder in which the vocabulary is stored. None means it is not stored.
+    """
+
+    FILE_NAME = 'autocomplete.pickle'
+
+    def __init__(self, corpus_folders: List[str], cache_directory: str = None):
+        self.corpus_folders = corpus_folders
+        self.path = os.path.join(cache_directory, self.FILE_NAME) if cache_directory else None
+        self._vocabularies = None  # type: Dict[str, Vocabulary]
+        self._lock = Lock()
+
+    @staticmethod
+    def read_texts(paths: Iterable[str]) -> Dict[str, Dict[str, Counter]]:
+        """ Count the word forms and lemmas of each corpus. The corpus of a text is the first part of its file name,
+            e.g., nt for nt.86-Jud.grc001.xml.
+        """
+        counts = {attribute: defaultdict(Counter) for attribute in FIELDS.values()}
+        for file_path in list_files(paths, ('.xml',)):
+            name = os.path.basename(file_path)
+            if name == '__cts__.xml':
+                continue
+            corpus = name.split('.')[0]
+            for _, w in etree.iterparse(file_path, events=('end',), tag=TEI_W):
+                form = ''.join(w.itertext()).strip()
+                if form:
+                    counts['form'][corpus][form] += 1
+                if w.get('lemma'):
+                    counts['lemma'][corpus][w.get('lemma')] += 1
+                w.clear()
+        return counts
+
+    @property
+    def vocabularies(self) -> Dict[str, Vocabulary]:
+        if self._vocabularies is None:
+            self.load()
+        return self._vocabularies
+
+    def load(self, rebuild: bool = False) -> Dict[str, Vocabulary]:
+        """ Load the stored vocabulary or build it if it is missing or the corpus has changed
+
+        :param rebuild: whether the vocabulary should be built even if a current one is stored
+        """
+        with self._lock:
+            if self._vocabularies is None or rebuild:
+                self._vocabularies = self._read_or_build(rebuild)
+        return self._vocabularies
+
+    def _read_or_build(self, rebuild: bool) -> Dict[str, Vocabulary]:
+        fingerprint = file_fingerprint(self.corpus_folders, ('.xml',))
+        if self.path and not rebuild:
+            try:
+                with open(self.path, 'rb') as f:
+                    if pickle.load(f) == fingerprint:
+                        return pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+                pass
+        counts = self.read_texts(self.corpus_folders)
+        vocabularies = {field: Vocabulary(counts[attribute]) for field, attribute in FIELDS.items()}
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(fingerprint, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(vocabularies, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        return vocabularies
+
+    def complete(self, query: str, field: str = 'autocomplete', corpora: Iterable[str] = ('all',),
+                 size: int = 10, fuzziness: Union[str, int] = 0) -> List[str]:
+        """ The completions of the last word of query. The words before it are kept as they were typed.
+
+        :param query: what has been typed in the search box
+        :param field: 'autocomplete' to complete word forms or 'autocomplete_lemmas' to complete lemmas
+        :param corpora: the corpora the search is restricted to
+        :param size: the maximum number of completions
+        :param fuzziness: the fuzziness of the search, which is applied to the beginning of the last word
+        :return: the completed queries, the most frequent first
+        """
+        words = query.split()
+        if not words or query[-1].isspace() or field not in FIELDS:
+            return []
+        head = ' '.join(words[:-1])
+        return [' '.join([head, term]).strip() for term in
+                self.vocabularies[field].complete(words[-1], corpora, size, fuzziness=fuzziness)]
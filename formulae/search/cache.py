@@ -0,0 +1,128 @@
+import os
+import pickle
+import sqlite3
+from collections import OrderedDict
+from hashlib import sha1
+from json import dumps
+from threading import Lock, local
+from time import time
+from typing import Any, Dict, Optional, Union, List
+
+
+class SearchCache(object):
+    """ Keeps Elasticsearch responses so that repeated searches (e.g., paging back and forth through the results or
+        the requests of the autocomplete) do not have to be sent to Elasticsearch again. Since the corpus only changes
+        between deployments, a response is valid until its time to live has passed.
+
+        Responses are kept in a least recently used store in the memory of the worker. If a shared backend is given
+        (e.g., a SharedSearchStore or any other cache with the get(key) and set(key, value, timeout) methods of the
+        Flask-Caching backends), responses are also stored there so that all workers can use them.
+
+    :param max_entries: the maximum number of responses kept in memory
+    :param ttl: the number of seconds for which a response is used
+    :param shared: an optional cache backend shared by all workers
+    """
+
+    def __init__(self, max_entries: int, ttl: int, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()  # type: Dict[str, tuple]
+        self._lock = Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(index: Union[str, List[str]], body: Dict[str, Any]) -> str:
+        """ Build a key that is the same for all equivalent requests. The order of the indices and of the keys in the
+            body does not matter.
+
+        :param index: the index or list of indices that are searched
+        :param body: the request body
+        :return: the key
+        """
+        indices = sorted([index] if isinstance(index, str) else index)
+        return 'search:' + sha1(dumps([indices, body], sort_keys=True, separators=(',', ':'),
+                                      ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """ Return the response stored under key or None if there is none that is still valid"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+        if self.shared is not None:
+            response = self.shared.get(key)
+            if response is not None:
+                self.shared_hits += 1
+                self._store(key, response)
+                return response
+        self.misses += 1
+        return None
+
+    def set(self, key: str, response: Any):
+        """ Store a response in memory and in the shared backend"""
+        self._store(key, response)
+        if self.shared is not None:
+            self.shared.set(key, response, timeout=self.ttl)
+
+    def _store(self, key: str, response: Any):
+        with self._lock:
+            self._entries[key] = (time() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self._entries), 'hits': self.hits, 'shared_hits': self.shared_hits,
+                'misses': self.misses}
+
+
+class SharedSearchStore(object):
+    """ A search response store in an SQLite database that all workers using the same cache directory can read and
+        write. Expired responses are removed when new ones are stored. When there are more than max_entries responses,
+        those that expire first are removed.
+
+    :param directory: the folder in which the database is created
+    :param max_entries: the maximum number of stored responses
+    """
+
+    FILE_NAME = 'search.sqlite'
+
+    def __init__(self, directory: str, max_entries: int):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.max_entries = max_entries
+        self._local = local()
+        with self.connection as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires)')
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ SQLite connections cannot be shared between threads, so every thread opens its own"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self.connection.execute('SELECT value FROM responses WHERE key = ? AND expires > ?',
+                                      (key, time())).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def set(self, key: str, value: Any, timeout: int):
+        with self.connection as conn:
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                         (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time() + timeout))
+            conn.execute('DELETE FROM responses WHERE expires <= ?', (time(),))
+            conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY expires DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_entries,))
@@ -0,0 +1,192 @@
+import json
+import os
+from multiprocessing import Pool
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from elasticsearch.helpers import parallel_bulk
+from formulae.passage_cache import list_files
+from .lemmas import align_lemmas
+from .local import read_document
+
+# The index of each corpus is created with these settings and mappings. The autocomplete fields are split into
+# edge n-grams so that every word that starts with the typed letters is found. The searched letters are not split.
+INDEX_SETTINGS = {'analysis': {'filter': {'autocomplete_filter': {'type': 'edge_ngram', 'min_gram': 1,
+                                                                  'max_gram': 20}},
+                               'analyzer': {'autocomplete': {'type': 'custom', 'tokenizer': 'standard',
+                                                             'filter': ['lowercase', 'autocomplete_filter']}}}}
+INDEX_MAPPINGS = {'properties': {
+    'urn': {'type': 'keyword'},
+    'title': {'type': 'text'},
+    'text': {'type': 'text'},
+    'lemmas': {'type': 'text'},
+    'lemma_offsets': {'type': 'integer', 'index': False, 'doc_values': False},
+    'autocomplete': {'type': 'text', 'analyzer': 'autocomplete', 'search_analyzer': 'standard'},
+    'autocomplete_lemmas': {'type': 'text', 'analyzer': 'autocomplete', 'search_analyzer': 'standard'},
+    'date_string': {'type': 'keyword'},
+    'comp_ort': {'type': 'keyword'},
+    'orig_comp_ort': {'type': 'text'}}}
+
+
+def es_action(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """ The bulk action that indexes a document as returned by local.read_document. Each corpus has its own index and
+        the autocomplete fields are analyzed differently from the text and lemmas they are copied from.
+    """
+    return {'_op_type': 'index', '_index': doc['type'], '_id': doc['urn'],
+            '_source': {'urn': doc['urn'], 'title': doc['title'], 'text': doc['text'], 'lemmas': doc['lemmas'],
+                        'lemma_offsets': align_lemmas(doc['text'], doc['lemmas']),
+                        'autocomplete': doc['text'], 'autocomplete_lemmas': doc['lemmas'],
+                        'date_string': doc['date_string'], 'comp_ort': doc['comp_ort'],
+                        'orig_comp_ort': doc['orig_comp_ort']}}
+
+
+def _read(file_path: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    return file_path, read_document(file_path)
+
+
+class CorpusIndexer(object):
+    """ Indexes the TEI texts of the corpus in Elasticsearch. The texts are parsed one at a time, optionally in several
+        processes, and sent with the bulk API by several threads, so the corpus is never held in memory as a whole.
+
+        The index of a corpus is created with INDEX_SETTINGS and INDEX_MAPPINGS before its first document is sent.
+
+        The size and modification time of every indexed file is stored under the cache directory. Later runs only
+        index the texts whose files have changed, or whose __cts__.xml has changed, and delete the documents of the
+        files that were removed. A text whose document could not be indexed is tried again in the next run.
+
+    :param es: the Elasticsearch client
+    :param corpus_folders: the folders that contain the texts
+    :param cache_directory: the folder in which the state of the index is stored
+    :param chunk_size: the number of documents sent in each bulk request
+    :param threads: the number of threads that send bulk requests
+    :param processes: the number of processes that parse the texts
+    """
+
+    def __init__(self, es, corpus_folders: List[str], cache_directory: str, chunk_size: int = 100, threads: int = 4,
+                 processes: int = 1):
+        self.es = es
+        self.corpus_folders = corpus_folders
+        self.path = os.path.join(cache_directory, 'search_index_state.json')
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.processes = processes
+
+    def load_state(self) -> Dict[str, Dict[str, Any]]:
+        """ The indexed files with their size, modification time and the id and index of their document"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        # The documents of another cluster have to be indexed again
+        return state['files'] if state.get('hosts') == self.hosts else dict()
+
+    def save_state(self, files: Dict[str, Dict[str, Any]]):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'hosts': self.hosts, 'files': files}, f)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def hosts(self) -> List[str]:
+        try:
+            return sorted(str(node.base_url) for node in self.es.transport.node_pool.all())
+        except AttributeError:
+            return []
+
+    @staticmethod
+    def stamp(file_path: str) -> List[int]:
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def prepare_index(self, name: str, recreate: bool = False):
+        """ Create an index with INDEX_SETTINGS and INDEX_MAPPINGS if it does not exist
+
+        :param name: the name of the index
+        :param recreate: whether an existing index should be deleted and created again
+        """
+        if recreate:
+            self.es.indices.delete(index=name, ignore_unavailable=True)
+        elif self.es.indices.exists(index=name):
+            return
+        self.es.indices.create(index=name, settings=INDEX_SETTINGS, mappings=INDEX_MAPPINGS)
+
+    def changes(self, state: Dict[str, Dict[str, Any]], full: bool = False) -> Tuple[List[str], List[str]]:
+        """ The texts that have to be indexed and the indexed files that no longer exist
+
+        :param state: the indexed files as returned by load_state
+        :param full: whether all texts should be indexed
+        :return: the changed files and the removed files
+        """
+        files = list(list_files(self.corpus_folders, ('.xml',)))
+        changed_folders = {os.path.dirname(f) for f in files
+                           if os.path.basename(f) == '__cts__.xml' and state.get(f, {}).get('stamp') != self.stamp(f)}
+        changed = [f for f in files if full or state.get(f, {}).get('stamp') != self.stamp(f) or
+                   os.path.dirname(f) in changed_folders]
+        existing = set(files)
+        return changed, [f for f in state if f not in existing]
+
+    def documents(self, files: List[str]) -> Iterator[Tuple[str, Optional[Dict[str, Any]]]]:
+        if self.processes > 1:
+            with Pool(self.processes) as pool:
+                yield from pool.imap(_read, files, chunksize=4)
+        else:
+            yield from map(_read, files)
+
+    def run(self, full: bool = False, recreate: bool = False) -> Dict[str, Any]:
+        """ Bring the index up to date with the corpus files
+
+        :param full: whether all texts should be indexed, not only those that changed
+        :param recreate: whether the indices should be deleted and created again with the current mappings, which
+            implies full
+        :return: the number of indexed, deleted, unchanged and failed documents and the number of seconds it took
+        """
+        start = perf_counter()
+        full = full or recreate
+        state = self.load_state()
+        changed, removed = self.changes(state, full=full)
+        stats = {'indexed': 0, 'deleted': 0, 'failed': 0,
+                 'unchanged': sum(1 for f, entry in state.items() if entry.get('id') and f not in removed)}
+        # The files of the documents that were sent with their new entry in the state, or their old one if the document
+        # is deleted. A new entry is only stored when its document was indexed, so that failed texts are sent again.
+        pending = dict()
+        prepared = set()
+
+        def actions():
+            for file_path in removed:
+                entry = state.pop(file_path)
+                if entry.get('id'):
+                    pending[entry['id']] = (file_path, entry)
+                    yield {'_op_type': 'delete', '_index': entry['index'], '_id': entry['id']}
+            for file_path, doc in self.documents(changed):
+                if state.pop(file_path, {}).get('id'):
+                    stats['unchanged'] -= 1
+                entry = {'stamp': self.stamp(file_path)}
+                if doc is None:
+                    state[file_path] = entry
+                    continue
+                entry.update({'id': doc['urn'], 'index': doc['type']})
+                if doc['type'] not in prepared:
+                    self.prepare_index(doc['type'], recreate=recreate)
+                    prepared.add(doc['type'])
+                pending[doc['urn']] = (file_path, entry)
+                yield es_action(doc)
+
+        for ok, item in parallel_bulk(self.es, actions(), thread_count=self.threads, chunk_size=self.chunk_size,
+                                      raise_on_error=False, raise_on_exception=False):
+            op_type, result = next(iter(item.items()))
+            file_path, entry = pending.pop(result.get('_id'), (None, None))
+            if op_type == 'delete':
+                if ok or result.get('status') == 404:
+                    stats['deleted'] += 1
+                    continue
+                # The document is deleted again in the next run
+                state[file_path] = entry
+            elif ok:
+                stats['indexed'] += 1
+                state[file_path] = entry
+                continue
+            stats['failed'] += 1
+        self.save_state(state)
+        stats['seconds'] = round(perf_counter() - start, 3)
+        return stats
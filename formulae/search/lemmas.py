@@ -0,0 +1,104 @@
+from bisect import bisect_left
+from flask import Markup
+from markupsafe import escape
+from string import punctuation
+from typing import Dict, List, Sequence, Set, Tuple
+import re
+
+
+TOKEN = re.compile(r'\S+')
+
+
+def word_spans(text: str) -> List[Tuple[int, int]]:
+    """ The character spans of the words of a text. A word is a token without the punctuation before and after it.
+        Tokens that consist only of punctuation are not words. The search results and the rendered passages both
+        number the words of a document this way (see snippets.words_in_span and rendering.tei_words).
+
+    :param text: the text of the document
+    :return: the start and end offsets of each word
+    """
+    words = []
+    for m in TOKEN.finditer(text):
+        # Punctuation before and after a word is not part of the inflected form
+        word = m.group().strip(punctuation)
+        if word:
+            start = m.start() + m.group().index(word)
+            words.append((start, start + len(word)))
+    return words
+
+
+def align_lemmas(text: str, lemmas: str) -> List[int]:
+    """ Maps every lemma of a document to the character span of its inflected form in the text. This is computed when
+        a document is indexed and stored in its 'lemma_offsets' field so that lemma searches can highlight the exact
+        words. Tokens that consist only of punctuation have no lemma. If the number of the remaining words still
+        differs from the number of lemmas, each lemma is mapped to the word at the same relative position.
+
+    :param text: the text of the document
+    :param lemmas: the lemmas of the document separated by whitespace
+    :return: the start and end offsets of the word of each lemma as one flat list, i.e., [start_0, end_0, start_1, ...]
+    """
+    lems = lemmas.split()
+    words = word_spans(text)
+    if not words or not lems:
+        return []
+    offsets = []
+    ratio = len(words) / len(lems)
+    for i in range(len(lems)):
+        offsets.extend(words[i] if len(words) == len(lems) else words[min(round(i * ratio), len(words) - 1)])
+    return offsets
+
+
+def find_lemma_matches(lems: Sequence[str], query_words: Sequence[str], slop: int,
+                       in_order: bool) -> List[Tuple[int, Set[int]]]:
+    """ Finds every occurrence of the first query word around which all other query words occur within the window
+        that the slop allows. The document is only walked once to collect the positions of the query words.
+
+    :param lems: the lemmas of the document
+    :param query_words: the lemmas that were searched
+    :param slop: the allowed number of words between the query words
+    :param in_order: whether the query words had to occur in the given order
+    :return: for each match the index of the first query word and the indices of all query words in its window
+    """
+    positions = {w: [] for w in query_words}  # type: Dict[str, List[int]]
+    for i, lem in enumerate(lems):
+        if lem in positions:
+            positions[lem].append(i)
+    addend = 0 if in_order else 1
+    matches = []
+    for i in positions[query_words[0]]:
+        start = max(i - (slop + addend), 0) if len(query_words) > 1 else i
+        end = min(i + slop + len(query_words), len(lems)) if len(query_words) > 1 else i + 1
+        found = set()
+        for w in set(query_words):
+            in_window = positions[w][bisect_left(positions[w], start):bisect_left(positions[w], end)]
+            if not in_window:
+                break
+            found.update(in_window)
+        else:
+            matches.append((i, found))
+    return matches
+
+
+def lemma_snippet(text: str, offsets: Sequence[int], found: Set[int], first: int, last: int,
+                  pre_tag: str, post_tag: str) -> Markup:
+    """ Builds the snippet for a lemma search hit directly from the lemma offsets of the document
+
+    :param text: the text of the document
+    :param offsets: the flat list of the lemma offsets (see align_lemmas)
+    :param found: the indices of the lemmas that should be highlighted
+    :param first: the index of the first lemma of the snippet
+    :param last: the index of the last lemma of the snippet
+    :param pre_tag: the tag(s) that mark the beginning of a highlighted word
+    :param post_tag: the tag(s) that mark the end of a highlighted word
+    :return: the snippet with the inflected forms of the found lemmas highlighted
+    """
+    last = min(last, len(offsets) // 2 - 1)
+    position = offsets[2 * first]
+    parts = []
+    for start, end in sorted(set((offsets[2 * i], offsets[2 * i + 1]) for i in found)):
+        if start < position:
+            continue
+        parts.extend([escape(text[position:start]), Markup(pre_tag), escape(text[start:end]), Markup(post_tag)])
+        position = end
+    parts.append(escape(text[position:max(offsets[2 * last + 1], position)]))
+    return Markup('').join(parts)
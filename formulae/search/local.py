@@ -0,0 +1,471 @@
+import json
+import mmap
+import os
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from glob import glob
+from threading import Lock
+from time import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from lxml import etree
+from markupsafe import escape
+from formulae.corpus_snapshot import file_fingerprint
+from formulae.passage_cache import list_files
+from .autocomplete import normalize
+from .lemmas import align_lemmas
+
+
+NAMESPACES = {'tei': 'http://www.tei-c.org/ns/1.0', 'ti': 'http://chs.harvard.edu/xmlns/cts',
+              'dct': 'http://purl.org/dc/terms/'}
+TOKEN = re.compile(r'\S+')
+# The fields of the Elasticsearch documents and the indexed field that they are searched in. The autocomplete fields
+# match every word that starts with the searched term, like the edge n-grams they are analyzed with in Elasticsearch.
+FIELDS = {'text': 'text', 'lemmas': 'lemmas', 'autocomplete': 'text', 'autocomplete_lemmas': 'lemmas'}
+PREFIX_FIELDS = {'autocomplete', 'autocomplete_lemmas'}
+# The Elasticsearch index names that stand for several corpora
+INDEX_ALIASES = {'new_testament': ['nt'], 'jewish': ['tlg0018', 'tlg0527']}
+DEFAULT_FRAGMENT_SIZE = 100
+NUMBER_OF_FRAGMENTS = 5
+# The age in seconds after which the temporary file of an index that is not being built anymore is removed
+STALE_TMP_AGE = 3600
+
+Matches = Dict[int, List[Tuple[int, ...]]]
+
+
+def tokenize(text: str) -> List[Tuple[int, int, str]]:
+    """ The words of a text with their character offsets and their normalized form. Tokens that consist only of
+        punctuation are skipped, so the position of a word is its index in this list.
+    """
+    tokens = []
+    for m in TOKEN.finditer(text):
+        term = normalize(m.group())
+        if term:
+            tokens.append((m.start(), m.end(), term))
+    return tokens
+
+
+def lemma_tokens(lemmas: str) -> List[Tuple[int, int, str]]:
+    """ The lemmas of a document with their character offsets and in lower case"""
+    return [(m.start(), m.end(), m.group().lower()) for m in TOKEN.finditer(lemmas)]
+
+
+def read_document(file_path: str) -> Optional[Dict[str, Any]]:
+    """ The searchable document of a TEI text. Its type is its corpus, i.e., the first part of its file name. Notes
+        are not part of the text. The date and the place of composition are taken from the dct:temporal and
+        dct:spatial metadata of the edition in __cts__.xml. Like in the existing index, ' ' stands for an unknown one.
+        comp_ort is the place without the details in parentheses, e.g., 'Salzburg' for 'Salzburg (St. Rudbert)'.
+
+    :param file_path: the path of the TEI file
+    :return: the document or None if the file is not a text
+    """
+    name = os.path.basename(file_path)
+    if name == '__cts__.xml':
+        return None
+    root = etree.parse(file_path).getroot()
+    edition = root.xpath('//tei:body/tei:div[@type="edition"]/@n', namespaces=NAMESPACES)
+    if not edition:
+        return None
+    body = root.xpath('//tei:body', namespaces=NAMESPACES)[0]
+    text = ' '.join(''.join(body.xpath('.//text()[not(ancestor::tei:note)]', namespaces=NAMESPACES)).split())
+    lemmas = ' '.join(w.get('lemma') for w in body.iter('{{{}}}w'.format(NAMESPACES['tei'])) if w.get('lemma'))
+    title = str(edition[0])
+    metadata = {'date_string': ' ', 'orig_comp_ort': ' '}
+    cts_file = os.path.join(os.path.dirname(file_path), '__cts__.xml')
+    if os.path.isfile(cts_file):
+        cts = etree.parse(cts_file)
+        titles = cts.xpath('//ti:title/text()', namespaces=NAMESPACES)
+        title = titles[0].strip() if titles else title
+        for field, element in (('date_string', 'dct:temporal'), ('orig_comp_ort', 'dct:spatial')):
+            values = cts.xpath('//ti:edition[@urn="{}"]//{}/text()'.format(edition[0], element), namespaces=NAMESPACES)
+            if values and values[0].strip():
+                metadata[field] = values[0].strip()
+    metadata['comp_ort'] = metadata['orig_comp_ort'].split('(')[0].strip() or ' '
+    return dict({'urn': str(edition[0]), 'type': name.split('.')[0], 'title': title, 'text': text, 'lemmas': lemmas},
+                **metadata)
+
+
+def read_documents(corpus_folders: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """ The searchable documents of the corpus, one for every TEI text"""
+    for file_path in list_files(corpus_folders, ('.xml',)):
+        doc = read_document(file_path)
+        if doc is not None:
+            yield doc
+
+
+def build_index(directory: str, documents: Iterable[Dict[str, Any]], fingerprint: str):
+    """ Write the inverted index of the documents. The postings of all terms are stored in one file of unsigned
+        integers as (document, position) pairs and the stored fields in another, so both can be memory-mapped and
+        shared by all workers. The files are named after the fingerprint of the corpus. Each one is written to a
+        temporary file of this process and then moved into place, the metadata file last since it makes the index
+        visible. So a worker that builds the same index at the same time never changes a file that another one has
+        already opened.
+
+    :param directory: the folder of the index
+    :param documents: the documents as returned by read_documents
+    :param fingerprint: the fingerprint of the corpus files
+    """
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, fingerprint)
+    postings = {field: defaultdict(lambda: array('I')) for field in set(FIELDS.values())}
+    docs = []
+    with open(temporary_path(base + '.store'), 'wb') as store:
+        for doc_id, doc in enumerate(documents):
+            source = {'text': doc['text'], 'lemmas': doc['lemmas'], 'lemma_offsets': align_lemmas(doc['text'],
+                                                                                                   doc['lemmas'])}
+            data = json.dumps(source, ensure_ascii=False).encode('utf-8')
+            docs.append({'urn': doc['urn'], 'type': doc['type'], 'title': doc['title'],
+                         'date_string': doc.get('date_string', ' '), 'orig_comp_ort': doc.get('orig_comp_ort', ' '),
+                         'store': [store.tell(), len(data)]})
+            store.write(data)
+            for position, (_, _, term) in enumerate(tokenize(doc['text'])):
+                postings['text'][term].extend((doc_id, position))
+            for position, (_, _, term) in enumerate(lemma_tokens(doc['lemmas'])):
+                postings['lemmas'][term].extend((doc_id, position))
+    fields = dict()
+    with open(temporary_path(base + '.postings'), 'wb') as f:
+        offset = 0
+        for field, terms in postings.items():
+            fields[field] = {'terms': sorted(terms), 'postings': []}
+            for term in fields[field]['terms']:
+                fields[field]['postings'].append([offset, len(terms[term]) // 2])
+                terms[term].tofile(f)
+                offset += len(terms[term])
+    with open(temporary_path(base + '.json'), 'w') as f:
+        json.dump({'docs': docs, 'fields': fields}, f, ensure_ascii=False)
+    for extension in ('.store', '.postings', '.json'):
+        os.replace(temporary_path(base + extension), base + extension)
+    for old in glob(os.path.join(directory, '*')):
+        if os.path.basename(old).startswith(fingerprint):
+            continue
+        try:
+            # Another worker may still be building an index for a different state of the corpus
+            if not old.endswith('.tmp') or time() - os.path.getmtime(old) > STALE_TMP_AGE:
+                os.remove(old)
+        except FileNotFoundError:
+            pass
+
+
+def temporary_path(path: str) -> str:
+    """ The name under which this process writes a file of the index before it is moved to path"""
+    return '{}.{}.tmp'.format(path, os.getpid())
+
+
+def levenshtein(a: str, b: str, limit: int) -> int:
+    """ The edit distance between a and b or limit + 1 if it is larger than limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def fuzziness_limit(fuzziness: Union[str, int], term: str) -> int:
+    """ The maximum edit distance of a fuzzy query as Elasticsearch computes it"""
+    if str(fuzziness).upper() == 'AUTO':
+        return 0 if len(term) < 3 else 1 if len(term) < 6 else 2
+    return int(fuzziness or 0)
+
+
+class LocalSearch(object):
+    """ A search engine that answers the requests of formulae.search.Search like the Elasticsearch client does, so that
+        deployments without Elasticsearch can still be searched. It supports the queries that are built there: span_near
+        with slop and in_order over span_term and span_multi clauses with wildcard or fuzzy terms in the text, lemma and
+        autocomplete fields, sorting by urn, from/size and search_after paging, highlighting and filters aggregations
+        on the corpus of a document.
+
+        The inverted index is built from the TEI texts of the corpus when it is first searched, or with the
+        build_search_index command of manager.py, and is rebuilt when the corpus files change.
+
+    :param corpus_folders: the folders that contain the texts
+    :param directory: the folder in which the index is stored
+    """
+
+    def __init__(self, corpus_folders: List[str], directory: str):
+        self.corpus_folders = corpus_folders
+        self.directory = directory
+        self._lock = Lock()
+        self._meta = None  # type: Dict[str, Any]
+        self._postings = None
+        self._store = None
+        self._urns = None
+
+    def build(self) -> str:
+        """ Build the index if there is none for the current corpus files
+
+        :return: the path of the metadata file of the index
+        """
+        fingerprint = file_fingerprint(self.corpus_folders, ('.xml',))
+        path = os.path.join(self.directory, fingerprint + '.json')
+        if not os.path.isfile(path):
+            build_index(self.directory, read_documents(self.corpus_folders), fingerprint)
+        return path
+
+    def _open(self):
+        if self._meta is not None:
+            return
+        with self._lock:
+            if self._meta is not None:
+                return
+            base = self.build()[:-len('.json')]
+            with open(base + '.json') as f:
+                meta = json.load(f)
+            with open(base + '.postings', 'rb') as f:
+                postings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f.name) else b''
+            with open(base + '.store', 'rb') as f:
+                self._store = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f.name) else b''
+            self._postings = memoryview(postings).cast('I') if postings else []
+            for doc_id, doc in enumerate(meta['docs']):
+                doc['id'] = doc_id
+            self._urns = sorted(range(len(meta['docs'])), key=lambda d: meta['docs'][d]['urn'])
+            self._meta = meta
+
+    def source(self, doc_id: int) -> Dict[str, Any]:
+        """ The stored fields of a document"""
+        self._open()
+        doc = self._meta['docs'][doc_id]
+        offset, length = doc['store']
+        source = json.loads(bytes(self._store[offset:offset + length]).decode('utf-8'))
+        source.update({k: doc[k] for k in ['urn', 'title', 'date_string', 'orig_comp_ort']})
+        return source
+
+    def terms(self, field: str, query: Dict[str, Any]) -> List[int]:
+        """ The indices of the terms in the term dictionary of field that a span_term or span_multi query matches"""
+        terms = self._meta['fields'][FIELDS[field]]['terms']
+        prefix = field in PREFIX_FIELDS
+        if 'wildcard' in query:
+            pattern = query['wildcard'][field]
+            pattern = pattern['value'] if isinstance(pattern, dict) else pattern
+            literal = re.split(r'[*?]', pattern, 1)[0].lower()
+            regex = re.compile(''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c)
+                                       for c in pattern.lower()) + ('.*' if prefix else '') + '$')
+            start, end = self._prefix_range(terms, literal)
+            return [i for i in range(start, end) if regex.match(terms[i])]
+        if 'fuzzy' in query:
+            value = query['fuzzy'][field]
+            value, fuzziness = (value['value'], value.get('fuzziness', 0)) if isinstance(value, dict) else (value, 0)
+        else:
+            value, fuzziness = query[field], 0
+        value = value.lower()
+        limit = fuzziness_limit(fuzziness, value)
+        if not limit:
+            if prefix:
+                return list(range(*self._prefix_range(terms, value)))
+            i = bisect_left(terms, value)
+            return [i] if i < len(terms) and terms[i] == value else []
+        return [i for i, term in enumerate(terms)
+                if levenshtein(value, term[:len(value)] if prefix else term, limit) <= limit]
+
+    @staticmethod
+    def _prefix_range(terms: Sequence[str], prefix: str) -> Tuple[int, int]:
+        start = bisect_left(terms, prefix)
+        return start, bisect_left(terms, prefix + '\U0010ffff', start)
+
+    def positions(self, field: str, term_ids: List[int]) -> Dict[int, List[int]]:
+        """ The positions of the given terms in each document in which they occur"""
+        field_postings = self._meta['fields'][FIELDS[field]]['postings']
+        found = defaultdict(list)
+        for term_id in term_ids:
+            offset, count = field_postings[term_id]
+            pairs = self._postings[offset:offset + 2 * count]
+            for i in range(0, 2 * count, 2):
+                found[pairs[i]].append(pairs[i + 1])
+        if len(term_ids) > 1:
+            for positions in found.values():
+                positions.sort()
+        return found
+
+    def match(self, query: Dict[str, Any]) -> Matches:
+        """ The documents that match a query with the positions of the words of every match"""
+        if not query or 'match_all' in query:
+            return {doc_id: [] for doc_id in range(len(self._meta['docs']))}
+        if 'bool' in query:
+            result = None
+            for sub_query in query['bool'].get('must', []):
+                matches = self.match(sub_query)
+                result = matches if result is None else {d: result[d] + matches[d] for d in result if d in matches}
+            return self.match({}) if result is None else result
+        if 'span_near' in query:
+            clauses = [self.match(clause) for clause in query['span_near']['clauses']]
+            return self.near([{d: [m[0] for m in ms] for d, ms in c.items()} for c in clauses],
+                             int(query['span_near'].get('slop', 0)), query['span_near'].get('in_order', True))
+        if 'span_multi' in query:
+            query = query['span_multi']['match']
+            field = list(list(query.values())[0])[0]
+        elif 'span_term' in query:
+            query = query['span_term']
+            field = list(query)[0]
+        else:
+            raise ValueError('Unsupported query: {}'.format(list(query)))
+        return {d: [(p,) for p in positions]
+                for d, positions in self.positions(field, self.terms(field, query)).items()}
+
+    @staticmethod
+    def near(clauses: List[Dict[int, List[int]]], slop: int, in_order: bool) -> Matches:
+        """ The documents in which the clauses occur within slop words of each other
+
+        :param clauses: for every clause the positions at which it matches in each document
+        :param slop: the maximum number of words between the matched clauses
+        :param in_order: whether the clauses have to occur in the given order
+        :return: the documents with the positions of each match
+        """
+        if len(clauses) == 1:
+            return {d: [(p,) for p in positions] for d, positions in clauses[0].items()}
+        results = dict()
+        docs = set.intersection(*[set(c) for c in clauses])
+        for doc in docs:
+            lists = [c[doc] for c in clauses]
+            matches = []
+            if in_order:
+                for first in lists[0]:
+                    chosen = [first]
+                    for positions in lists[1:]:
+                        i = bisect_right(positions, chosen[-1])
+                        if i == len(positions):
+                            break
+                        chosen.append(positions[i])
+                    if len(chosen) == len(lists) and chosen[-1] - chosen[0] - (len(lists) - 1) <= slop:
+                        matches.append(tuple(chosen))
+            else:
+                merged = sorted((p, n) for n, positions in enumerate(lists) for p in positions)
+                latest = dict()
+                for p, n in merged:
+                    latest[n] = p
+                    if len(latest) == len(lists):
+                        window = sorted(latest.values())
+                        if len(set(window)) == len(lists) and window[-1] - window[0] - (len(lists) - 1) <= slop:
+                            matches.append(tuple(window))
+            if matches:
+                results[doc] = sorted(set(matches))
+        return results
+
+    @staticmethod
+    def highlight(text: str, tokens: List[Tuple[int, int, str]], matches: List[Tuple[int, ...]], fragment_size: int,
+                  pre_tag: str, post_tag: str) -> List[str]:
+        """ Fragments of a field around its first matches with the matched words between pre_tag and post_tag
+
+        :param text: the value of the field
+        :param tokens: the tokens of the field as returned by tokenize or lemma_tokens
+        :param matches: the positions of the words of each match
+        :param fragment_size: the approximate number of characters of a fragment
+        :param pre_tag: the tag that is inserted before each matched word
+        :param post_tag: the tag that is inserted after each matched word
+        :return: the highlighted fragments
+        """
+        fragments = []
+        covered = -1
+        for match in matches:
+            if len(fragments) == NUMBER_OF_FRAGMENTS:
+                break
+            if tokens[match[0]][0] < covered:
+                continue
+            span_start, span_end = tokens[match[0]][0], tokens[match[-1]][1]
+            start = max(0, span_start - max(fragment_size - (span_end - span_start), 0) // 2)
+            start = 0 if start == 0 else text.find(' ', start) + 1 or span_start
+            start = min(start, span_start)
+            end = max(span_end, min(len(text), start + fragment_size))
+            end = text.find(' ', end) if text.find(' ', end) != -1 else len(text)
+            marked = [p for m in matches for p in m if start <= tokens[p][0] and tokens[p][1] <= end]
+            parts = []
+            position = start
+            for p in sorted(set(marked)):
+                parts.extend([str(escape(text[position:tokens[p][0]])), pre_tag,
+                              str(escape(text[tokens[p][0]:tokens[p][1]])), post_tag])
+                position = tokens[p][1]
+            parts.append(str(escape(text[position:end])))
+            fragments.append(''.join(parts))
+            covered = end
+        return fragments
+
+    def _doc_types(self, index: Union[str, List[str], None]) -> Optional[set]:
+        indices = [index] if isinstance(index, str) else list(index or ['all'])
+        if 'all' in indices or '_all' in indices:
+            return None
+        types = set()
+        for name in indices:
+            types.update(INDEX_ALIASES.get(name, [name]))
+        return types
+
+    def search(self, index: Union[str, List[str]] = None, body: Dict[str, Any] = None, **kwargs) -> Dict[str, Any]:
+        """ Answer a search request like Elasticsearch"""
+        self._open()
+        body = body or {}
+        if 'pit' in body:
+            index = json.loads(body['pit']['id'])
+        types = self._doc_types(index)
+        docs = self._meta['docs']
+        matches = {d: m for d, m in self.match(body.get('query', {})).items()
+                   if types is None or docs[d]['type'] in types}
+        response = {'took': 0, 'timed_out': False, 'hits': {'total': len(matches), 'hits': []}}
+        if 'pit' in body:
+            response['pit_id'] = body['pit']['id']
+        for name, agg in body.get('aggs', {}).items():
+            buckets = dict()
+            for bucket, bucket_filter in agg['filters']['filters'].items():
+                doc_type = bucket_filter['match']['_type']
+                buckets[bucket] = {'doc_count': sum(1 for d in matches if docs[d]['type'] == doc_type)}
+            response.setdefault('aggregations', {})[name] = {'buckets': buckets}
+        ordered, sort_values = self._sort(matches, body.get('sort'))
+        if 'search_after' in body:
+            after = list(body['search_after'])
+            ordered = [d for d in ordered if self._is_after(sort_values(d), after, body.get('sort'))]
+        start = body.get('from', 0)
+        highlight = body.get('highlight', {})
+        for d in ordered[start:start + body.get('size', 10)]:
+            hit = {'_index': docs[d]['type'], '_type': docs[d]['type'], '_id': docs[d]['urn'],
+                   '_score': float(len(matches[d])), 'sort': sort_values(d)}
+            source = self.source(d) if body.get('_source', True) is not False or highlight else {}
+            if body.get('_source', True) is not False:
+                fields = body.get('_source', True)
+                hit['_source'] = source if fields is True else {k: source[k] for k in fields if k in source}
+            if highlight and matches[d]:
+                hit['highlight'] = dict()
+                for field, options in highlight['fields'].items():
+                    value = source[FIELDS[field]]
+                    tokens = tokenize(value) if FIELDS[field] == 'text' else lemma_tokens(value)
+                    hit['highlight'][field] = self.highlight(value, tokens, matches[d],
+                                                             options.get('fragment_size', DEFAULT_FRAGMENT_SIZE),
+                                                             highlight.get('pre_tags', ['<em>'])[0],
+                                                             highlight.get('post_tags', ['</em>'])[0])
+            response['hits']['hits'].append(hit)
+        return response
+
+    def _sort(self, matches: Matches, sort) -> Tuple[List[int], Any]:
+        docs = self._meta['docs']
+        if sort is None:
+            ordered = sorted(matches, key=lambda d: (-len(matches[d]), docs[d]['urn']))
+            return ordered, lambda d: [float(len(matches[d])), docs[d]['urn']]
+        ordered = [d for d in self._urns if d in matches]
+        if self._descending(sort):
+            ordered.reverse()
+        return ordered, lambda d: [docs[d]['urn']]
+
+    @staticmethod
+    def _descending(sort) -> bool:
+        return isinstance(sort, list) and isinstance(sort[0], dict) and sort[0].get('urn', {}).get('order') == 'desc'
+
+    def _is_after(self, values: list, after: list, sort) -> bool:
+        if sort is None:
+            return (-values[0], values[1]) > (-after[0], after[1])
+        return values > after[:1] if not self._descending(sort) else values < after[:1]
+
+    def msearch(self, body: List[Dict[str, Any]] = None, **kwargs) -> Dict[str, Any]:
+        """ Answer several searches given as alternating header and body lines"""
+        return {'responses': [self.search(index=header.get('index'), body=search_body)
+                              for header, search_body in zip(body[::2], body[1::2])]}
+
+    def open_point_in_time(self, index: Union[str, List[str]] = None, **kwargs) -> Dict[str, str]:
+        """ The index does not change while the application runs, so a point in time only has to remember the
+            indices that are searched
+        """
+        return {'id': json.dumps([index] if isinstance(index, str) else list(index))}
+
+    def close_point_in_time(self, **kwargs) -> Dict[str, Any]:
+        return {'succeeded': True}
@@ -1,8 +1,8 @@
-from flask import redirect, request, url_for, g, flash, current_app
+from flask import redirect, request, url_for, g, flash, current_app, abort
 from flask_babel import _
 from flask_login import login_required
 from math import ceil
-from .Search import query_index, advanced_query_index, suggest_word_search
+from .Search import query_index, advanced_query_index
 from .forms import AdvancedSearchForm
 from formulae.search import bp
 from json import dumps
@@ -116,21 +116,17 @@ def r_search_docs():
 @bp.route("/suggest/<word>", methods=["GET"])
 @login_required
 def word_search_suggester(word):
-    words = suggest_word_search(word, field=request.args.get('field', 'autocomplete'),
-                                fuzziness=request.args.get("fuzziness", "0"),
-                                in_order=request.args.get('in_order', 'False'),
-                                slop=request.args.get('slop', '0'),
-                                year=request.args.get('year', 0, type=int),
-                                month=request.args.get('month', 0, type=int),
-                                day=request.args.get('day', 0, type=int),
-                                year_start=request.args.get('year_start', 0, type=int),
-                                month_start=request.args.get('month_start', 0, type=int),
-                                day_start=request.args.get('day_start', 0, type=int),
-                                year_end=request.args.get('year_end', 0, type=int),
-                                month_end=request.args.get('month_end', 0, type=int),
-                                day_end=request.args.get('day_end', 0, type=int),
-                                date_plus_minus=request.args.get("date_plus_minus", 0, type=int),
-                                corpus=request.args.get('corpus', '').split() or ['all'],
-                                exclusive_date_range=request.args.get('exclusive_date_range', "False"),
-                                composition_place=request.args.get('composition_place', ''))
+    """ Completes the last word of the search box from the vocabulary of the selected corpora with the fuzziness of
+        the search. in_order and slop only concern how the words of a query are matched with each other, so they do
+        not change the completions of the last word. The vocabulary has no dates or places, so requests that are
+        restricted by them are rejected.
+    """
+    date_args = ('year', 'month', 'day', 'year_start', 'month_start', 'day_start', 'year_end', 'month_end', 'day_end',
+                 'date_plus_minus')
+    if any(request.args.get(x, 0, type=int) for x in date_args) or request.args.get('composition_place'):
+        abort(400)
+    words = current_app.autocompleter.complete(word, field=request.args.get('field', 'autocomplete'),
+                                               corpora=request.args.get('corpus', '').split() or ['all'],
+                                               size=current_app.config['AUTOCOMPLETE_MAX_RESULTS'],
+                                               fuzziness=request.args.get('fuzziness', '0'))
     return dumps(words)
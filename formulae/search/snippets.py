@@ -0,0 +1,148 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_left, bisect_right
+from flask import Markup
+from string import punctuation
+from typing import Iterable, List, Optional, Sequence, Tuple
+import re
+import zlib
+
+
+# The characters that are removed from the sentences that are highlighted in the texts (see Nemo.convert_result_sents)
+NOT_IN_SENTENCE = re.compile('[{}„“…]'.format(re.escape(punctuation)))
+WHITESPACE = re.compile(r'\s+')
+_tag_patterns = dict()
+# The maximum decoded size of the result_sents of a link so that a crafted link cannot use up the memory of a worker
+MAX_RESULT_SENTS_LENGTH = 64 * 1024
+# Marks the line of an encoded result_sents that holds the word ranges of the sentences. Sentences never contain it.
+WORDS_MARKER = '#'
+
+
+def tag_pattern(pre_tag: str, post_tag: str):
+    """ The compiled pattern that matches both the pre_tag and the post_tag"""
+    if (pre_tag, post_tag) not in _tag_patterns:
+        _tag_patterns[pre_tag, post_tag] = re.compile('({})|({})'.format(re.escape(pre_tag), re.escape(post_tag)))
+    return _tag_patterns[pre_tag, post_tag]
+
+
+def snippet_window(fragment: str, first_pre: int, last_post: int, chars_before: int, chars_after: int,
+                   post_tag_length: int) -> Tuple[int, int]:
+    """ The part of a highlighted fragment that should be shown. It starts at the first space more than chars_before
+        characters before the first highlight and ends at the first space more than chars_after characters after the
+        last highlight.
+
+    :param fragment: the highlighted fragment
+    :param first_pre: the offset of the first pre_tag or -1 if there is none
+    :param last_post: the offset of the last post_tag or -1 if there is none
+    :param chars_before: the number of characters to include before the first pre_tag
+    :param chars_after: the number of characters to include after the last post_tag
+    :param post_tag_length: the length of the post_tag
+    :return: the start and end offsets of the snippet in the fragment
+    """
+    start = 0
+    end = len(fragment)
+    if first_pre - chars_before > 0:
+        start = max(fragment.rfind(' ', 0, first_pre - chars_before), 0)
+    if last_post + chars_after + post_tag_length < len(fragment):
+        end = fragment.find(' ', last_post + chars_after + post_tag_length)
+        if end == -1:
+            end = len(fragment)
+    return start, end
+
+
+def plain_sentence(snippet: str, pre_tag: str, post_tag: str) -> str:
+    """ The words of a snippet without the highlighting tags and punctuation, as they are searched for in the text"""
+    snippet = tag_pattern(pre_tag, post_tag).sub('', snippet)
+    return WHITESPACE.sub(' ', NOT_IN_SENTENCE.sub('', snippet)).strip()
+
+
+def words_in_span(spans: Tuple[Sequence[int], Sequence[int]], start: int, end: int) -> Optional[Tuple[int, int]]:
+    """ The first and last of the words that lie completely between the character offsets start and end
+
+    :param spans: the start offsets and the end offsets of the words of the document (see lemmas.word_spans)
+    :param start: the offset of the first character
+    :param end: the offset after the last character
+    :return: the indices of the first and last word or None if there is no word in between
+    """
+    first = bisect_left(spans[0], start)
+    last = bisect_right(spans[1], end) - 1
+    return (first, last) if first <= last else None
+
+
+def build_snippets(highlights: Iterable[List[str]], chars_before: int, chars_after: int,
+                   pre_tag: str, post_tag: str) -> List[Tuple[List[Markup], List[str]]]:
+    """ Shortens the highlighted fragments of all hits of a response. The tags in each fragment are located with a
+        single scan, which gives both the window of the snippet and the plain sentence that is passed on as
+        result_sents when a result is opened.
+
+    :param highlights: the highlighted fragments of each hit
+    :param chars_before: the number of characters to include before the first pre_tag
+    :param chars_after: the number of characters to include after the last post_tag
+    :param pre_tag: the tag(s) that mark the beginning of a highlighted section
+    :param post_tag: the tag(s) that mark the end of a highlighted section
+    :return: for each hit the snippets to show and the sentences to highlight in the text
+    """
+    tags = tag_pattern(pre_tag, post_tag)
+    snippets = []
+    for fragments in highlights:
+        sents = []
+        result_sents = []
+        for fragment in fragments:
+            first_pre = last_post = -1
+            for m in tags.finditer(fragment):
+                if m.group(1) is not None:
+                    if first_pre == -1:
+                        first_pre = m.start()
+                else:
+                    last_post = m.start()
+            start, end = snippet_window(fragment, first_pre, last_post, chars_before, chars_after, len(post_tag))
+            sents.append(Markup(fragment[start:end]))
+            result_sents.append(plain_sentence(fragment[start:end], pre_tag, post_tag))
+        snippets.append((sents, result_sents))
+    return snippets
+
+
+def encode_result_sents(result_sents: List[str], result_words: List[Optional[Tuple[int, int]]] = None) -> Optional[str]:
+    """ Encodes the result_sents of a hit compactly for the link from the search results to the text. The words are
+        already normalized, so they are only compressed and do not have to be parsed again when the text is shown.
+        The positions of the sentences in the document, if they are known, are stored in an additional line.
+
+    :param result_sents: the plain sentences of the hit
+    :param result_words: the indices of the first and last word of each sentence or None where they are not known
+    :return: the URL-safe code or None if there are no sentences
+    """
+    if not any(result_sents):
+        return None
+    lines = list(result_sents)
+    if result_words and any(result_words):
+        lines.insert(0, WORDS_MARKER + ' '.join('{}-{}'.format(*words) if words else '-' for words in result_words))
+    return urlsafe_b64encode(zlib.compress('\n'.join(lines).encode('utf-8'), 9)).decode('ascii').rstrip('=')
+
+
+def decode_result_code(code: str) -> Tuple[List[str], List[Optional[Tuple[int, int]]]]:
+    """ The result_sents and the word ranges encoded with encode_result_sents
+
+    :param code: the code from the link
+    :return: the sentences, each with its words separated by single spaces, and for each sentence the indices of its
+        first and last word in the document or None. Both are empty if the code is invalid.
+    """
+    try:
+        data = urlsafe_b64decode(code + '=' * (-len(code) % 4))
+        lines = zlib.decompressobj().decompress(data, MAX_RESULT_SENTS_LENGTH).decode('utf-8').split('\n')
+        result_words = [None] * len(lines)  # type: List[Optional[Tuple[int, int]]]
+        if lines[0].startswith(WORDS_MARKER):
+            lines, words = lines[1:], lines[0][len(WORDS_MARKER):].split(' ')
+            result_words = [tuple(int(x) for x in w.split('-', 1)) if w != '-' else None for w in words]
+            if len(result_words) != len(lines):
+                result_words = [None] * len(lines)
+        return lines, result_words
+    except (ValueError, zlib.error):
+        return [], []
+
+
+def decode_result_sents(code: str) -> List[str]:
+    """ The result_sents encoded with encode_result_sents
+
+    :param code: the code from the link
+    :return: the sentences, each with its words separated by single spaces, or [] if the code is invalid
+    """
+    return decode_result_code(code)[0]
@@ -0,0 +1,58 @@
+from lxml import etree
+from threading import Lock
+from time import perf_counter
+from collections import Counter
+from typing import Dict, Any
+
+
+class StylesheetRegistry(object):
+    """ Holds the compiled XSLT objects for all of the stylesheets registered in Nemo's transform dictionary.
+        Each stylesheet is parsed and compiled only once (either at startup or the first time it is requested) and the
+        compiled object is then shared between requests and threads. A compiled libxslt stylesheet is read-only during
+        a transformation, so a single object can safely be applied in several threads at once.
+
+    :param transforms: the Nemo transform dictionary, e.g., {'default': 'components/epidoc.xsl'}
+    """
+
+    def __init__(self, transforms: Dict[str, Any]):
+        self.paths = {name: path for name, path in transforms.items() if isinstance(path, str)}
+        self._compiled = dict()
+        self._lock = Lock()
+        self.compile_times = dict()
+        self.hits = Counter()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.paths
+
+    def compile_all(self):
+        """ Compile every registered stylesheet. Used at startup so that no request has to pay for the compilation."""
+        for name in self.paths:
+            self.get(name, count=False)
+
+    def get(self, name: str, count: bool = True) -> etree.XSLT:
+        """ Return the compiled stylesheet registered under name, compiling it if this has not happened yet
+
+        :param name: the key of the stylesheet in the transform dictionary
+        :param count: whether this call should be counted in the hit statistics
+        :return: the compiled XSLT object
+        """
+        xslt = self._compiled.get(name)
+        if xslt is None:
+            with self._lock:
+                # Another thread may have compiled the stylesheet while this one was waiting for the lock
+                xslt = self._compiled.get(name)
+                if xslt is None:
+                    start = perf_counter()
+                    with open(self.paths[name]) as f:
+                        xslt = etree.XSLT(etree.parse(f))
+                    self.compile_times[name] = perf_counter() - start
+                    self._compiled[name] = xslt
+        if count:
+            self.hits[name] += 1
+        return xslt
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """ The compilation time in seconds and the number of times each stylesheet has been used"""
+        return {name: {'path': path, 'compile_time': self.compile_times.get(name), 'hits': self.hits[name]}
+                for name, path in self.paths.items()}
@@ -1,7 +1,67 @@
-from formulae.app import resolver, nautilus_api
+from formulae.app import resolver, nautilus_api, nemo, flask_app
 from capitains_nautilus.manager import FlaskNautilusManager
+import click
 
 manager = FlaskNautilusManager(resolver, nautilus_api)
 
+
+@manager.command()
+def build_snapshot():
+    """ Write the corpus metadata snapshot, including the references of every text, that is loaded on startup """
+    nemo.write_snapshot()
+    click.echo("Wrote {} with the references of {} texts".format(nemo.snapshot.path, len(nemo.reffs_indices)))
+    click.echo("Startup times: " + nemo.startup_timer.report())
+
+
+@manager.command()
+def build_passage_tables():
+    """ Compile the TEXT_PARALLELS and NT_COMMENTARY_SECTIONS files into the tables that are memory-mapped on startup """
+    for config_var, compile_json in [('TEXT_PARALLELS', None),
+                                     ('NT_COMMENTARY_SECTIONS', nemo.compile_nt_commentary_sections)]:
+        table = nemo.load_external_table(config_var, compile_json, rebuild=True)
+        click.echo("Wrote {} with the passages of {} texts".format(table.path, len(table)))
+
+
+@manager.command()
+def build_autocomplete():
+    """ Build the vocabulary that the words typed in the search box are completed from """
+    vocabularies = flask_app.autocompleter.load(rebuild=True)
+    click.echo("Wrote {} with {} words and {} lemmas".format(flask_app.autocompleter.path,
+                                                            len(vocabularies['autocomplete'].terms),
+                                                            len(vocabularies['autocomplete_lemmas'].terms)))
+
+
+@manager.command()
+def build_search_index():
+    """ Build the index that the corpus is searched with when ELASTICSEARCH_URL is not set """
+    from formulae.search.local import LocalSearch
+    if not isinstance(flask_app.elasticsearch, LocalSearch):
+        click.echo("The local search is not used: ELASTICSEARCH_URL or NO_LOCAL_SEARCH is set")
+        return
+    click.echo("Wrote " + flask_app.elasticsearch.build())
+
+
+@manager.command()
+@click.option('--full', is_flag=True, help='Index all texts and not only those whose files changed')
+@click.option('--recreate', is_flag=True, help='Delete the indices and create them again with their mappings before '
+                                               'indexing all texts')
+@click.option('--chunk-size', default=100, help='The number of documents sent in each bulk request')
+@click.option('--threads', default=4, help='The number of threads that send bulk requests')
+@click.option('--processes', default=1, help='The number of processes that parse the texts')
+def index_corpus(full, recreate, chunk_size, threads, processes):
+    """ Index the texts of the corpus in the Elasticsearch cluster at ELASTICSEARCH_URL """
+    from elasticsearch import Elasticsearch
+    from formulae.search.indexer import CorpusIndexer
+    if not isinstance(flask_app.elasticsearch, Elasticsearch):
+        click.echo("ELASTICSEARCH_URL is not set")
+        return
+    indexer = CorpusIndexer(flask_app.elasticsearch, flask_app.config['CORPUS_FOLDERS'],
+                            flask_app.config['CACHE_DIRECTORY'], chunk_size=chunk_size, threads=threads,
+                            processes=processes)
+    stats = indexer.run(full=full, recreate=recreate)
+    click.echo("Indexed {indexed}, deleted {deleted} and kept {unchanged} documents in {seconds} seconds; "
+               "{failed} failed".format(**stats))
+
+
 if __name__ == "__main__":
     manager()
@@ -0,0 +1,47 @@
+""" Microbenchmark for the highlighting of search results in a passage (formulae.rendering.highlight_sentences)
+
+    Run from the repository root with ``python -m tests.bench_highlighting``. For every combination of passage length
+    and number of result sentences, one JSON object with the median time in seconds is printed per line.
+"""
+from formulae.rendering import highlight_sentences
+from lxml import etree
+from json import dumps
+from statistics import median
+from time import perf_counter
+import random
+
+PASSAGE_LENGTHS = [500, 2000, 8000, 32000]
+SENTENCE_COUNTS = [1, 10, 50]
+SENTENCE_LENGTH = 12
+WORDS_PER_PARAGRAPH = 20
+REPEATS = 5
+VOCABULARY = ['λόγος', 'καὶ', 'ὁ', 'θεός', 'ἐν', 'ἀρχῇ', 'ἦν', 'πρὸς', 'τὸν', 'οὗτος', 'δι᾽', 'αὐτοῦ', 'ἐγένετο',
+              'χωρὶς', 'οὐδὲ', 'ἕν', 'ζωὴ', 'φῶς', 'τῶν', 'ἀνθρώπων', 'σκοτίᾳ', 'φαίνει', 'αὐτὸ', 'κατέλαβεν']
+
+
+def build_passage(length: int):
+    words = [random.choice(VOCABULARY) for _ in range(length)]
+    paragraphs = ['<p>' + ''.join('<span class="w">{}</span>'.format(w) for w in words[i:i + WORDS_PER_PARAGRAPH]) +
+                  '</p>' for i in range(0, length, WORDS_PER_PARAGRAPH)]
+    return '<div>' + ''.join(paragraphs) + '</div>', words
+
+
+def run():
+    random.seed(0)
+    for length in PASSAGE_LENGTHS:
+        html, words = build_passage(length)
+        for count in SENTENCE_COUNTS:
+            starts = [random.randrange(length - SENTENCE_LENGTH) for _ in range(count)]
+            sents = [' '.join(words[s:s + SENTENCE_LENGTH]) for s in starts]
+            timings = []
+            for _ in range(REPEATS):
+                root = etree.fromstring(html)
+                start = perf_counter()
+                highlight_sentences(root, sents)
+                timings.append(perf_counter() - start)
+            print(dumps({'benchmark': 'highlight_sentences', 'words': length, 'sentences': count,
+                         'seconds': median(timings)}))
+
+
+if __name__ == '__main__':
+    run()
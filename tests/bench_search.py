@@ -0,0 +1,232 @@
+""" Benchmark for the search hot path that replays recorded searches against a local stand-in for Elasticsearch
+
+    Run from the repository root with ``python -m tests.bench_search``. The searches and responses that were recorded
+    with SAVE_REQUESTS (see tests/fake_es.py) are sent through query_index, advanced_query_index, the autocompleter
+    and the r_results view. A query log with one JSON object of r_results arguments per line (e.g.,
+    {"corpus": "nt", "q": "λόγος", "lemma_search": "y"}) can be replayed instead with ``--log FILE``.
+
+    For every entry point and stage, one JSON object with the number of samples and the 50th, 90th and 99th
+    percentiles in seconds is printed per line. The stages are the building of the request body ('body'), the call to
+    Elasticsearch ('es_call'), the highlighting of text hits ('highlighting'), the matching of lemma hits
+    ('lemma_alignment') and the rendering of the results page ('render'). 'total' is the whole call.
+
+    The application is built from the test corpus with BenchConfig like the one of tests/test_routes.py, so nothing is
+    read from or written to the production corpus and cache.
+"""
+from config import Config
+from capitains_nautilus.cts.resolver import NautilusCTSResolver
+from formulae import create_app
+from formulae.dispatcher_builder import organizer
+from formulae.nemo import NemoFormulae
+from formulae.search import Search, routes
+from .fake_es import FakeElasticsearch
+from collections import defaultdict
+from contextlib import ExitStack
+from functools import wraps
+from glob import glob
+from json import dumps, loads
+from time import perf_counter
+from unittest.mock import patch
+from tempfile import mkdtemp
+from urllib.parse import urlencode
+import argparse
+import os
+import shutil
+
+MOCK_DIR = os.path.join(os.path.dirname(__file__), 'test_data', 'advanced_search', '__mocks__', '_search')
+PERCENTILES = [50, 90, 99]
+REPEATS = 20
+
+
+class BenchConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    CORPUS_FOLDERS = ["tests/test_data/cjhnt"]
+    WTF_CSRF_ENABLED = False
+    LOGIN_DISABLED = True
+    SAVE_REQUESTS = False
+    PASSAGE_CACHE_MAX_SIZE = 0
+    # Every search should reach the stand-in for Elasticsearch so that the whole path is measured
+    ELASTICSEARCH_URL = None
+    LOCAL_SEARCH = False
+    SEARCH_CACHE_MAX_ENTRIES = 0
+    SEARCH_PREFETCH_PAGES = 0
+    # The autocomplete vocabulary is written here instead of into the working tree
+    CACHE_DIRECTORY = mkdtemp(prefix='cjhnt-nemo-bench-')
+
+
+def build_app():
+    """ The application and its Nemo instance for the test corpus, built the same way as in tests/test_routes.py"""
+    app = create_app(BenchConfig)
+    nemo = NemoFormulae(name="InstanceNemo", resolver=NautilusCTSResolver(app.config['CORPUS_FOLDERS'],
+                                                                         dispatcher=organizer),
+                        app=app, base_url="", transform={"default": "components/epidoc.xsl",
+                                                         "notes": "components/extract_notes.xsl"},
+                        templates={"main": "templates/main",
+                                   "errors": "templates/errors",
+                                   "auth": "templates/auth",
+                                   "search": "templates/search"},
+                        css=["assets/css/theme.css"], js=["assets/js/empty.js"], static_folder="./assets/")
+    return app, nemo
+
+
+class ReplayElasticsearch(object):
+    """ Answers searches with the recorded responses. A request that was not recorded, e.g., from a query log, is
+        answered with a recorded response for the same field so that the highlighting still has work to do.
+    """
+
+    def __init__(self, recordings):
+        self.responses = dict()
+        self.by_field = defaultdict(list)
+        for name, args in recordings:
+            fake = FakeElasticsearch(name, 'advanced_search')
+            if not os.path.isfile(fake.buildPath('_resp.json')):
+                continue
+            response = fake.load_response()
+            self.responses[self.key(fake.load_request())] = response
+            self.by_field[args['field']].append(response)
+
+    @staticmethod
+    def key(body):
+        return dumps(body, sort_keys=True, ensure_ascii=False)
+
+    @staticmethod
+    def field(body):
+        query = dumps(body.get('query', {}), ensure_ascii=False)
+        for field in ['autocomplete_lemmas', 'autocomplete', 'lemmas']:
+            if '"{}"'.format(field) in query:
+                return field
+        return 'text'
+
+    def search(self, index=None, doc_type='', body=None):
+        if self.key(body) in self.responses:
+            return self.responses[self.key(body)]
+        candidates = self.by_field.get(self.field(body)) or [{'hits': {'total': 0, 'hits': []},
+                                                                'aggregations': {'corpus': {'buckets': {}}}}]
+        return candidates[len(self.key(body)) % len(candidates)]
+
+
+class StageTimer(object):
+    """ Collects how long each stage takes in every call to an entry point. A stage that runs several times during
+        one call, e.g., the lemma matching for each hit, is recorded as the sum of its durations.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.current = defaultdict(float)
+        self.started = None
+
+    def run(self, entry, function, *args, **kwargs):
+        self.current.clear()
+        self.started = perf_counter()
+        start = self.started
+        result = function(*args, **kwargs)
+        self.current['total'] = perf_counter() - start
+        for stage, seconds in self.current.items():
+            self.samples[entry, stage].append(seconds)
+        return result
+
+    def stage(self, name, function, first=None):
+        """ Wrap function so that its duration is recorded as stage name. If first is given, the time from the start
+            of the entry point until the first call of function is recorded as that stage.
+        """
+        @wraps(function)
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            if first and self.started is not None:
+                self.current[first] += start - self.started
+                self.started = None
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.current[name] += perf_counter() - start
+        return timed
+
+    def restart(self, function):
+        """ Wrap a search function that is called from a view so that the body is timed from when it is called"""
+        @wraps(function)
+        def restarted(*args, **kwargs):
+            self.started = perf_counter()
+            return function(*args, **kwargs)
+        return restarted
+
+    def report(self):
+        for (entry, stage), values in sorted(self.samples.items()):
+            values = sorted(values)
+            result = {'benchmark': 'search', 'entry': entry, 'stage': stage, 'samples': len(values)}
+            for p in PERCENTILES:
+                result['p{}'.format(p)] = values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+            yield result
+
+
+def recorded_searches():
+    """ The arguments of the recorded searches, parsed from the names of their files"""
+    for path in sorted(glob(os.path.join(MOCK_DIR, '*_req.json'))):
+        name = os.path.basename(path)[:-len('_req.json')]
+        corpus, field, q, fuzziness, in_order, slop, sort = name.split('&')
+        yield name, {'corpus': corpus, 'field': field, 'q': q.replace('+', ' '), 'fuzziness': fuzziness,
+                     'in_order': in_order, 'slop': slop, 'sort': sort}
+
+
+def logged_searches(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                args = loads(line)
+                yield None, {'corpus': args.get('corpus', 'all'), 'q': args.get('q', ''),
+                             'field': 'lemmas' if args.get('lemma_search') == 'y' else args.get('field', 'text'),
+                             'fuzziness': args.get('fuzziness', '0'), 'in_order': args.get('in_order', 'False'),
+                             'slop': args.get('slop', '0'), 'sort': args.get('sort', 'urn')}
+
+
+def replay(flask_app, searches, repeats, timer):
+    client = flask_app.test_client()
+    per_page = flask_app.config['POSTS_PER_PAGE']
+    for _ in range(repeats):
+        for _, args in searches:
+            corpus = args['corpus'].split('+')
+            with flask_app.test_request_context():
+                if args['field'].startswith('autocomplete'):
+                    timer.run('autocomplete', flask_app.autocompleter.complete, args['q'], field=args['field'],
+                              corpora=corpus, fuzziness=args['fuzziness'])
+                    continue
+                timer.run('advanced_query_index', Search.advanced_query_index, corpus=corpus, **{
+                    k: v for k, v in args.items() if k != 'corpus'})
+                if args['field'] == 'text':
+                    timer.run('query_index', Search.query_index, corpus, 'text', args['q'], 1, per_page,
+                              sort=args['sort'])
+            query = {'source': 'advanced', 'corpus': args['corpus'], 'q': args['q'], 'fuzziness': args['fuzziness'],
+                     'in_order': args['in_order'], 'slop': args['slop'], 'sort': args['sort']}
+            if args['field'] == 'lemmas':
+                query['lemma_search'] = 'y'
+            timer.run('r_results', client.get, '/search/results?' + urlencode(query))
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Replay searches and report the latency of each stage')
+    parser.add_argument('--log', help='a file with the r_results arguments of one search per line')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    options = parser.parse_args()
+    recordings = list(recorded_searches())
+    searches = list(logged_searches(options.log)) if options.log else recordings
+    timer = StageTimer()
+    with ExitStack() as stack:
+        stack.callback(shutil.rmtree, BenchConfig.CACHE_DIRECTORY, ignore_errors=True)
+        flask_app, nemo = build_app()
+        flask_app.elasticsearch = ReplayElasticsearch(recordings)
+        stack.enter_context(patch.object(Search, 'search_index', timer.stage('es_call', Search.search_index,
+                                                                             first='body')))
+        stack.enter_context(patch.object(Search, 'build_snippets', timer.stage('highlighting', Search.build_snippets)))
+        stack.enter_context(patch.object(Search, 'find_lemma_matches',
+                                         timer.stage('lemma_alignment', Search.find_lemma_matches)))
+        stack.enter_context(patch.object(Search, 'lemma_snippet', timer.stage('lemma_alignment', Search.lemma_snippet)))
+        stack.enter_context(patch.object(routes, 'query_index', timer.restart(routes.query_index)))
+        stack.enter_context(patch.object(routes, 'advanced_query_index', timer.restart(routes.advanced_query_index)))
+        stack.enter_context(patch.object(nemo, 'render', timer.stage('render', nemo.render)))
+        replay(flask_app, searches, options.repeats, timer)
+    for result in timer.report():
+        print(dumps(result))
+
+
+if __name__ == '__main__':
+    run()
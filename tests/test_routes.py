@@ -2,8 +2,15 @@ from config import Config
 from capitains_nautilus.cts.resolver import NautilusCTSResolver
 from formulae import create_app, db, mail
 from formulae.nemo import NemoFormulae
-from formulae.models import User
-from formulae.search.Search import advanced_query_index, query_index, build_sort_list, suggest_word_search
+from formulae.rendering import serialize, add_word_spacing, mark_cited_words
+from formulae.passage_cache import PassageCache, content_hash
+from formulae.passage_tables import PassageTable, write_table
+from formulae.corpus_snapshot import CorpusSnapshot
+from formulae.lazy_resolver import LazyCapitainsResolver, ParsedTreeCache, parse_header
+from MyCapytain.common.constants import get_graph, set_graph
+from formulae.models import User, NtComRels
+from formulae.search.Search import advanced_query_index, query_index, build_sort_list, \
+    SOURCE_FIELDS, highlight_segment
 from formulae.dispatcher_builder import organizer
 import flask_testing
 from formulae.search.forms import AdvancedSearchForm, SearchForm
@@ -11,15 +18,29 @@ from formulae.auth.forms import LoginForm, PasswordChangeForm, LanguageChangeFor
     ResetPasswordRequestForm, RegistrationForm, ValidationError
 from flask_login import current_user
 from flask_babel import _
-from elasticsearch import Elasticsearch
-from unittest.mock import patch
+from elasticsearch import Elasticsearch, ConnectionTimeout
+from unittest.mock import patch, MagicMock
 from .fake_es import FakeElasticsearch
 from collections import OrderedDict
 import os
+import shutil
 from MyCapytain.common.constants import Mimetypes
+from rdflib.namespace import DC
 from flask import Markup, url_for, abort
 import re
 from math import ceil
+from lxml import etree
+from tempfile import TemporaryDirectory, mkdtemp
+from concurrent.futures import ThreadPoolExecutor
+from formulae.search.cache import SearchCache, SharedSearchStore
+from formulae.search.lemmas import align_lemmas
+from formulae.search.autocomplete import Autocompleter
+from formulae.search.local import LocalSearch, build_index, read_documents
+from formulae.search.indexer import CorpusIndexer
+from formulae.search.snippets import build_snippets, encode_result_sents, decode_result_sents, decode_result_code
+from urllib.parse import quote
+import json
+from time import time
 
 
 class TestConfig(Config):
@@ -27,11 +48,18 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     CORPUS_FOLDERS = ["tests/test_data/cjhnt"]
     WTF_CSRF_ENABLED = False
+    PASSAGE_CACHE_MAX_SIZE = 0
+    # The snapshot, the compiled tables and the search index are written here instead of into the working tree
+    CACHE_DIRECTORY = mkdtemp(prefix='cjhnt-nemo-tests-')
     SQLALCHEMY_BINDS = {
         'appmeta':      'sqlite:///./{}/appmeta.db'.format(CORPUS_FOLDERS[0])
     }
 
 
+def tearDownModule():
+    shutil.rmtree(TestConfig.CACHE_DIRECTORY, ignore_errors=True)
+
+
 class Formulae_Testing(flask_testing.TestCase):
     def create_app(self):
 
@@ -81,6 +109,226 @@ class TestFunctions(Formulae_Testing):
         test_list = self.nemo.f_replace_indexed_item(old_list, 3, 4)
         self.assertEqual(test_list, new_list)
 
+    def test_stylesheets_compiled_once(self):
+        """ Make sure that the XSL stylesheets are compiled at startup and then reused for every passage"""
+        self.assertEqual(set(self.nemo.stylesheets.compile_times), {'default', 'notes'})
+        notes_xslt = self.nemo.stylesheets.get('notes')
+        with self.app.test_request_context():
+            self.nemo.r_passage('urn:cts:cjhnt:nt.86-Jud.grc001', '1.1')
+            self.nemo.r_passage('urn:cts:cjhnt:nt.86-Jud.grc001', '1.2')
+        self.assertIs(self.nemo.stylesheets.get('notes'), notes_xslt)
+        self.assertEqual(self.nemo.stylesheets.stats['notes']['hits'], 3)
+        self.assertEqual(self.nemo.stylesheets.stats['default']['hits'], 2)
+
+    def test_nt_commentary_link(self):
+        """ Make sure that the commentary sections are compiled per verse and linked to the correct words"""
+        sections = {'urn:cts:cjhnt:nt.86-Jud.grc001': {'1': {'1': {'1': [], '2': [['urn:a', '1.1'], ['urn:b', '2']]},
+                                                             '2': {'1': []}}}}
+        compiled = self.nemo.compile_nt_commentary_sections(sections)
+        self.assertEqual(compiled, {'urn:cts:cjhnt:nt.86-Jud.grc001': {'1.1': {'2': 'urn:a;1.1%urn:b;2'}}})
+        self.nemo.nt_commentary_sections = compiled
+        root = etree.fromstring('<div><span class="w" wordnum="1">a</span><span class="w" wordnum="2">b</span></div>')
+        self.nemo.nt_commentary_link('urn:cts:cjhnt:nt.86-Jud.grc001', '1.1', root)
+        self.assertIsNone(root[0].get('comm-passages'))
+        self.assertEqual(root[1].get('class'), 'w commentary-word')
+        self.assertEqual(root[1].get('comm-passages'), 'urn:a;1.1%urn:b;2')
+        # Verses without linked words should be left untouched
+        self.nemo.nt_commentary_link('urn:cts:cjhnt:nt.86-Jud.grc001', '1.2', root)
+        self.nemo.nt_commentary_link('urn:cts:cjhnt:nt.86-Jud.grc001', '1.1-1.20', root)
+
+    def test_commentary_index(self):
+        """ Make sure that the NT-commentary relations are indexed in both directions and reloaded when they change"""
+        jude = 'urn:cts:cjhnt:nt.86-Jud.grc001'
+        com = 'urn:cts:greekLit:commentary.tlg0042006.opp-grc1'
+        cjhnt_com = 'urn:cts:cjhnt:commentary.tlg0042006.opp-grc1'
+        db.session.add_all([NtComRels(nt=jude + ':1.1', com=com + ':1'), NtComRels(nt=jude + ':1.1', com=com + ':2'),
+                            NtComRels(nt=jude + ':1.10', com=com + ':3'), NtComRels(nt=jude + ':1.2', com=com + ':2')])
+        db.session.commit()
+        index = self.nemo.commentary_index
+        self.assertTrue(index._loaded, 'The relations should be loaded on startup')
+        # The database is checked for changes on every lookup
+        index.REFRESH_INTERVAL = 0
+        self.assertEqual(index.commentaries(jude, '1.1'), [(cjhnt_com, '1'), (cjhnt_com, '2')])
+        self.assertEqual(index.commentaries(jude, '1'), [(cjhnt_com, '1'), (cjhnt_com, '2'), (cjhnt_com, '3')])
+        self.assertEqual(index.commentaries(jude, '1.2-1.9'), [(cjhnt_com, '2')])
+        self.assertEqual(index.nt_passages(cjhnt_com, '2'), [(jude, '1.1'), (jude, '1.2')])
+        self.assertEqual(index.commentaries(jude, '2'), [])
+        db.session.add(NtComRels(nt=jude + ':1.3', com=com + ':4'))
+        db.session.commit()
+        self.assertEqual(index.commentaries(jude, '1.3'), [(cjhnt_com, '4')])
+        self.assertIs(self.nemo.nt_commentary_sections, index.sections)
+
+    def test_passage_tables(self):
+        """ Make sure that the JSON files of all corpus folders are merged and compiled into memory-mapped tables"""
+        jude = 'urn:cts:cjhnt:nt.86-Jud.grc001'
+        joel = 'urn:cts:greekLit:tlg0527.tlg039.1st1K-grc1'
+        with TemporaryDirectory() as tmp_dir:
+            files = []
+            for i, parallels in enumerate([{jude: {'1.1': [[joel, '1.1']]}},
+                                           {jude: {'1.1': [[joel, '1.1'], [joel, '2.1']], '1.2': []}}]):
+                files.append(os.path.join(tmp_dir, '{}.json'.format(i)))
+                with open(files[-1], 'w') as f:
+                    json.dump(parallels, f)
+            with patch.dict(self.app.config, {'TEXT_PARALLELS': files, 'CACHE_DIRECTORY': tmp_dir}):
+                table = self.nemo.load_external_table('TEXT_PARALLELS')
+            self.assertEqual(table[jude]['1.1'], [(joel, '1.1'), (joel, '2.1')])
+            self.assertEqual(table.get(jude).get('1.2'), [])
+            self.assertIsNone(table.get(jude).get('1.3'))
+            self.assertIsNone(table.get(joel))
+            self.assertEqual(list(table), [jude])
+            sections_path = os.path.join(tmp_dir, 'sections.bin')
+            write_table(sections_path, self.nemo.compile_nt_commentary_sections(
+                {jude: {'1': {'1': {'1': [], '2': [['urn:a', '1.1'], ['urn:b', '2']]}}}}))
+            self.nemo.nt_commentary_sections = PassageTable(sections_path)
+            root = etree.fromstring('<div><span class="w" wordnum="1">a</span><span class="w" wordnum="2">b</span></div>')
+            self.nemo.nt_commentary_link(jude, '1.1', root)
+            self.assertIsNone(root[0].get('comm-passages'))
+            self.assertEqual(root[1].get('comm-passages'), 'urn:a;1.1%urn:b;2')
+
+    def test_parallel_labels(self):
+        """ Make sure that the titles of the parallel texts are resolved once when the parallels are loaded"""
+        jude = 'urn:cts:cjhnt:nt.86-Jud.grc001'
+        joel = 'urn:cts:greekLit:tlg0527.tlg039.1st1K-grc1'
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'parallels.bin')
+            write_table(path, {jude: {'1.1': [[joel, '1.1'], [joel, '2.1']], '1.2': [[joel, '3.1']]}})
+            self.nemo.parallel_texts = PassageTable(path)
+            metadata = self.nemo.get_collection(joel).metadata
+            title = str(metadata.get_single(DC.title, lang='eng'))
+            with patch.object(self.nemo, 'get_collection', wraps=self.nemo.get_collection) as mock_get:
+                self.nemo.parallel_titles = self.nemo.load_parallel_titles()
+                self.assertEqual(mock_get.call_count, 1)
+                self.assertEqual(self.nemo.get_parallels(jude, '1.1', lang='eng'),
+                                 [(joel, '1.1', title + ' 1.1'), (joel, '2.1', title + ' 2.1')])
+                self.assertEqual(self.nemo.get_parallels(jude, '1.2', lang='eng'), [(joel, '3.1', title + ' 3.1')])
+                self.assertEqual(self.nemo.get_parallels(jude, '1.3', lang='eng'), [])
+                self.assertEqual(self.nemo.get_parallels(jude, '1.2', lang='fre'),
+                                 [(joel, '3.1', str(metadata.get_single(DC.title, lang='fre')) + ' 3.1')])
+                self.assertEqual(mock_get.call_count, 1)
+
+    def test_passage_cache(self):
+        """ Make sure that rendered passages are stored on disk and are dropped when the corpus version changes"""
+        with TemporaryDirectory() as cache_dir:
+            cache = PassageCache(cache_dir, 'version1', 1000)
+            key = cache.make_key('urn:cts:cjhnt:nt.86-Jud.grc001', '1.1', 'eng', None, None)
+            self.assertIsNone(cache.get(key))
+            cache.set(key, {'text_passage': '<div/>', 'prev': None})
+            self.assertEqual(cache.get(key), {'text_passage': '<div/>', 'prev': None})
+            # A second cache object, e.g., in another worker, shares the stored passages
+            self.assertEqual(PassageCache(cache_dir, 'version1', 1000).get(key), {'text_passage': '<div/>', 'prev': None})
+            self.assertIsNone(PassageCache(cache_dir, 'version2', 1000).get(key))
+            # The least recently used passages are evicted when the cache grows beyond its maximum size
+            cache = PassageCache(cache_dir, 'version2', 150)
+            cache.ACCESS_INTERVAL = 0
+            cache.set('a', {'text_passage': 'a' * 40})
+            cache.set('b', {'text_passage': 'b' * 40})
+            cache.get('a')
+            cache.set('c', {'text_passage': 'c' * 40})
+            self.assertIsNone(cache.get('b'))
+            self.assertIsNotNone(cache.get('a'))
+            self.assertIsNotNone(cache.get('c'))
+            # The total size is kept up to date without adding up the entries
+            cache.set('a', {'text_passage': 'a' * 20})
+            self.assertEqual(cache.connection.execute('SELECT size FROM total').fetchone()[0],
+                             cache.connection.execute('SELECT TOTAL(size) FROM passages').fetchone()[0])
+        self.assertEqual(content_hash(['components']), content_hash(['components']))
+        self.assertNotEqual(content_hash(['components']), content_hash(['components/epidoc.xsl']))
+
+    def test_get_passages(self):
+        """ Make sure that passages retrieved in a batch are the same as those retrieved one by one"""
+        passages = [('urn:cts:cjhnt:nt.86-Jud.grc001', '1.1'), ('urn:cts:cjhnt:nt.86-Jud.grc001', None),
+                    ('urn:cts:cjhnt:nt.86-Jud.grc001', '1.25')]
+        with self.client:
+            self.client.get('/lang/en', follow_redirects=True)
+            batch = self.nemo.get_passages(passages, lang='eng')
+            single = [self.nemo.r_passage('urn:cts:cjhnt:nt.86-Jud.grc001', subref, lang='eng')
+                      for subref in ['1.1', '1.1-1.20', '1.25']]
+            self.app.config['PASSAGE_RENDER_THREADS'] = 4
+            threaded = self.nemo.get_passages(passages, lang='eng')
+        for key in ['text_passage', 'notes', 'prev', 'next']:
+            self.assertEqual([x[key] for x in batch], [x[key] for x in single])
+            self.assertEqual([x[key] for x in threaded], [x[key] for x in single])
+
+    def test_get_passages_threaded(self):
+        """ Make sure that passages of several texts rendered in parallel are returned in the order of the request and
+            that an error in one of the texts is raised"""
+        jude = 'urn:cts:cjhnt:nt.86-Jud.grc001'
+        joel = 'urn:cts:greekLit:tlg0527.tlg039.1st1K-grc1'
+        passages = [(jude, '1.1'), (joel, '1.1'), (jude, '1.25'), (joel, None)]
+        with self.client:
+            self.client.get('/lang/en', follow_redirects=True)
+            self.app.config['PASSAGE_RENDER_THREADS'] = 1
+            serial = self.nemo.get_passages(passages, lang='eng')
+            self.app.config['PASSAGE_RENDER_THREADS'] = 4
+            with patch('formulae.nemo.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as mock_executor:
+                threaded = self.nemo.get_passages(passages, lang='eng')
+                mock_executor.assert_called_once_with(max_workers=2)
+            for key in ['objectId', 'subreference', 'text_passage', 'notes', 'prev', 'next']:
+                self.assertEqual([x[key] for x in threaded], [x[key] for x in serial])
+            r_passage = self.nemo.r_passage
+
+            def fail_for_joel(objectId, *args, **kwargs):
+                if objectId == joel:
+                    raise ValueError(objectId)
+                return r_passage(objectId, *args, **kwargs)
+
+            with patch.object(self.nemo, 'r_passage', side_effect=fail_for_joel):
+                with self.assertRaises(ValueError):
+                    self.nemo.get_passages(passages, lang='eng')
+
+    def test_reffs_index(self):
+        """ Make sure that the reference index returns the same references and siblings as the resolver"""
+        objectId = 'urn:cts:cjhnt:nt.86-Jud.grc001'
+        index = self.nemo.get_reffs_index(objectId)
+        self.assertIs(self.nemo.get_reffs_index(objectId), index)
+        self.assertEqual(list(index.levels[0]), [str(x) for x in self.nemo.resolver.getReffs(objectId)])
+        self.assertEqual(index.children('1'), [str(x) for x in self.nemo.resolver.getReffs(objectId, subreference='1')])
+        self.assertEqual(index.children('1.1'), [])
+        self.assertEqual(index.first, '1.1-1.20')
+        self.assertEqual(index.siblings('1.1-1.20'), (None, '1.21-1.25'))
+        self.assertIsNone(index.siblings('1.5'))
+        passage = self.nemo.get_passage(objectId, '1.5')
+        self.assertEqual(self.nemo.get_siblings(objectId, '1.5', passage), passage.siblingsId)
+
+    def test_corpus_snapshot(self):
+        """ Make sure that the corpus metadata snapshot is restored when it is fresh and ignored when it is stale"""
+        graph = get_graph()
+        with TemporaryDirectory() as cache_dir:
+            self.nemo.snapshot = CorpusSnapshot(cache_dir, NemoFormulae.corpus_paths(self.app.config))
+            self.nemo.write_snapshot()
+            snapshot = CorpusSnapshot(cache_dir, NemoFormulae.corpus_paths(self.app.config))
+            self.assertTrue(snapshot.load())
+            self.assertEqual(snapshot.data['sub_colls'], self.nemo.sub_colls)
+            self.assertEqual(snapshot.data['reffs_indices']['urn:cts:cjhnt:nt.86-Jud.grc001'].chunks,
+                             self.nemo.get_reffs_index('urn:cts:cjhnt:nt.86-Jud.grc001').chunks)
+            self.assertEqual(str(snapshot.resolver.getMetadata('urn:cts:cjhnt:nt.86-Jud.grc001').get_label('eng')),
+                             str(self.nemo.resolver.getMetadata('urn:cts:cjhnt:nt.86-Jud.grc001').get_label('eng')))
+            self.assertEqual(self.nemo.get_first_passage('urn:cts:cjhnt:nt.86-Jud.grc001'), '1.1-1.20')
+            self.assertFalse(CorpusSnapshot(cache_dir, ['components']).load())
+            self.assertIn('write_snapshot', self.nemo.startup_timer.times)
+        set_graph(graph)
+
+    def test_parsed_tree_cache(self):
+        """ Make sure that the lazy resolver reads only the TEI headers at startup and keeps parsed texts within budget"""
+        jude = 'tests/test_data/cjhnt/data/nt/86-Jud/nt.86-Jud.grc001.xml'
+        with open(jude) as f:
+            header = parse_header(f)
+        self.assertEqual(header.xpath('//tei:text', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}), [])
+        self.assertEqual(len(header.xpath('//tei:refsDecl', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})), 1)
+        cache = ParsedTreeCache(os.stat(jude).st_size * ParsedTreeCache.TREE_SIZE_FACTOR)
+        tree = cache.get(jude, lambda: etree.parse(jude))
+        self.assertIs(cache.get(jude, lambda: etree.parse(jude)), tree)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        salzburg = 'tests/test_data/cjhnt/data/salzburg/hauthaler-a0001/salzburg.hauthaler-a0001.lat001.xml'
+        cache.get(salzburg, lambda: etree.parse(salzburg))
+        self.assertEqual(len(cache), 1, 'The least recently used tree should be dropped when the budget is exceeded')
+        self.assertLessEqual(cache.size, cache.max_size)
+        resolver = LazyCapitainsResolver(self.app.config['CORPUS_FOLDERS'])
+        self.assertEqual(len(resolver.trees), 0)
+        self.assertEqual([str(x) for x in resolver.getReffs('urn:cts:cjhnt:nt.86-Jud.grc001')],
+                         [str(x) for x in self.nemo.resolver.getReffs('urn:cts:cjhnt:nt.86-Jud.grc001')])
+        self.assertEqual(len(resolver.trees), 1)
+
 
 class TestIndividualRoutes(Formulae_Testing):
     def test_anonymous_user(self):
@@ -264,17 +512,45 @@ class TestIndividualRoutes(Formulae_Testing):
         expected = '<span class="searched"><span class="w searched-start">Text</span><span class="w searched-end">that</span></span></p><p><span class="searched"><span class="w searched-start searched-end">I</span></span></p><p><span class="searched"><span class="w searched-start">want</span><span class="w">to</span><span class="w searched-end">search</span></span>'
         obj_id = 'urn:cts:formulae:salzburg.hauthaler-a0001.lat001'
         xml = self.nemo.get_passage(objectId=obj_id, subreference='1')
-        html_input = Markup(self.nemo.transform(xml, xml.export(Mimetypes.PYTHON.ETREE), obj_id))
-        result = self.nemo.highlight_found_sents(html_input, search_string)
-        self.assertIn(expected, result)
+        root = self.nemo.transform_tree(xml, xml.export(Mimetypes.PYTHON.ETREE), obj_id)
+        self.nemo.highlight_found_sents(root, search_string)
+        self.assertIn(expected, serialize(root))
         # Should be able to deal with editorial punctuation in the text
         search_string = ['Text with special editorial signs in it']
         expected = '<span class="searched"><span class="w searched-start">Text</span><span class="w">with</span><span class="w">sp&lt;e&gt;cial</span><span class="w">[edi]torial</span><span class="w">[signs</span><span class="w">in</span><span class="w searched-end">i]t</span></span>'
         obj_id = 'urn:cts:formulae:salzburg.hauthaler-a0001.lat001'
         xml = self.nemo.get_passage(objectId=obj_id, subreference='1')
-        html_input = Markup(self.nemo.transform(xml, xml.export(Mimetypes.PYTHON.ETREE), obj_id))
-        result = self.nemo.highlight_found_sents(html_input, search_string)
-        self.assertIn(expected, result)
+        root = self.nemo.transform_tree(xml, xml.export(Mimetypes.PYTHON.ETREE), obj_id)
+        self.nemo.highlight_found_sents(root, search_string)
+        self.assertIn(expected, serialize(root))
+
+    def test_passage_pipeline_stages(self):
+        """ Make sure that the rendering stages work on the passage tree without re-parsing it"""
+        root = etree.fromstring('<div><p><span class="w" wordnum="1">a</span><span class="w" wordnum="2">b</span>'
+                                '<span class="w" wordnum="3">c</span></p></div>')
+        add_word_spacing(root)
+        mark_cited_words(root, range(2, 4))
+        self.assertEqual(serialize(root), '<div><p><span class="w" wordnum="1">a</span> '
+                                          '<span class="w cited-word" wordnum="2">b</span> '
+                                          '<span class="w cited-word" wordnum="3">c</span></p></div>')
+
+    def test_highlight_after_punctuation(self):
+        """ Make sure that words consisting only of punctuation do not shift the highlighting of later words"""
+        root = etree.fromstring('<div><p><span class="w">a</span><span class="w">,</span><span class="w">b</span>'
+                                '<span class="w">c</span><span class="w">d</span></p></div>')
+        self.nemo.highlight_found_sents(root, ['b c', 'x y', ''])
+        self.assertEqual(serialize(root), '<div><p><span class="w">a</span><span class="w">,</span>'
+                                          '<span class="searched"><span class="w searched-start">b</span>'
+                                          '<span class="w searched-end">c</span></span><span class="w">d</span></p></div>')
+
+    def test_highlight_overlapping_sentences(self):
+        """ Make sure that sentences that overlap are highlighted in a single run instead of nested ones"""
+        root = etree.fromstring('<div><p><span class="w">a</span><span class="w">b</span><span class="w">c</span>'
+                                '<span class="w">d</span><span class="w">e</span></p></div>')
+        self.nemo.highlight_found_sents(root, ['a b c', 'b c d'])
+        self.assertEqual(serialize(root), '<div><p><span class="searched"><span class="w searched-start">a</span>'
+                                          '<span class="w">b</span><span class="w">c</span>'
+                                          '<span class="w searched-end">d</span></span><span class="w">e</span></p></div>')
 
     def test_convert_result_sents(self):
         """ Make sure that search result_sents are converted correctly"""
@@ -283,6 +559,75 @@ class TestIndividualRoutes(Formulae_Testing):
         expected = ['Anno XXV pos regnum domni nistri Lodoici regis in', 'Notavimus die et regnum superscripsi Signum Petrone']
         self.assertEqual(output, expected)
 
+    def test_conditional_get(self):
+        """ Make sure that passages that the client already has are answered with 304 before they are rendered"""
+        url = '/texts/urn:cts:cjhnt:nt.86-Jud.grc001/passage/1.1'
+        with patch.dict(self.app.config['ROUTE_MAX_AGE'], {'r_multipassage': 300}), self.client as c:
+            c.post('/auth/login', data=dict(username='project.member', password="some_password"),
+                   follow_redirects=True)
+            response = c.get(url)
+            etag = response.headers['ETag']
+            self.assertEqual(response.cache_control.max_age, 300)
+            with patch.object(self.nemo, 'get_passages') as mock_get_passages:
+                response = c.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.headers['ETag'], etag)
+                mock_get_passages.assert_not_called()
+            self.assertNotEqual(c.get(url + '?sents=abc').headers['ETag'], etag)
+            # A new version of the templates or the code gets a new tag
+            with patch.object(self.nemo, 'app_version', 'other'):
+                self.assertEqual(c.get(url, headers={'If-None-Match': etag}).status_code, 200)
+            # Errors are not tagged
+            response = c.get('/texts/urn:cts:cjhnt:newtestament/passage/1.1')
+            self.assert404(response)
+            self.assertIsNone(response.headers.get('ETag'))
+            c.get('/lang/en')
+            response = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200, 'The ETag should change with the locale')
+            c.get('/auth/logout')
+            response = c.get(url, headers={'If-None-Match': etag})
+            self.assertNotIn(response.status_code, [200, 304])
+            self.assertNotIn('ETag', c.get('/auth/login').headers)
+
+    def test_fragment_caching(self):
+        """ Make sure that with FRAGMENT_CACHING the passage page includes its passages and notes as fragments that
+            are the same for every reader outside of the project team and expire"""
+        url = '/texts/urn:cts:cjhnt:nt.86-Jud.grc001/passage/1.1'
+        with patch.dict(self.app.config, {'FRAGMENT_CACHING': True}), \
+                patch.dict(self.app.config['ROUTE_MAX_AGE'], {'r_passage_fragment': 300}), self.client as c:
+            c.post('/auth/login', data=dict(username='project.member', password="some_password"),
+                   follow_redirects=True)
+            response = c.get(url)
+            self.assertTemplateUsed('main::multipassage.html')
+            self.assertNotIn('Surrogate-Control', response.headers)
+            self.assertNotIn('<esi:include', response.get_data(as_text=True))
+            c.get('/auth/logout')
+            c.post('/auth/login', data=dict(username='not.project', password="some_other_password"),
+                   follow_redirects=True)
+            with patch.object(self.nemo, 'get_passages') as mock_get_passages:
+                response = c.get(url)
+                mock_get_passages.assert_not_called()
+            self.assertTemplateUsed('main::multipassage.html')
+            self.assertEqual(response.headers['Surrogate-Control'], 'content="ESI/1.0"')
+            passage_url, notes_url = [x.replace('&amp;', '&') for x in
+                                      re.findall(r'<esi:include src="([^"]+)"', response.get_data(as_text=True))]
+            self.assertIn('part=passage', passage_url)
+            self.assertIn('part=notes', notes_url)
+            c.get('/auth/logout')
+            response = c.get(passage_url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTemplateUsed('main::passage_fragment.html')
+            self.assertEqual(response.cache_control.max_age, 300)
+            self.assertNotIn('Cookie', response.vary)
+            self.assertNotIn('Set-Cookie', response.headers)
+            self.assertEqual(c.get(passage_url, headers={'If-None-Match': response.headers['ETag']}).status_code, 304)
+            c.get(notes_url)
+            self.assertTemplateUsed('main::notes.html')
+            self.assertEqual(c.get(passage_url.replace('/passage/1.1', '/passage/1.2')).status_code, 403)
+            self.assertEqual(c.get(re.sub(r'access=[^&]+', 'access=abc', passage_url)).status_code, 403)
+            with patch('formulae.nemo.time', return_value=time() + 3 * self.nemo.fragment_period):
+                self.assertEqual(c.get(passage_url).status_code, 403, 'The fragment URLs should expire')
+
 
 class TestForms(Formulae_Testing):
     def test_validate_success_login_form(self):
@@ -582,6 +927,113 @@ class TestES(Formulae_Testing):
         mock_search.assert_called_with(index=test_args['corpus'], doc_type="", body=body)
         self.assertEqual(ids, [{"id": x['id']} for x in actual])
 
+    @patch.object(Elasticsearch, "search")
+    def test_search_cache(self, mock_search):
+        """ Make sure that a repeated search is answered from the search cache without a request to Elasticsearch"""
+        test_args = OrderedDict([("corpus", "nt+tlg0527"), ("field", "text"), ("q", 'λόγος'), ("fuzziness", "0"),
+                                 ("in_order", "False"), ('slop', '0'), ('sort', 'urn')])
+        fake = FakeElasticsearch(self.build_file_name(test_args), 'advanced_search')
+        mock_search.return_value = fake.load_response()
+        test_args['corpus'] = test_args['corpus'].split('+')
+        first, _, _ = advanced_query_index(**test_args)
+        test_args['corpus'] = list(reversed(test_args['corpus']))
+        second, _, _ = advanced_query_index(**test_args)
+        self.assertEqual(mock_search.call_count, 1, 'The second search should come from the cache.')
+        self.assertEqual(first, second)
+        self.assertEqual(self.app.search_cache.stats, {'entries': 1, 'hits': 1, 'shared_hits': 0, 'misses': 1})
+        with TemporaryDirectory() as cache_dir:
+            shared = SharedSearchStore(cache_dir, 10)
+            worker_1, worker_2 = SearchCache(10, 60, shared=shared), SearchCache(10, 60, shared=shared)
+            key = SearchCache.make_key(['nt', 'tlg0527'], {'query': {'match_all': {}}, 'size': 10})
+            self.assertEqual(key, SearchCache.make_key(['tlg0527', 'nt'], {'size': 10, 'query': {'match_all': {}}}))
+            worker_1.set(key, {'hits': {'total': 0, 'hits': []}})
+            self.assertEqual(worker_2.get(key), {'hits': {'total': 0, 'hits': []}})
+            self.assertEqual(worker_2.shared_hits, 1)
+            expired = SearchCache(1, 0)
+            expired.set(key, {'hits': {'total': 0, 'hits': []}})
+            self.assertIsNone(expired.get(key))
+
+    @patch.object(Elasticsearch, "open_point_in_time", return_value={'id': 'pit'})
+    @patch.object(Elasticsearch, "search")
+    def test_aggregations_only_on_first_page(self, mock_search, mock_pit):
+        """ Make sure that the aggregations of a query are only requested with the first page of its results"""
+        test_args = OrderedDict([("corpus", "nt+tlg0527"), ("field", "text"), ("q", 'λόγος'), ("fuzziness", "0"),
+                                 ("in_order", "False"), ('slop', '0'), ('sort', 'urn')])
+        fake = FakeElasticsearch(self.build_file_name(test_args), 'advanced_search')
+        mock_search.return_value = fake.load_response()
+        test_args['corpus'] = test_args['corpus'].split('+')
+        _, _, first_aggs = advanced_query_index(page=1, **test_args)
+        self.assertIn('aggs', mock_search.call_args[1]['body'])
+        self.assertEqual(mock_search.call_args[1]['body']['_source'], SOURCE_FIELDS)
+        _, _, second_aggs = advanced_query_index(page=2, **test_args)
+        self.assertEqual(mock_search.call_count, 2)
+        self.assertNotIn('aggs', mock_search.call_args[1]['body'])
+        self.assertEqual(mock_search.call_args[1]['body']['search_after'], ['urn:cts:cjhnt:nt.72-Col.grc001'])
+        self.assertEqual(first_aggs, second_aggs)
+
+    @patch.object(Elasticsearch, "open_point_in_time", return_value={'id': 'pit-1'})
+    @patch.object(Elasticsearch, "search")
+    def test_deep_pages_with_search_after(self, mock_search, mock_pit):
+        """ Make sure that pages after the first are retrieved with search_after and the cursors of visited pages"""
+        hits = [{'_id': str(i), '_source': {}, 'sort': ['urn:{:03}'.format(i)], 'highlight': {'text': ['a']}}
+                for i in range(100)]
+
+        def search(index=None, doc_type='', body=None):
+            start = body.get('from', 0)
+            if 'search_after' in body:
+                start = [hit['sort'] for hit in hits].index(body['search_after']) + 1
+            return {'hits': {'total': len(hits), 'hits': hits[start:start + body['size']]}, 'aggregations': {}}
+
+        mock_search.side_effect = search
+        ids, _, _ = advanced_query_index(corpus=['nt'], q='καὶ', page=4, sort='urn')
+        self.assertEqual([x['id'] for x in ids], [str(i) for i in range(30, 40)])
+        walk, page = [c[1]['body'] for c in mock_search.call_args_list]
+        self.assertEqual(walk['size'], 30)
+        self.assertFalse(walk['_source'])
+        self.assertNotIn('from', page)
+        self.assertEqual(page['search_after'], ['urn:029'])
+        self.assertEqual(page['pit'], {'id': 'pit-1', 'keep_alive': self.app.config['SEARCH_PIT_KEEP_ALIVE']})
+        # The cursors of the skipped pages and of the page after the current one are now known
+        ids, _, _ = advanced_query_index(corpus=['nt'], q='καὶ', page=3, sort='urn')
+        self.assertEqual([x['id'] for x in ids], [str(i) for i in range(20, 30)])
+        ids, _, _ = advanced_query_index(corpus=['nt'], q='καὶ', page=5, sort='urn')
+        self.assertEqual([x['id'] for x in ids], [str(i) for i in range(40, 50)])
+        self.assertEqual(mock_search.call_count, 4)
+        mock_pit.assert_called_once()
+        ids, _, _ = advanced_query_index(corpus=['nt'], q='καὶ', page=12, sort='urn')
+        self.assertEqual(ids, [])
+
+    @patch.object(Elasticsearch, "msearch")
+    @patch.object(Elasticsearch, "search")
+    def test_prefetch_next_pages(self, mock_search, mock_msearch):
+        """ Make sure that the following result pages are retrieved together in the background"""
+        test_args = OrderedDict([("corpus", "nt+tlg0527"), ("field", "text"), ("q", 'λόγος'), ("fuzziness", "0"),
+                                 ("in_order", "False"), ('slop', '0'), ('sort', 'urn')])
+        fake = FakeElasticsearch(self.build_file_name(test_args), 'advanced_search')
+        mock_search.return_value = fake.load_response()
+        mock_msearch.return_value = {'responses': [fake.load_response(), fake.load_response()]}
+        test_args['corpus'] = test_args['corpus'].split('+')
+        test_args['sort'] = 'min_date_asc'
+        self.app.config['SEARCH_PREFETCH_PAGES'] = 2
+        self.app.search_executor = ThreadPoolExecutor(max_workers=1)
+        advanced_query_index(**test_args)
+        self.app.search_executor.shutdown(wait=True)
+        lines = mock_msearch.call_args[1]['body']
+        self.assertEqual([line['from'] for line in lines[1::2]], [10, 20])
+        self.app.search_executor = None
+        advanced_query_index(page=3, **test_args)
+        self.assertEqual(mock_search.call_count, 1, 'The third page should have been prefetched.')
+
+    @patch.object(Elasticsearch, "search")
+    def test_search_timeout(self, mock_search):
+        """ Make sure that an empty result is shown when Elasticsearch does not answer in time"""
+        mock_search.side_effect = ConnectionTimeout('Connection timed out')
+        with self.client:
+            ids, hits, aggs = advanced_query_index(corpus=['nt'], q='λόγος')
+            self.assertEqual((ids, hits, aggs), ([], 0, {'corpus': {'buckets': {}}}))
+            self.assertMessageFlashed(_('Die Suche konnte nicht rechtzeitig beantwortet werden. '
+                                        'Bitte versuchen Sie es erneut.'))
+
     @patch.object(Elasticsearch, "search")
     def test_wildcard_text_search(self, mock_search):
         test_args = OrderedDict([("corpus", "all"), ("field", "text"), ("q", 'λ?γος'), ("fuzziness", "0"),
@@ -610,6 +1062,22 @@ class TestES(Formulae_Testing):
         mock_search.assert_called_with(index=test_args['corpus'], doc_type="", body=body)
         self.assertEqual(ids, [{"id": x['id']} for x in actual])
 
+    @patch.object(Elasticsearch, "search")
+    def test_lemma_search_with_offsets(self, mock_search):
+        """ Make sure that the exact inflected forms are highlighted when the lemma offsets have been indexed"""
+        text = 'Ἐν ἀρχῇ ἦν ὁ λόγος, καὶ ὁ λόγος ἦν πρὸς τὸν θεόν.'
+        lemmas = 'ἐν ἀρχή εἰμί ὁ λόγος καί ὁ λόγος εἰμί πρός ὁ θεός'
+        offsets = align_lemmas(text, lemmas)
+        self.assertEqual(text[offsets[8]:offsets[9]], 'λόγος')
+        self.assertEqual(text[offsets[22]:offsets[23]], 'θεόν')
+        mock_search.return_value = {'hits': {'total': 1, 'hits': [
+            {'_id': 'urn:cts:cjhnt:nt.64-Jn.grc001', '_source': {'text': text, 'lemmas': lemmas,
+                                                                 'lemma_offsets': offsets}}]},
+                                    'aggregations': {}}
+        hits, _, _ = advanced_query_index(corpus=['nt'], field='lemmas', q='λόγος εἰμί', slop='0', in_order='True')
+        self.assertEqual(hits[0]['sents'], [Markup('Ἐν ἀρχῇ ἦν ὁ λόγος, καὶ ὁ </small><strong>λόγος</strong><small> '
+                                                   '</small><strong>ἦν</strong><small> πρὸς τὸν θεόν')])
+
     @patch.object(Elasticsearch, "search")
     def test_multiword_lemma_advanced_search(self, mock_search):
         test_args = OrderedDict([("corpus", "all"), ("field", "lemmas"), ("q", 'λόγος+εἰμί'), ("fuzziness", "0"),
@@ -683,17 +1151,195 @@ class TestES(Formulae_Testing):
         self.assertEqual(build_sort_list('urn'), 'urn')
         self.assertEqual(build_sort_list('urn_desc'), [{'urn': {'order': 'desc'}}])
 
-    @patch.object(Elasticsearch, "search")
-    def test_suggest_word_search_completion(self, mock_search):
-        test_args = OrderedDict([("corpus", "all"), ("field", "autocomplete"), ("q", 'ἀγαπητῷ'), ("fuzziness", "0"),
-                                 ("in_order", "False"), ('slop', '0'), ('sort', 'urn')])
-        fake = FakeElasticsearch(self.build_file_name(test_args), 'advanced_search')
-        resp = fake.load_response()
-        expected = ['', 'ἀγαπητῷ καὶ συνεργῷ ἡμῶν καὶ Ἀπφίᾳ']
-        mock_search.return_value = resp
-        test_args.pop('q')
-        results = suggest_word_search('λόγο', **test_args)
-        self.assertEqual(results[:10], expected, 'The true results should match the expected results.')
+    def test_build_snippets(self):
+        """ Make sure that the snippets of all hits are built at once together with their result_sents"""
+        fragments = [['Ἐν ἀρχῇ ἦν ὁ </small><strong>λόγος</strong><small>, καὶ ὁ </small><strong>λόγος</strong><small> ἦν '
+                      'πρὸς τὸν θεόν, καὶ θεὸς ἦν ὁ λόγος. οὗτος ἦν ἐν ἀρχῇ πρὸς τὸν θεόν.', 'οὐδὲν ἐνταῦθα'],
+                     ['πάντα δι’ αὐτοῦ ἐγένετο, καὶ χωρὶς αὐτοῦ ἐγένετο οὐδὲ ἕν ὃ γέγονεν. ἐν αὐτῷ '
+                      '</small><strong>ζωὴ</strong><small> ἦν']]
+        snippets = build_snippets(fragments, 10, 10, '</small><strong>', '</strong><small>')
+        self.assertEqual([sents for sents, _ in snippets],
+                         [[Markup(highlight_segment(x, 10, 10, '</small><strong>', '</strong><small>')) for x in hit]
+                          for hit in fragments])
+        self.assertEqual(snippets[0][1], ['ἀρχῇ ἦν ὁ λόγος καὶ ὁ λόγος ἦν πρὸς τὸν', 'οὐδὲν ἐνταῦθα'])
+        self.assertEqual(snippets[1][1], ['γέγονεν ἐν αὐτῷ ζωὴ ἦν'])
+        # The result_sents need no further conversion when a result is opened
+        self.assertEqual(self.nemo.convert_result_sents('$'.join(snippets[0][1])), snippets[0][1])
+        # They are handed to the text view compactly encoded
+        code = encode_result_sents(snippets[0][1])
+        self.assertRegex(code, r'^[\w-]+$')
+        self.assertLess(len(code), len(quote('$'.join(snippets[0][1]))))
+        self.assertEqual(decode_result_sents(code), snippets[0][1])
+        self.assertEqual(decode_result_sents('not a code'), [])
+        self.assertIsNone(encode_result_sents(['']))
+        with self.client as c:
+            c.post('/auth/login', data=dict(username='project.member', password="some_password"),
+                   follow_redirects=True)
+            response = c.get('/texts/urn:cts:cjhnt:nt.86-Jud.grc001/passage/all?sents=' +
+                             encode_result_sents(['Ἰούδας Ἰησοῦ Χριστοῦ δοῦλος']))
+            self.assertIn('searched-start', response.get_data(as_text=True))
+
+    def test_highlight_by_position(self):
+        """ Make sure that the text view highlights the found sentences by the positions of their words, whether the
+            search results pass them on (lemma searches) or they are looked up in the text when it is opened"""
+        self.assertEqual(decode_result_code(encode_result_sents(['Ἰησοῦ Χριστῷ'], [(13, 14)])),
+                         (['Ἰησοῦ Χριστῷ'], [(13, 14)]))
+        self.assertEqual(decode_result_code(encode_result_sents(['Ἰησοῦ'])), (['Ἰησοῦ'], [None]))
+        url = '/texts/urn:cts:cjhnt:nt.86-Jud.grc001/passage/1.1?sents='
+        with self.client as c:
+            c.post('/auth/login', data=dict(username='project.member', password="some_password"),
+                   follow_redirects=True)
+            # The second Ἰησοῦ of the verse is highlighted although the first one also matches the sentence
+            data = c.get(url + encode_result_sents(['Ἰησοῦ'], [(13, 13)])).get_data(as_text=True)
+            self.assertRegex(data, r'<span class="searched"><span class="w searched-start searched-end"[^>]*>Ἰησοῦ'
+                                   r'</span></span> <span class="w"[^>]*>Χριστῷ')
+            self.assertNotIn('passageword', data)
+            # Without positions the sentence is looked up among the words of the passage
+            data = c.get(url + encode_result_sents(['καὶ Ἰησοῦ Χριστῷ'])).get_data(as_text=True)
+            self.assertRegex(data, r'<span class="searched"><span class="w searched-start"[^>]*>καὶ</span> '
+                                   r'<span class="w"[^>]*>Ἰησοῦ</span> <span class="w searched-end"[^>]*>Χριστῷ')
+            self.assertNotIn('passageword', data)
+            # Positions that do not match the sentence are ignored
+            data = c.get(url + encode_result_sents(['Ἰησοῦ'], [(0, 0)])).get_data(as_text=True)
+            self.assertRegex(data, r'<span class="searched"><span class="w searched-start searched-end"[^>]*>Ἰησοῦ'
+                                   r'</span></span> <span class="w"[^>]*>Χριστοῦ')
+        # The search results are highlighted over the stored passage instead of being rendered and stored again
+        with TemporaryDirectory() as cache_dir, \
+                patch.object(self.nemo, 'passage_cache', PassageCache(cache_dir, 'version1', 10 ** 7)), self.client as c:
+            c.post('/auth/login', data=dict(username='project.member', password="some_password"),
+                   follow_redirects=True)
+            plain = c.get(url).get_data(as_text=True)
+            self.assertNotIn('class="searched"', plain)
+            self.assertNotIn('passageword', plain)
+            with patch.object(self.nemo, 'render_passage') as mock_render:
+                data = c.get(url + encode_result_sents(['καὶ Ἰησοῦ Χριστῷ'])).get_data(as_text=True)
+                mock_render.assert_not_called()
+            self.assertRegex(data, r'<span class="searched"><span class="w searched-start"[^>]*>καὶ</span> ')
+            self.assertNotIn('passageword', data)
+
+    def test_autocompleter(self):
+        """ Make sure that the word being typed is completed from the vocabulary of the selected corpora"""
+        with TemporaryDirectory() as cache_dir:
+            completer = Autocompleter(self.app.config['CORPUS_FOLDERS'], cache_dir)
+            self.assertEqual(completer.complete('ἀγα'), ['ἀγαπητοί', 'ἀγαλλιάσει'])
+            self.assertEqual(completer.complete('Ἐν ἀρχ', corpora=['nt'], size=1), ['Ἐν ἀρχάγγελος'])
+            self.assertEqual(completer.complete('θε', field='autocomplete_lemmas'), ['θεός'])
+            self.assertEqual(completer.complete('ἀγα', corpora=['tlg0527']), [])
+            self.assertEqual(completer.complete('ἀγα '), [])
+            # The beginning of a word may differ from what is typed by the fuzziness of the search
+            self.assertEqual(completer.complete('ἀκα'), [])
+            self.assertEqual(completer.complete('ἀκα', fuzziness='1'), ['ἀγαπητοί', 'ἀγαλλιάσει', 'ἄκαρπα'])
+            # The vocabulary is stored and reused as long as the corpus does not change
+            self.assertTrue(os.path.isfile(completer.path))
+            with patch.object(Autocompleter, 'read_texts') as mock_read:
+                self.assertEqual(Autocompleter(self.app.config['CORPUS_FOLDERS'], cache_dir).complete('ἀγα', size=1),
+                                 ['ἀγαπητοί'])
+                mock_read.assert_not_called()
+        self.assertIsNone(self.app.autocompleter._vocabularies, 'The vocabulary should only be loaded on first use')
+        with self.client as c:
+            c.post('/auth/login', data=dict(username='project.member', password="some_password"),
+                   follow_redirects=True)
+            response = c.get('/search/suggest/ἀγα?corpus=nt+tlg0527&field=autocomplete')
+            self.assertEqual(json.loads(response.get_data(as_text=True)), ['ἀγαπητοί', 'ἀγαλλιάσει'])
+            response = c.get('/search/suggest/ἀκα?corpus=nt&field=autocomplete&fuzziness=1&in_order=False&slop=0')
+            self.assertEqual(json.loads(response.get_data(as_text=True)), ['ἀγαπητοί', 'ἀγαλλιάσει', 'ἄκαρπα'])
+            # Completions cannot be restricted to dates or places
+            self.assertEqual(c.get('/search/suggest/ἀγα?year=814').status_code, 400)
+            self.assertEqual(c.get('/search/suggest/ἀγα?composition_place=Basel').status_code, 400)
+
+    def test_local_search(self):
+        """ Make sure that the corpus can be searched without Elasticsearch"""
+        jude = 'urn:cts:cjhnt:nt.86-Jud.grc001'
+        with TemporaryDirectory() as cache_dir:
+            local = LocalSearch(self.app.config['CORPUS_FOLDERS'], cache_dir)
+            self.app.elasticsearch = local
+            self.app.search_cache = None
+            hits, total, aggs = advanced_query_index(corpus=['all'], field='text', q='ὑμεῖς δέ ἀγαπητοί', slop='0',
+                                                     in_order='True', sort='urn')
+            self.assertEqual([x['id'] for x in hits], [jude])
+            self.assertEqual(aggs['corpus']['buckets']['NT'], {'doc_count': 1})
+            self.assertIn('</small><strong>ἀγαπητοί,</strong><small>', str(hits[0]['sents'][0]))
+            self.assertEqual(advanced_query_index(corpus=['nt'], field='text', q='ἀγαπητοί δέ', slop='0',
+                                                  in_order='True')[1], 0, 'The order of the words should be kept')
+            self.assertEqual(advanced_query_index(corpus=['nt'], field='text', q='ἀγαπητοί δέ', slop='0',
+                                                  in_order='False')[1], 1)
+            self.assertEqual(advanced_query_index(corpus=['nt'], field='text', q='ὑμεῖς ἀγαπητοί', slop='1',
+                                                  in_order='True')[1], 1)
+            self.assertEqual(advanced_query_index(corpus=['nt'], field='text', q='ἀγαπητοι', fuzziness='1')[1], 1)
+            self.assertEqual(advanced_query_index(corpus=['nt'], field='text', q='ἀγαπ*οί')[1], 1)
+            self.assertEqual(advanced_query_index(corpus=['tlg0527'], field='text', q='ἀγαπ*οί')[1], 0)
+            hits, total, aggs = advanced_query_index(corpus=['all'], field='lemmas', q='ἀγαπητός', slop='0')
+            self.assertEqual([x['id'] for x in hits], [jude])
+            self.assertIn('</small><strong>Ἀγαπητοί</strong><small>', hits[0]['sents'][0])
+            # The index is stored and reused as long as the corpus does not change
+            with patch('formulae.search.local.read_documents') as mock_read:
+                self.assertEqual(LocalSearch(self.app.config['CORPUS_FOLDERS'], cache_dir).build(), local.build())
+                mock_read.assert_not_called()
+            # A new index replaces the old one but not the temporary files of a build that is still in progress
+            in_progress = os.path.join(cache_dir, 'other.json.1.tmp')
+            stale = os.path.join(cache_dir, 'older.store.2.tmp')
+            for path in (in_progress, stale):
+                open(path, 'w').close()
+            os.utime(stale, (0, 0))
+            build_index(cache_dir, read_documents(self.app.config['CORPUS_FOLDERS']), 'rebuilt')
+            self.assertEqual(sorted(os.listdir(cache_dir)), ['other.json.1.tmp', 'rebuilt.json', 'rebuilt.postings',
+                                                             'rebuilt.store'])
+
+    def test_corpus_indexer(self):
+        """ Make sure that the texts are indexed with the bulk API and that only changed texts are indexed again"""
+        failing = set()
+
+        def bulk(operations=None, **kwargs):
+            items = []
+            for line in operations:
+                action = json.loads(line)
+                if list(action) in [['index'], ['delete']]:
+                    op_type, meta = next(iter(action.items()))
+                    status = 500 if meta['_id'] in failing else 200 if op_type == 'delete' else 201
+                    items.append({op_type: {'_index': meta['_index'], '_id': meta['_id'], 'status': status}})
+            return MagicMock(body={'errors': bool(failing), 'items': items})
+
+        jude = 'urn:cts:cjhnt:nt.86-Jud.grc001'
+        salzburg = 'urn:cts:formulae:salzburg.hauthaler-a0001.lat001'
+        created = set()
+        es = Elasticsearch('http://localhost:9200')
+        with TemporaryDirectory() as tmp_dir, patch.object(Elasticsearch, 'bulk', side_effect=bulk) as mock_bulk, \
+                patch.object(es, 'indices') as mock_indices:
+            mock_indices.exists.side_effect = lambda index: index in created
+            mock_indices.create.side_effect = lambda index, **kwargs: created.add(index)
+            shutil.copytree(os.path.join(self.app.config['CORPUS_FOLDERS'][0], 'data'), os.path.join(tmp_dir, 'data'))
+            indexer = CorpusIndexer(es, [tmp_dir], os.path.join(tmp_dir, 'cache'))
+            stats = indexer.run()
+            self.assertEqual((stats['indexed'], stats['unchanged']), (6, 0))
+            # The missing indices are created with the edge n-grams of the autocomplete fields
+            self.assertEqual(created, {'nt', 'tlg0018', 'tlg0527', 'commentary', 'salzburg'})
+            mappings = mock_indices.create.call_args[1]['mappings']['properties']
+            self.assertEqual(mappings['autocomplete']['analyzer'], 'autocomplete')
+            self.assertEqual(mappings['autocomplete_lemmas']['analyzer'], 'autocomplete')
+            lines = [json.loads(line) for c in mock_bulk.call_args_list for line in c[1]['operations']]
+            i = lines.index({'index': {'_index': 'nt', '_id': jude}})
+            self.assertEqual(lines[i + 1]['lemma_offsets'], align_lemmas(lines[i + 1]['text'], lines[i + 1]['lemmas']))
+            self.assertEqual(lines[i + 1]['autocomplete_lemmas'], lines[i + 1]['lemmas'])
+            self.assertEqual(lines[i + 1]['date_string'], ' ')
+            i = lines.index({'index': {'_index': 'salzburg', '_id': salzburg}})
+            self.assertEqual((lines[i + 1]['date_string'], lines[i + 1]['comp_ort'], lines[i + 1]['orig_comp_ort']),
+                             ('923 10(?) 26', 'Salzburg', 'Salzburg (St. Rudbert)'))
+            mock_bulk.reset_mock()
+            self.assertEqual(indexer.run()['unchanged'], 6)
+            mock_bulk.assert_not_called()
+            jude_file = os.path.join(tmp_dir, 'data', 'nt', '86-Jud', 'nt.86-Jud.grc001.xml')
+            os.utime(jude_file, ns=(os.stat(jude_file).st_atime_ns, os.stat(jude_file).st_mtime_ns + 10 ** 9))
+            os.remove(os.path.join(tmp_dir, 'data', 'tlg0527', 'tlg052', 'tlg0527.tlg052.1st1K-grc1.xml'))
+            failing.add(jude)
+            stats = indexer.run()
+            self.assertEqual((stats['indexed'], stats['deleted'], stats['failed'], stats['unchanged']), (0, 1, 1, 4))
+            failing.clear()
+            stats = indexer.run()
+            self.assertEqual((stats['indexed'], stats['failed']), (1, 0), 'A failed text should be indexed again')
+            self.assertEqual(indexer.run(full=True)['indexed'], 5)
+            mock_indices.delete.assert_not_called()
+            self.assertEqual(indexer.run(recreate=True)['indexed'], 5)
+            self.assertEqual(mock_indices.delete.call_count, 5)
 
     @patch.object(Elasticsearch, "search")
     def test_single_lemma_highlighting(self, mock_search):